@@ -0,0 +1,172 @@
+"""
+Benchmark the tree, sparse and dense GP engines on synthetic data.
+
+Inputs are generated on the fly (no dataset directories needed), so a
+full run is one offline command:
+
+    python -m treegp.experiments.code.benchmark --out results.json
+
+Each configuration times the GP fit (factorization and the timings it
+records), tree build, prediction, every variance method, and the
+likelihood gradient. Results are written as JSON. Given --baseline, the
+results are compared against a previous run, and the exit status is
+nonzero if any timing regressed by more than --threshold.
+"""
+
+import sys
+import time
+import json
+import platform
+import numpy as np
+from optparse import OptionParser
+
+from treegp.gp import GP, GPCov, prior_sample_scalable
+from treegp.experiments.code.synth_dataset import genX, genX_clusters
+
+# (name, generator args): uniform points at a range of lengthscales,
+# and clustered points at a fixed lengthscale.
+CONFIGS = [
+    ("uniform_lscale1", dict(points_within_lscale=1.0)),
+    ("uniform_lscale10", dict(points_within_lscale=10.0)),
+    ("uniform_lscale50", dict(points_within_lscale=50.0)),
+    ("cluster_w0.01", dict(n_clusters=20, cluster_width=0.01)),
+    ("cluster_w0.03", dict(n_clusters=20, cluster_width=0.03)),
+]
+
+# variance methods to time, with the kwargs they're called with
+VARIANCE_METHODS = [
+    ("covariance", dict()),
+    ("covariance_spkernel", dict()),
+    ("covariance_spkernel_solve", dict()),
+    ("covariance_treedense", dict()),
+    ("covariance_double_tree", dict(eps_abs=1e-4, cutoff_rule=1)),
+]
+
+def gen_problem(config, npts, test_n, dim, seed, noise_var=1.0):
+    np.random.seed(seed)
+    if "n_clusters" in config:
+        n_clusters = config["n_clusters"]
+        cluster_pts = int(np.ceil((npts + test_n) / float(n_clusters)))
+        X = genX_clusters(dim, n_clusters, cluster_pts, config["cluster_width"])
+        lengthscale = np.sqrt(2.0/n_clusters) / np.sqrt(np.pi)
+    else:
+        X = genX(dim, npts + test_n)
+        lengthscale = np.sqrt(config["points_within_lscale"]/npts) / np.sqrt(np.pi)
+    X = X[np.random.permutation(len(X))[:npts + test_n]]
+
+    cov = GPCov(wfn_params=[1.0,], dfn_params=[lengthscale,] * dim, dfn_str="euclidean", wfn_str="compact2")
+    y = prior_sample_scalable(X, cov, noise_var)
+    return X[:npts], y[:npts], X[npts:], cov
+
+def time_queries(f, X):
+    # mean time per single-point query
+    t0 = time.time()
+    for i in range(X.shape[0]):
+        f(X[i:i+1,:])
+    return (time.time() - t0) / X.shape[0]
+
+def bench_config(config, npts, test_n, dim, seed, noise_var=1.0):
+    X, y, test_X, cov = gen_problem(config, npts, test_n, dim, seed, noise_var=noise_var)
+    r = dict()
+
+    t0 = time.time()
+    gp = GP(X=X, y=y, noise_var=noise_var, cov_main=cov, compute_ll=True, sparse_invert=True, build_tree=False)
+    r['fit'] = time.time() - t0
+    for k in ('chol_factor', 'solve_alpha', 'solve_Kinv'):
+        if k in gp.timings:
+            r[k] = gp.timings[k]
+
+    t0 = time.time()
+    gp.build_point_tree(HKinv=gp.HKinv, Kinv=gp.Kinv, alpha_r=gp.alpha_r, leaf_bin_width=0, build_dense_Kinv_hack=True)
+    r['tree_build'] = time.time() - t0
+
+    r['predict_tree'] = time_queries(gp.predict, test_X)
+    r['predict_naive'] = time_queries(gp.predict_naive, test_X)
+    for (method, kwargs) in VARIANCE_METHODS:
+        f = getattr(gp, method)
+        r[method] = time_queries(lambda x: f(x, **kwargs), test_X)
+
+    t0 = time.time()
+    gp._log_likelihood_gradient(z=gp.y, Kinv=gp.Kinv)
+    r['ll_grad'] = time.time() - t0
+
+    return r
+
+def run(configs, npts, test_n, dim, seed, repeats):
+    results = dict()
+    for (name, config) in configs:
+        runs = [bench_config(config, npts, test_n, dim, seed) for i in range(repeats)]
+        # the fastest repeat is the least affected by other load on the machine
+        results[name] = dict([(k, min([rr[k] for rr in runs])) for k in runs[0].keys()])
+        print "%s: %s" % (name, ", ".join(["%s %.4fs" % (k, results[name][k]) for k in sorted(results[name].keys())]))
+    return results
+
+def compare(results, baseline, threshold, min_time):
+    """
+    Returns a list of (config, phase, baseline time, new time) for
+    every timing that is more than threshold (relative) slower than
+    the baseline. Timings under min_time seconds in both runs are
+    ignored, since they are mostly noise.
+    """
+    regressions = []
+    for name in sorted(results.keys()):
+        if name not in baseline:
+            continue
+        for phase in sorted(results[name].keys()):
+            if phase not in baseline[name]:
+                continue
+            old, new = baseline[name][phase], results[name][phase]
+            if max(old, new) < min_time:
+                continue
+            if new > old * (1 + threshold):
+                regressions.append((name, phase, old, new))
+    return regressions
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--npts", dest="npts", default=2000, type="int", help="training points per configuration (2000)")
+    parser.add_option("--test_n", dest="test_n", default=100, type="int", help="test points per configuration (100)")
+    parser.add_option("--dim", dest="dim", default=2, type="int", help="input dimension (2)")
+    parser.add_option("--seed", dest="seed", default=0, type="int", help="random seed for the synthetic data (0)")
+    parser.add_option("--repeats", dest="repeats", default=1, type="int", help="run each configuration this many times, keeping the fastest (1)")
+    parser.add_option("--configs", dest="configs", default=None, type="str", help="comma-separated configurations to run (all)")
+    parser.add_option("--out", dest="out", default=None, type="str", help="write results to this JSON file")
+    parser.add_option("--baseline", dest="baseline", default=None, type="str", help="compare against the results in this JSON file")
+    parser.add_option("--threshold", dest="threshold", default=0.2, type="float", help="relative slowdown that counts as a regression (0.2)")
+    parser.add_option("--min_time", dest="min_time", default=1e-4, type="float", help="ignore timings below this many seconds (1e-4)")
+    (options, args) = parser.parse_args()
+
+    configs = CONFIGS
+    if options.configs is not None:
+        names = options.configs.split(",")
+        unknown = [n for n in names if n not in dict(CONFIGS)]
+        if len(unknown) > 0:
+            raise ValueError("unknown configurations %s" % unknown)
+        configs = [(n, c) for (n, c) in CONFIGS if n in names]
+
+    results = run(configs, options.npts, options.test_n, options.dim, options.seed, options.repeats)
+
+    out = {"params": {"npts": options.npts, "test_n": options.test_n, "dim": options.dim,
+                      "seed": options.seed, "repeats": options.repeats},
+           "host": platform.node(),
+           "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+           "results": results}
+    if options.out is not None:
+        with open(options.out, "w") as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+        print "wrote results to", options.out
+
+    if options.baseline is not None:
+        with open(options.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline["params"] != out["params"]:
+            print "WARNING: baseline was run with different parameters %s" % baseline["params"]
+        regressions = compare(results, baseline["results"], options.threshold, options.min_time)
+        for (name, phase, old, new) in regressions:
+            print "REGRESSION: %s %s took %.4fs, baseline %.4fs (%+.0f%%)" % (name, phase, new, old, 100 * (new/old - 1))
+        if len(regressions) > 0:
+            sys.exit(1)
+        print "no regressions against", options.baseline
+
+if __name__ == "__main__":
+    main()
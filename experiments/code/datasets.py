@@ -17,31 +17,46 @@ def get_data_dir(dataset_name):
     mkdir_p(d)
     return d
 
+def load_array(data_dir, name):
+    """
+    Load the array stored as name.txt (CSV with a header row) or
+    name.npy in data_dir, read-only and memory-mapped.
+
+    Parsing large CSVs is slow, so the first load of name.txt writes
+    a binary copy to name.txt.npy, and later loads map that copy
+    instead, as long as it's newer than the CSV.
+    """
+    txt_fname = os.path.join(data_dir, name + ".txt")
+    if os.path.exists(txt_fname):
+        cache_fname = txt_fname + ".npy"
+        if not os.path.exists(cache_fname) or os.path.getmtime(cache_fname) < os.path.getmtime(txt_fname):
+            A = np.loadtxt(txt_fname, skiprows=1, delimiter=',')
+            # write and rename, so a concurrent or interrupted load
+            # never sees a partial cache.
+            tmp_fname = "%s.%d.tmp" % (cache_fname, os.getpid())
+            with open(tmp_fname, 'wb') as f:
+                np.save(f, A)
+            os.rename(tmp_fname, cache_fname)
+        return np.load(cache_fname, mmap_mode='r')
+
+    return np.load(os.path.join(data_dir, name + ".npy"), mmap_mode='r')
+
 def test_data(dataset_name):
     data_dir = get_data_dir(dataset_name)
-
-    try:
-        X_test = np.loadtxt(os.path.join(data_dir, "X_test.txt"), skiprows=1, delimiter=',')
-        y_test = np.loadtxt(os.path.join(data_dir, "y_test.txt"), skiprows=1, delimiter=',')
-    except IOError:
-        X_test = np.load(os.path.join(data_dir, "X_test.npy"))
-        y_test = np.load(os.path.join(data_dir, "y_test.npy"))
-
+    X_test = load_array(data_dir, "X_test")
+    y_test = load_array(data_dir, "y_test")
     return X_test, y_test
 
 def training_data(dataset_name, n=None):
+    # arrays are read-only memory maps, and slices of them are views,
+    # so taking the first n points doesn't read the rest.
     data_dir = get_data_dir(dataset_name)
-
-    try:
-        X_train = np.loadtxt(os.path.join(data_dir, "X_train.txt"), skiprows=1, delimiter=',')
-        y_train = np.loadtxt(os.path.join(data_dir, "y_train.txt"), skiprows=1, delimiter=',')
-    except IOError:
-        X_train = np.load(os.path.join(data_dir, "X_train.npy"))
-        y_train = np.load(os.path.join(data_dir, "y_train.npy"))
+    X_train = load_array(data_dir, "X_train")
+    y_train = load_array(data_dir, "y_train")
 
     if n is not None:
-        X_train = np.array(X_train[:n,:], copy=True)
-        y_train = np.array(y_train[:n], copy=True)
+        X_train = X_train[:n,:]
+        y_train = y_train[:n]
 
     return X_train, y_train
 
@@ -1,15 +1,10 @@
 import numpy as np
 import time
 import os
-from sigvisa.models.spatial_regression.SparseGP_CSFIC import SparseGP_CSFIC
+from treegp.gp import GP, GPCov, sum_log_p, maximize_sum_log_p
 
 def x_lp(x, missing_vals, models):
-
-    lp = 0
-    for (y, model) in zip(missing_vals, models):
-        mylp = model.log_p(x=y, cond=x, covar="double_tree")
-        lp += mylp
-    return lp
+    return sum_log_p(models, missing_vals, x)[0]
 
 def gridsearch(min_x, max_x, ks, missing_vals, models):
 
@@ -17,17 +12,13 @@ def gridsearch(min_x, max_x, ks, missing_vals, models):
     x2s = np.linspace(min_x[1], max_x[1], ks[1])
     x3s = np.linspace(min_x[2], max_x[2], ks[2])
 
-    max_lp = -999
-    max_lp_x = []
-    lp = np.zeros(ks)
-    for (i,x1) in enumerate(x1s):
-        for (j,x2) in enumerate(x2s):
-            for (k,x3) in enumerate(x3s):
-                x = np.array(((x1, x2, x3),))
-                lp[i,j,k] = x_lp(x, missing_vals, models)
-                if (lp[i,j,k] > max_lp):
-                    max_lp = lp[i,j,k]
-                    max_lp_x = x
+    # evaluate every cell of the grid in one batched call
+    grid = np.array(np.meshgrid(x1s, x2s, x3s, indexing='ij')).reshape((3, -1)).T
+    lp = np.reshape(sum_log_p(models, missing_vals, grid), ks)
+
+    best = np.argmax(lp)
+    max_lp = lp.flat[best]
+    max_lp_x = grid[best:best+1, :]
 
     print "max", max_lp, "at", max_lp_x
     return lp, x1s, x2s, x3s, max_lp_x
@@ -86,14 +77,13 @@ def main():
 
         fname = "model_%s%s.gp" % (month, model_str)
         if os.path.exists(fname):
-            model = SparseGP_CSFIC(fname=fname, build_tree=True, leaf_bin_size=15)
+            model = GP(fname=fname, build_tree=True, sparse_invert=True)
         else:
-            model = SparseGP_CSFIC(X=X, y=y,
-                                   dfn_str=dfn_str, dfn_params_fic=dfn_params_fic, dfn_params_cs=dfn_params_cs,
-                                   wfn_str_fic = wfn_str_fic, wfn_params_fic=wfn_params_fic,
-                                   wfn_str_cs = wfn_str_cs, wfn_params_cs=wfn_params_cs,
-                                   build_tree=True, sort_events=True, center_mean=False,
-                                   noise_var=noise_var, Xu=Xu, leaf_bin_size=15)
+            cov_main = GPCov(wfn_params=wfn_params_cs, dfn_params=dfn_params_cs, wfn_str=wfn_str_cs, dfn_str=dfn_str)
+            cov_fic = GPCov(wfn_params=wfn_params_fic, dfn_params=dfn_params_fic, wfn_str=wfn_str_fic, dfn_str=dfn_str, Xu=Xu)
+            model = GP(X=X, y=y, cov_main=cov_main, cov_fic=cov_fic,
+                       build_tree=True, sort_events=True, center_mean=False,
+                       noise_var=noise_var, sparse_invert=True)
             model.save_trained_model(fname)
         models.append(model)
 
@@ -118,6 +108,15 @@ def main():
     print  "second gridsearch took", t2-t1
     print "total time", t2-t0
 
+    # branch-and-bound over the full region, at the resolution of the
+    # second grid.
+    ks = np.array((20, 20, 7))
+    min_width = np.array([5.0, 5.0, 10.0]) / (ks - 1)
+    bb_x, bb_lp, stats = maximize_sum_log_p(models, np.array(missing_vals), np.min(X, axis=0), np.max(X, axis=0), min_width)
+    t3 = time.time()
+    print "branch and bound: max", bb_lp, "at", bb_x
+    print "branch and bound took", t3-t2, "with", stats['evals'], "evaluations and", stats['bounds'], "bounds, vs", 2*np.prod(ks), "for the grids"
+
 if __name__ == "__main__":
 
     try:
@@ -9,7 +9,7 @@ from scikits.sparse.cholmod import cholesky as sp_cholesky
 import scipy.sparse
 import scipy.special
 
-from treegp.gp import GP, GPCov, prior_sample, sort_morton
+from treegp.gp import GP, GPCov, prior_sample_scalable, sort_morton
 from treegp.experiments.code.datasets import save_hparams, get_data_dir
 
 basedir = "experiments/datasets/"
@@ -35,7 +35,7 @@ def sort_events(X):
     return X_sorted
 
 def genX(dim, npts):
-    pts = np.array([[np.random.rand() for d in range(dim)] for i in range(npts)]) # generate n_clusters points within the unit cube of dimension dim
+    pts = np.random.rand(npts, dim) # generate npts points within the unit cube of dimension dim
     return pts
 
 
@@ -116,7 +116,7 @@ def run_lscale_benchmark():
 def create_bench(dsetname, dim, test_n, npts, lengthscale, sigma2_n, sigma2_f, wfn_str="compact2", cluster_args=None):
     sparse_threshold=1e-8
 
-    cov_main = GPCov(dfn_str="euclidean", wfn_str=wfn_str, wfn_params=[sigma2_f,], dfn_params=[lengthscale,lengthscale])
+    cov_main = GPCov(dfn_str="euclidean", wfn_str=wfn_str, wfn_params=[sigma2_f,], dfn_params=[lengthscale,] * dim)
     save_hparams(dataset_name=dsetname, model_name=wfn_str, cov_main=cov_main, cov_fic=None, noise_var=sigma2_n)
 
 
@@ -125,12 +125,19 @@ def create_bench(dsetname, dim, test_n, npts, lengthscale, sigma2_n, sigma2_f, w
         X = genX_clusters(dim, **cluster_args)
     else:
         X = genX(dim, npts + test_n)
+
+    # sample train and test observations jointly from the GP prior. This
+    # never forms the dense covariance, so it scales to millions of points.
+    t0 = time.time()
+    y = prior_sample_scalable(X, cov_main, sigma2_n, sparse_threshold=sparse_threshold)
+    print "sampled %d points from the prior in %.1fs" % (len(X), time.time()-t0)
+
     test_p = np.random.permutation(len(X))
     test_X = X[test_p[:test_n], :]
-    test_y = np.random.randn(test_X.shape[0])
+    test_y = y[test_p[:test_n]]
 
     X = np.array(X[test_p[test_n:], :])
-    y = np.random.randn(X.shape[0])
+    y = np.array(y[test_p[test_n:]])
 
 
     data_dir = get_data_dir(dsetname)
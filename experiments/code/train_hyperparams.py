@@ -7,7 +7,7 @@ from collections import defaultdict
 import cPickle as pickle
 
 from treegp.distributions import LogUniform, LogNormal, InvGamma
-from treegp.gp import GP, GPCov, optimize_gp_hyperparams
+from treegp.gp import GP, GPCov, optimize_gp_hyperparams, CholmodAnalysisCache
 
 from datasets import *
 
@@ -58,19 +58,30 @@ def train_hyperparams(X,
     noise_var, cov_main, cov_fic = covs_from_vector(result.x)
     return noise_var, cov_main, cov_fic
 
-def choose_best_hparams(covs, X, y, noise_prior, sparse_invert=False):
+def choose_best_hparams(covs, X, y, noise_prior, sparse_invert=False, solver="cholmod"):
+    # with solver="pcg", likelihoods use iterative solves and a
+    # stochastic log-determinant estimate, so evaluation sets too large
+    # to factor can still be compared.
 
-    noise_var, cov_main, cov_fic = covs[0]
-
-    nllgrad, x0, bounds, build_gp, covs_from_vector = optimize_gp_hyperparams(noise_var=noise_var, cov_main=cov_main, cov_fic=cov_fic, X=X, y=y, noise_prior=noise_prior, sparse_invert=sparse_invert, build_tree=False)
+    # restarts often converge to the same hyperparameters, so each
+    # distinct setting is only fit once, and sparse fits share their
+    # symbolic factorization.
+    chol_cache = CholmodAnalysisCache()
+    lls = dict()
 
     best_ll = np.float('-inf')
     for (noise_var, cov_main, cov_fic) in covs:
 
-        gp = GP(compute_ll=True, noise_var=noise_var,
-                cov_main=cov_main, cov_fic=cov_fic, X=X, y=y, sparse_invert=False, build_tree=False)
-        ll = gp.ll
-        del gp
+        key = np.concatenate([[noise_var,],
+                              cov_main.flatten() if cov_main is not None else [],
+                              cov_fic.flatten() if cov_fic is not None else []]).tostring()
+        if key not in lls:
+            gp = GP(compute_ll=True, noise_var=noise_var,
+                    cov_main=cov_main, cov_fic=cov_fic, X=X, y=y, sparse_invert=sparse_invert, build_tree=False,
+                    solver=solver, chol_cache=chol_cache)
+            lls[key] = gp.ll
+            del gp
+        ll = lls[key]
 
         ll += noise_prior.log_p(noise_var) + \
               ( cov_main.prior_logp() if cov_main is not None else 0 ) + \
@@ -139,7 +150,7 @@ def train_csfic(dataset_name, dfn_params_fic, dfn_params_cs, dfn_str="euclidean"
     optim_tag = "_xu" if optimize_xu else ""
     save_hparams(dataset_name, "csfic%d" % n_fic, cov_main_best, cov_fic_best, noise_var_best, tag="%d%s" % (n_train_hyper,optim_tag) )
 
-def train_standard(dataset_name, dfn_params, wfn_str="se", dfn_str="euclidean", n_train_hyper=1500, random_restarts=3, dfn_priors=[], sparse_invert=False):
+def train_standard(dataset_name, dfn_params, wfn_str="se", dfn_str="euclidean", n_train_hyper=1500, random_restarts=3, dfn_priors=[], sparse_invert=False, rff_dim=None):
 
 
     X_full, y_full = training_data(dataset_name)
@@ -154,14 +165,17 @@ def train_standard(dataset_name, dfn_params, wfn_str="se", dfn_str="euclidean",
     cov_main = GPCov(wfn_str=wfn_str, dfn_str=dfn_str,
                       wfn_params=[1.0,], dfn_params=dfn_params,
                       wfn_priors=[ln],
-                      dfn_priors=dfn_priors)
+                      dfn_priors=dfn_priors,
+                      rff_dim=rff_dim)
     noise_var = 0.01
 
+    model_name = wfn_str if rff_dim is None else "%srff%d" % (wfn_str, rff_dim)
+
     covs = []
     for i in range(random_restarts):
 
         def save_progress(noise_var, cov_main, cov_fic):
-            save_hparams(dataset_name, wfn_str, cov_main, cov_fic, noise_var, tag="%d_round%d" % (n_train_hyper,i) )
+            save_hparams(dataset_name, model_name, cov_main, cov_fic, noise_var, tag="%d_round%d" % (n_train_hyper,i) )
 
 
         X, y = subsample_data(X_full, y_full, n_train_hyper)
@@ -172,7 +186,7 @@ def train_standard(dataset_name, dfn_params, wfn_str="se", dfn_str="euclidean",
 
     X_eval, y_eval = subsample_data(X_full, y_full, n_train_hyper)
     noise_var_best, cov_main_best, _ = choose_best_hparams(covs, X_eval, y_eval, ln)
-    save_hparams(dataset_name, wfn_str, cov_main_best, None, noise_var_best, tag="%d" % (n_train_hyper,) )
+    save_hparams(dataset_name, model_name, cov_main_best, None, noise_var_best, tag="%d" % (n_train_hyper,) )
 
 
 initial_cs_params = {
@@ -217,7 +231,7 @@ dfn_se_priors['seismic_fitz'] = [LogNormal(np.log(500.0), 1.0), LogNormal(np.log
 dfn_se_priors['seismic_as12'] = [LogNormal(np.log(500.0), 1.0), LogNormal(np.log(500.0), 1.0)]
 dfn_cs_priors['sarcos'] = [LogNormal(6, 1.0),] * 21
 
-def train_hparams(dataset, fic=None, se=False, optimize_xu=False, n_hyper=2500, random_restarts=1):
+def train_hparams(dataset, fic=None, se=False, rff=None, optimize_xu=False, n_hyper=2500, random_restarts=1):
 
     dfn_str="euclidean"
     if dataset.startswith("seismic"):
@@ -227,7 +241,12 @@ def train_hparams(dataset, fic=None, se=False, optimize_xu=False, n_hyper=2500,
     if (dataset == "snow" or dataset == "tco"):
 	sparse_invert_se = True
 
-    if fic is None:
+    if rff is not None:
+        # SE kernel approximated by random features: training is
+        # O(n rff^2) and the noise-only kernel matrix is diagonal.
+        assert(fic is None and dfn_str == "euclidean")
+        train_standard(dataset, initial_se_params[dataset], dfn_str=dfn_str, n_train_hyper=n_hyper, random_restarts=random_restarts, dfn_priors=dfn_se_priors[dataset], wfn_str="se", sparse_invert=True, rff_dim=int(rff))
+    elif fic is None:
         if se:
             train_standard(dataset, initial_se_params[dataset], dfn_str=dfn_str, n_train_hyper=n_hyper, random_restarts=random_restarts, dfn_priors=dfn_se_priors[dataset], wfn_str="se", sparse_invert=sparse_invert_se)
         else:
@@ -2,6 +2,9 @@ import os
 import time
 import numpy as np
 import collections
+import itertools
+import heapq
+import threading
 import scipy
 import scipy.sparse
 import scipy.sparse.linalg
@@ -12,14 +15,42 @@ import types
 import marshal
 
 from features import featurizer_from_string, recover_featurizer
-from cover_tree import VectorTree, MatrixTree
+from cover_tree import VectorTree, MatrixTree, sparse_fic_trace
 from util import mkdir_p
-
-import scipy.weave as weave
-from scipy.weave import converters
+from ski import SKIGrid
+from vecchia import previous_neighbors, VecchiaApprox
+from iterative import conjugate_gradient, lanczos, slq_logdet, PCGSolver
+from profiling import GPStats, profiled
 
 from gpy_linalg import pdinv, dpotrs
 
+# with this many inducing points or fewer, we precompute Luu^-1 and use
+# a matrix multiply in place of triangular solves against Luu.
+FIC_EXPLICIT_INV_MAX = 16
+
+# structured kernel interpolation: relative residual for the CG solve
+# of the training system, and the number of Lanczos vectors kept for
+# fast predictive variances.
+SKI_CG_TOL = 1e-8
+SKI_LOVE_RANK = 50
+
+# solver="pcg": relative residual for each solve, and the number of
+# (Morton-ordered) points in each block of the block-Jacobi
+# preconditioner.
+PCG_TOL = 1e-8
+PCG_BLOCK_SIZE = 64
+
+# without a factorization (solver="pcg" or ski_grid), log det K for
+# the marginal likelihood is estimated by stochastic Lanczos
+# quadrature with this many probes and Lanczos steps. The probes come
+# from a fixed seed so likelihoods of different models are comparable.
+SLQ_PROBES = 30
+SLQ_STEPS = 30
+SLQ_SEED = 0
+
+# symbolic CHOLMOD analyses kept by the default cache shared by all
+# sparse fits (see CholmodAnalysisCache).
+CHOL_CACHE_PATTERNS = 4
 
 def marshal_fn(f):
     if f.func_closure is not None:
@@ -32,8 +63,18 @@ def unmarshal_fn(dumped_code):
     f = types.FunctionType(f_code, globals())
     return f
 
-def sparse_kernel_from_tree(tree, X, sparse_threshold, identical, noise_var):
-    max_distance = np.sqrt(-np.log(sparse_threshold)) # assuming a SE kernel
+def cov_max_distance(cov, sparse_threshold):
+    # distance beyond which the kernel is (treated as) zero
+    if cov.wfn_str=="se" and sparse_threshold>0:
+        return np.sqrt(-np.log(sparse_threshold))
+    elif cov.wfn_str.startswith("compact"):
+        return 1.0
+    else:
+        return 1e300
+
+def sparse_kernel_from_tree(tree, X, sparse_threshold, identical, noise_var, max_distance=None):
+    if max_distance is None:
+        max_distance = np.sqrt(-np.log(sparse_threshold)) # assuming a SE kernel
     n = len(X)
     entries = tree.sparse_training_kernel_matrix(X, max_distance, False)
     spK = scipy.sparse.coo_matrix((entries[:,2], (entries[:,0], entries[:,1])), shape=(n,n), dtype=float)
@@ -58,18 +99,80 @@ def prior_grad(params, priors):
             grad[i] = prior.deriv_log_p(param)
     return grad
 
-def prior_sample_sparse(X, cov, noise_var, sparse_threshold=1e-20):
+def prior_sample_sparse(X, cov, noise_var, sparse_threshold=1e-20, n_samples=1):
     n = X.shape[0]
     predict_tree = VectorTree(X, 1, cov.dfn_str, cov.dfn_params, cov.wfn_str, cov.wfn_params)
 
-    spK = sparse_kernel_from_tree(predict_tree, X, sparse_threshold, True, noise_var)
+    max_distance = cov_max_distance(cov, sparse_threshold)
+    spK = sparse_kernel_from_tree(predict_tree, X, sparse_threshold, True, noise_var, max_distance=max_distance)
+
+    # CHOLMOD factors the matrix under a fill-reducing permutation,
+    # K[P][:,P] = L L^T, so we undo the permutation on the sample.
     factor = scikits.sparse.cholmod.cholesky(spK)
     L = factor.L()
     P = factor.P()
     Pinv = np.argsort(P)
-    z = np.random.randn(n)
-    y = np.array((L * z)[Pinv]).reshape((-1,))
-    return y
+    z = np.random.randn(n, n_samples)
+    y = np.asarray(L * z)[Pinv, :]
+    return y.reshape((-1,)) if n_samples == 1 else y
+
+def rff_frequencies(cov, dim, n_rff, rng=np.random):
+    # random Fourier features (Rahimi & Recht) for a stationary
+    # kernel under a scaled euclidean distance: frequencies are drawn
+    # from the kernel's spectral density, phases uniformly. The draws
+    # are for unit lengthscales and rescaled afterwards, so with a
+    # seeded rng the frequencies are a smooth function of dfn_params.
+    if cov.dfn_str != "euclidean":
+        raise ValueError("random features require a euclidean distance, not %s" % cov.dfn_str)
+
+    z = rng.randn(n_rff, dim)
+    if cov.wfn_str == "se":
+        # w(d) = var * exp(-d^2), i.e. a gaussian with std l/sqrt(2)
+        omega = z * np.sqrt(2.0)
+    elif cov.wfn_str == "matern32":
+        # student-t spectral density with three degrees of freedom
+        u = rng.chisquare(3, size=(n_rff, 1))
+        omega = z * np.sqrt(3.0 / u)
+    else:
+        raise ValueError("random features not implemented for weight function %s" % cov.wfn_str)
+
+    omega /= np.reshape(np.asarray(cov.dfn_params, dtype=float), (1, -1))
+    phase = rng.rand(n_rff) * 2 * np.pi
+    return omega, phase
+
+def rff_features(X, cov, omega, phase):
+    # n x n_rff feature matrix Phi, with Phi Phi^T approximating the
+    # kernel matrix of X.
+    n_rff = omega.shape[0]
+    return np.sqrt(2.0 * cov.wfn_params[0] / n_rff) * np.cos(np.dot(X, omega.T) + phase)
+
+def prior_sample_rff(X, cov, noise_var, n_rff=1000, n_samples=1, chunk_size=10000):
+    """
+    Approximate prior sample using n_rff random Fourier features. Rows
+    are generated chunk_size at a time, so memory is O(chunk_size *
+    n_rff) regardless of the number of points.
+    """
+    X = np.asarray(X, dtype=float)
+    n = X.shape[0]
+    omega, phase = rff_frequencies(cov, X.shape[1], n_rff)
+    w = np.random.randn(n_rff, n_samples)
+
+    y = np.empty((n, n_samples))
+    for start in range(0, n, chunk_size):
+        Phi = rff_features(X[start:start+chunk_size], cov, omega, phase)
+        y[start:start+chunk_size] = np.dot(Phi, w)
+    y += np.sqrt(noise_var) * np.random.randn(n, n_samples)
+    return y.reshape((-1,)) if n_samples == 1 else y
+
+def prior_sample_scalable(X, cov, noise_var, n_samples=1, sparse_threshold=1e-8, n_rff=1000, chunk_size=10000):
+    """
+    Prior sample at the rows of X without forming a dense covariance:
+    exact, from a sparse Cholesky factor, for compact kernels, and
+    approximated with random features for SE and matern32 kernels.
+    """
+    if cov.wfn_str.startswith("compact"):
+        return prior_sample_sparse(X, cov, noise_var, sparse_threshold=sparse_threshold, n_samples=n_samples)
+    return prior_sample_rff(X, cov, noise_var, n_rff=n_rff, n_samples=n_samples, chunk_size=chunk_size)
 
 def mcov(X, cov, noise_var, X2=None):
     n = X.shape[0]
@@ -173,11 +276,80 @@ def unpack_gpcov(d, prefix):
             Xu = d[prefix+'_Xu']
         except KeyError:
             Xu = None
-        return GPCov(wfn_params=wfn_params, dfn_params=dfn_params, wfn_str=wfn_str, dfn_str=dfn_str, Xu=Xu)
+        try:
+            rff_dim = int(d[prefix+'_rff_dim'])
+            rff_seed = int(d[prefix+'_rff_seed'])
+        except KeyError:
+            rff_dim, rff_seed = None, 0
+        return GPCov(wfn_params=wfn_params, dfn_params=dfn_params, wfn_str=wfn_str, dfn_str=dfn_str, Xu=Xu, rff_dim=rff_dim, rff_seed=rff_seed)
     except KeyError:
         return None
 
 
+def array_bytes(A):
+    # memory held by a dense or sparse matrix (or a PCGSolver standing
+    # in for Kinv); 0 for None or anything else.
+    if A is None:
+        return 0
+    if isinstance(A, PCGSolver):
+        return array_bytes(A.K) + A.precond.block_inv.nbytes
+    if scipy.sparse.issparse(A):
+        if A.format in ('csr', 'csc', 'bsr'):
+            return A.data.nbytes + A.indices.nbytes + A.indptr.nbytes
+        A = A.tocoo()
+        return A.data.nbytes + A.row.nbytes + A.col.nbytes
+    if isinstance(A, np.ndarray):
+        return A.nbytes
+    return 0
+
+class CholmodAnalysisCache(object):
+
+    def __init__(self, max_patterns=CHOL_CACHE_PATTERNS):
+        """
+        Symbolic CHOLMOD analyses (fill-reducing ordering and
+        elimination tree) of the max_patterns most recently factored
+        sparsity patterns. A fit whose kernel matrix has a known nonzero
+        pattern, as compact kernels usually do across nearby
+        hyperparameters or when refitting the same points, redoes only
+        the numeric factorization. Patterns are identified by a hash of
+        the CSC index arrays, so nothing of size nnz is kept per
+        pattern beyond the analysis itself.
+        """
+        self.max_patterns = max_patterns
+        self.analyses = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def pattern_key(self, K):
+        h = hashlib.sha1(np.ascontiguousarray(K.indptr))
+        h.update(np.ascontiguousarray(K.indices))
+        return (K.shape, K.nnz, h.hexdigest())
+
+    def cholesky(self, K):
+        # returns a new Factor of the sparse matrix K. The cached
+        # analyses are copied rather than refactored in place
+        # (cholesky_inplace), since every GP keeps its own factor.
+        K = K.tocsc()
+        key = self.pattern_key(K)
+        with self.lock:
+            analysis = self.analyses.pop(key, None)
+            if analysis is None:
+                self.misses += 1
+                analysis = scikits.sparse.cholmod.analyze(K)
+                if len(self.analyses) >= self.max_patterns:
+                    self.analyses.popitem(last=False)
+            else:
+                self.hits += 1
+            self.analyses[key] = analysis
+            return analysis.cholesky(K)
+
+    def clear(self):
+        with self.lock:
+            self.analyses.clear()
+
+# used by sparse fits that aren't given a cache of their own
+default_chol_cache = CholmodAnalysisCache()
+
 def sort_morton(X, *args):
 
     def cmp_zorder(a, b):
@@ -205,16 +377,29 @@ def sort_morton(X, *args):
     return tuple(returns)
 
 class GPCov(object):
+
+    # class-level defaults, so that covs pickled before random
+    # features existed still unpickle as exact kernels.
+    rff_dim = None
+    rff_seed = 0
+
     def __init__(self, wfn_params, dfn_params,
                  wfn_str="se", dfn_str="euclidean",
                  wfn_priors=None, dfn_priors=None,
-                 Xu=None):
+                 Xu=None, rff_dim=None, rff_seed=0):
         self.wfn_str =str(wfn_str)
         self.wfn_params = np.array(wfn_params, dtype=float)
         self.dfn_str = str(dfn_str)
         self.dfn_params = np.array(dfn_params, dtype=float)
         self.Xu = np.asarray(Xu) if Xu is not None else None
 
+        # if rff_dim is set, a GP using this as its main covariance
+        # approximates the kernel with rff_dim random Fourier features
+        # (drawn deterministically from rff_seed) instead of
+        # evaluating it exactly.
+        self.rff_dim = int(rff_dim) if rff_dim is not None else None
+        self.rff_seed = int(rff_seed)
+
         self.wfn_priors = wfn_priors
         self.dfn_priors = dfn_priors
         if self.wfn_priors is None:
@@ -225,17 +410,28 @@ class GPCov(object):
     def copy(self):
         return GPCov(wfn_params = self.wfn_params.copy(), dfn_params=self.dfn_params.copy(),
                      dfn_str = self.dfn_str, wfn_str=self.wfn_str,
-                     wfn_priors=self.wfn_priors, dfn_priors=self.dfn_priors, Xu= self.Xu.copy() if self.Xu is not None else None)
+                     wfn_priors=self.wfn_priors, dfn_priors=self.dfn_priors, Xu= self.Xu.copy() if self.Xu is not None else None,
+                     rff_dim=self.rff_dim, rff_seed=self.rff_seed)
 
     def tree_params(self):
         return (self.dfn_str, self.dfn_params, self.wfn_str, self.wfn_params)
 
     def packed(self, prefix):
-        return {prefix + "_wfn_str": self.wfn_str,
-                prefix + "_wfn_params": self.wfn_params,
-                prefix + "_dfn_str": self.dfn_str,
-                prefix + "_dfn_params": self.dfn_params,
-                prefix + "_Xu": self.Xu}
+        d = {prefix + "_wfn_str": self.wfn_str,
+             prefix + "_wfn_params": self.wfn_params,
+             prefix + "_dfn_str": self.dfn_str,
+             prefix + "_dfn_params": self.dfn_params,
+             prefix + "_Xu": self.Xu}
+        if self.rff_dim is not None:
+            d[prefix + "_rff_dim"] = self.rff_dim
+            d[prefix + "_rff_seed"] = self.rff_seed
+        return d
+
+    def rff_frequencies(self, dim):
+        # the same frequencies every time for a given seed, so that
+        # the likelihood is a deterministic function of the
+        # hyperparams and saved models recover their features.
+        return rff_frequencies(self, dim, self.rff_dim, rng=np.random.RandomState(self.rff_seed))
 
     def bounds(self, include_xu=True):
         b = [(1e-8,None),] * (len(self.wfn_params) + len(self.dfn_params))
@@ -261,11 +457,30 @@ class GPCov(object):
 
     def __repr__(self):
         s = self.wfn_str + str(self.wfn_params) + ", " + self.dfn_str + str(self.dfn_params)
+        if self.rff_dim is not None:
+            s += ", rff%d(seed %d)" % (self.rff_dim, self.rff_seed)
         return s
 
 
 class GP(object):
 
+    # profiling is off unless requested with profile=True (or by
+    # assigning a GPStats to gp.stats); models loaded from files or
+    # pickles share this disabled instance.
+    stats = GPStats(enabled=False)
+
+    # set when loaded with mean_only=True: only the predictive mean is
+    # available.
+    mean_only = False
+
+    # pickled models don't go through __init__, and are never ski or
+    # vecchia models
+    ski = None
+    vecchia = None
+
+    # set by store_single_precision()
+    single_precision = False
+
     def standardize_input_array(self, c, **kwargs):
         assert(len(c.shape) == 2)
         return c
@@ -290,7 +505,8 @@ class GP(object):
         return K.tocsc()
 
     def invert_kernel_matrix_cheap(self, K):
-        prec, L, Lprec, logdet = pdinv(K)
+        with self.stats.phase('chol_factor'):
+            prec, L, Lprec, logdet = pdinv(K)
         Alpha, _ = dpotrs(L, self.y, lower=1)
         factor = lambda z : dpotrs(L, z, lower=1)[0]
         self.logdet = logdet
@@ -299,16 +515,19 @@ class GP(object):
     def invert_kernel_matrix(self, K):
         alpha = None
         t0 = time.time()
-        L = scipy.linalg.cholesky(K, lower=True) # c = sqrt(inv(B) + H*K^-1*H.T)
+        with self.stats.phase('chol_factor'):
+            L = scipy.linalg.cholesky(K, lower=True) # c = sqrt(inv(B) + H*K^-1*H.T)
         factor = lambda z : scipy.linalg.cho_solve((L, True), z)
         t1 = time.time()
         self.timings['chol_factor'] = t1-t0
 
-        alpha = factor(self.y)
+        with self.stats.phase('solve_alpha'):
+            alpha = factor(self.y)
         t2 = time.time()
         self.timings['solve_alpha'] = t2-t1
 
-        Kinv = np.linalg.inv(K)
+        with self.stats.phase('solve_Kinv'):
+            Kinv = np.linalg.inv(K)
         t3 = time.time()
         self.timings['solve_Kinv'] = t3-t2
 
@@ -317,17 +536,23 @@ class GP(object):
         #    print "WARNING: poorly conditioned inverse (I=%f)" % I
         return alpha, factor, L, Kinv
 
-    def sparse_invert_kernel_matrix(self, K):
+    def sparse_invert_kernel_matrix(self, K, chol_cache=None):
         alpha = None
         t0 = time.time()
-        factor = scikits.sparse.cholmod.cholesky(K)
+        with self.stats.phase('chol_factor'):
+            if chol_cache is False:
+                factor = scikits.sparse.cholmod.cholesky(K)
+            else:
+                factor = (chol_cache or default_chol_cache).cholesky(K)
         t1 = time.time()
         self.timings['chol_factor'] = t1-t0
 
-        alpha = factor(self.y)
+        with self.stats.phase('solve_alpha'):
+            alpha = factor(self.y)
         t2 = time.time()
         self.timings['solve_alpha'] = t2-t1
-        Kinv = factor(scipy.sparse.eye(K.shape[0]).tocsc())
+        with self.stats.phase('solve_Kinv'):
+            Kinv = factor(scipy.sparse.eye(K.shape[0]).tocsc())
         t3 = time.time()
         self.timings['solve_Kinv'] = t3-t2
 
@@ -342,6 +567,23 @@ class GP(object):
 
         return alpha, factor, L, Kinv
 
+    def pcg_invert_kernel_matrix(self, K):
+        # no factorization: K^-1 is applied by iterative solves, and
+        # the solver object stands in for both the factor and Kinv.
+        t0 = time.time()
+        with self.stats.phase('pcg_precond'):
+            solver = PCGSolver(K, tol=PCG_TOL, block_size=PCG_BLOCK_SIZE)
+        t1 = time.time()
+        self.timings['pcg_precond'] = t1-t0
+
+        with self.stats.phase('solve_alpha'):
+            alpha = solver(self.y)
+        self.stats.count('pcg_iters', solver.iters[-1])
+        self.timings['solve_alpha'] = time.time()-t1
+        self.timings['pcg_iters'] = solver.iters[-1]
+        self.timings['pcg_resid'] = solver.resids[-1]
+        return alpha, solver, None, solver
+
 
     def sparsify(self, M):
         import scipy.sparse
@@ -378,13 +620,71 @@ class GP(object):
             i = F.shape[0]
             features[:i,:] = F
 
+        if self.n_rff_features > 0:
+            features[i:i+self.n_rff_features,:] = self.rff_projection(X)
+            i += self.n_rff_features
+
         if self.predict_tree_fic is not None:
-            features[i:,:] = self.kernel(self.cov_fic.Xu, X, predict_tree=self.predict_tree_fic)
+            features[i:,:] = self.fic_projection(X)[0]
 
         return features
 
+    def setup_rff(self):
+        # number of random features standing in for the main kernel
+        # (0 if the kernel is evaluated exactly), and their frequencies.
+        self.n_rff_features = 0
+        if self.cov_main is not None and self.cov_main.rff_dim is not None:
+            self.n_rff_features = self.cov_main.rff_dim
+            self.rff_omega, self.rff_phase = self.cov_main.rff_frequencies(self.X.shape[1])
+
+    def rff_projection(self, X):
+        # random features of the main kernel at the rows of X, as an
+        # n_rff x m matrix (the same orientation as H).
+        X = np.asarray(X, dtype=float)
+        return rff_features(X, self.cov_main, self.rff_omega, self.rff_phase).T
+
+    def rff_phase_deriv(self, X):
+        # derivative of each random feature wrt its argument
+        # omega.x + phase, as an n_rff x m matrix.
+        X = np.asarray(X, dtype=float)
+        scale = np.sqrt(2.0 * self.cov_main.wfn_params[0] / self.n_rff_features)
+        return -scale * np.sin(np.dot(self.rff_omega, X.T) + np.reshape(self.rff_phase, (-1, 1)))
+
+    def set_Luu(self, Luu):
+        self.Luu = Luu
+        # cached projections were computed with the old Luu
+        self.fic_hsh = None
+        self.fic_proj = None
+        if Luu.shape[0] <= FIC_EXPLICIT_INV_MAX:
+            self.Luu_inv = scipy.linalg.solve_triangular(Luu, np.eye(Luu.shape[0]), lower=True)
+        else:
+            self.Luu_inv = None
+
+    def solve_Luu(self, K_fic_un):
+        # returns Luu^-1 K_fic_un
+        if self.Luu_inv is not None:
+            return np.dot(self.Luu_inv, K_fic_un)
+        return scipy.linalg.solve_triangular(self.Luu, K_fic_un, lower=True)
+
+    def fic_projection(self, X):
+        # returns (K_uq, B) for a batch of points X, where K_uq is the
+        # kernel between the inducing points and X, and B = Luu^-1 K_uq.
+        # Both the FIC features and the diagonal correction are computed
+        # from these, so we cache the most recent batch (a size-1 cache).
+        try:
+            self.fic_hsh
+        except AttributeError:
+            self.fic_hsh = None
+
+        hsh = hashlib.sha1(np.ascontiguousarray(X).view(np.uint8)).hexdigest()
+        if hsh != self.fic_hsh:
+            K_uq = self.kernel(self.cov_fic.Xu, X, identical=False, predict_tree = self.predict_tree_fic)
+            self.fic_proj = (K_uq, self.solve_Luu(K_uq))
+            self.fic_hsh = hsh
+        return self.fic_proj
 
-    def combine_lowrank_models(self, H, b, B, K_fic_un, K_fic_uu):
+
+    def combine_lowrank_models(self, H, b, B, K_fic_un, K_fic_uu, Phi=None):
         # for training lowrank models: given feature representations
         # (H, K_fic_un) and prior covariances (B, K_fic_uu) for two
         # additive models, return the combined feature representation,
@@ -392,14 +692,22 @@ class GP(object):
         # have mean 0) and combined parameter precision matrix (we
         # assume the parameters of the two models are independent, so
         # this is block diagonal).
+        #
+        # random features Phi of the main kernel, if given, go between
+        # the two, with weights ~ N(0, I). They count as parametric
+        # features, so the FIC block still starts at n_param_features.
 
         N = 0
+        n_basis = 0
         self.n_features = 0
         self.n_param_features = 0
         if H is not None:
-            self.n_param_features = H.shape[0]
-            self.n_features += self.n_param_features
+            n_basis = H.shape[0]
             N = H.shape[1]
+        if Phi is not None:
+            N = Phi.shape[1]
+        self.n_param_features = n_basis + (Phi.shape[0] if Phi is not None else 0)
+        self.n_features += self.n_param_features
         if K_fic_un is not None:
             self.n_features += K_fic_un.shape[0]
             N = K_fic_un.shape[1]
@@ -409,9 +717,12 @@ class GP(object):
         cov_inv = np.zeros((self.n_features, self.n_features))
 
         if H is not None:
-            features[0:self.n_param_features, :] = H
-            mean[0:self.n_param_features] = b
-            cov_inv[0:self.n_param_features,0:self.n_param_features] = np.linalg.inv(B)
+            features[0:n_basis, :] = H
+            mean[0:n_basis] = b
+            cov_inv[0:n_basis,0:n_basis] = np.linalg.inv(B)
+        if Phi is not None:
+            features[n_basis:self.n_param_features, :] = Phi
+            cov_inv[n_basis:self.n_param_features, n_basis:self.n_param_features] = np.eye(Phi.shape[0])
         if K_fic_un is not None:
             features[self.n_param_features:, :] = K_fic_un
             cov_inv[self.n_param_features:,self.n_param_features:] = K_fic_uu
@@ -447,7 +758,10 @@ class GP(object):
         if b is not None:
             tmp += np.dot(Binv, b)
 
-        HKinv = H * Kinv_sp
+        if isinstance(Kinv_sp, PCGSolver):
+            HKinv = Kinv_sp.dot(H.T).T
+        else:
+            HKinv = H * Kinv_sp
         M_inv  = Binv + np.dot(HKinv, H.T)
         c = scipy.linalg.cholesky(M_inv, lower=True)
         beta_bar = scipy.linalg.cho_solve((c, True), tmp)
@@ -458,10 +772,14 @@ class GP(object):
     def init_csfic_kernel(self, K_cs):
         K_fic_uu = self.kernel(self.cov_fic.Xu, self.cov_fic.Xu, identical=False, predict_tree = self.predict_tree_fic)
         Luu  = scipy.linalg.cholesky(K_fic_uu, lower=True)
-        self.Luu = Luu
-        K_fic_un = self.kernel(self.cov_fic.Xu, self.X, identical=False, predict_tree = self.predict_tree_fic)
+        self.set_Luu(Luu)
 
-        dc = self.covariance_diag_correction(self.X)
+        # computed directly rather than through fic_projection(), so
+        # the query cache doesn't hold a second copy of K_fic_un (and
+        # its projection) after training.
+        K_fic_un = self.kernel(self.cov_fic.Xu, self.X, identical=False, predict_tree = self.predict_tree_fic)
+        B = self.solve_Luu(K_fic_un)
+        dc = self.cov_fic.wfn_params[0] - np.sum(B*B, axis=0)
         diag_correction = scipy.sparse.dia_matrix((dc, 0), shape=K_cs.shape)
 
         K_cs = K_cs + diag_correction
@@ -483,29 +801,41 @@ class GP(object):
 
     ###################################################################################
 
-    def setup_kernel_matrix(self, sparse_invert=False, build_tree=False):
+    def setup_kernel_matrix(self, sparse_invert=False, build_tree=False, chol_cache=None):
+
+        # iterative solves work from the sparse kernel matrix
+        sparse_invert = sparse_invert or self.solver == "pcg"
 
         try:
             self.predict_tree
         except:
             self.predict_tree, self.predict_tree_fic = self.build_initial_single_trees(build_single_trees=sparse_invert)
 
-        if sparse_invert:
-            self._set_max_distance()
-            self.K = self.sparse_training_kernel_matrix(self.X)
-        else:
-            self.K = self.training_kernel_matrix(self.X)
+        # with random features, the matrix factored here is just the
+        # noise (plus any CSFIC part), which is sparse: a dense
+        # factorization would cost O(n^3) for a diagonal matrix.
+        sparse_invert = sparse_invert or self.n_rff_features > 0
 
-        if self.cov_fic is not None:
-            self.K, self.K_fic_uu, self.K_fic_un = self.init_csfic_kernel(self.K)
-        else:
-            self.K_fic_uu, self.K_fic_un = None, None
+        with self.stats.phase('build_K'):
+            if sparse_invert:
+                self._set_max_distance()
+                self.K = self.sparse_training_kernel_matrix(self.X)
+            else:
+                self.K = self.training_kernel_matrix(self.X)
+
+            if self.cov_fic is not None:
+                self.K, self.K_fic_uu, self.K_fic_un = self.init_csfic_kernel(self.K)
+            else:
+                self.K_fic_uu, self.K_fic_un = None, None
 
         if sparse_invert:
             if type(self.K) == np.ndarray or type(self.K) == np.matrix:
                 self.K = self.sparsify(self.K)
-            alpha, self.factor, L, Kinv = self.sparse_invert_kernel_matrix(self.K)
-            self.Kinv = self.sparsify(Kinv)
+            if self.solver == "pcg":
+                alpha, self.factor, L, self.Kinv = self.pcg_invert_kernel_matrix(self.K)
+            else:
+                alpha, self.factor, L, Kinv = self.sparse_invert_kernel_matrix(self.K, chol_cache=chol_cache)
+                self.Kinv = self.sparsify(Kinv)
             #print "Kinv is ", len(self.Kinv.nonzero()[0]) / float(self.Kinv.shape[0]**2), "full (vs diag at", 1.0/self.Kinv.shape[0], ")"
         else:
             alpha, self.factor, L, Kinv = self.invert_kernel_matrix_cheap(self.K)
@@ -541,12 +871,28 @@ class GP(object):
                  center_mean=False,
                  ymean=0.0,
                  leaf_bin_width = 0,
-                 build_dense_Kinv_hack=False): # WARNING: bin sizes > 0 currently lead to memory leaks
+                 build_dense_Kinv_hack=False, # WARNING: bin sizes > 0 currently lead to memory leaks
+                 ski_grid=None,
+                 ski_bounds=None,
+                 vecchia_k=None,
+                 solver="cholmod",
+                 profile=False,
+                 mean_only=False,
+                 single_precision=False,
+                 chol_cache=None):
 
 
         self.double_tree = None
+        self.ski = None
+        self.vecchia = None
+        if profile:
+            self.stats = GPStats()
+        # set now so that trees built below store Kinv in single precision
+        self.single_precision = single_precision
         if fname is not None:
-            self.load_trained_model(fname, build_tree=build_tree, leaf_bin_width=leaf_bin_width, build_dense_Kinv_hack=build_dense_Kinv_hack, compile_tree=compile_tree, sparse_invert=sparse_invert)
+            self.load_trained_model(fname, build_tree=build_tree, leaf_bin_width=leaf_bin_width, build_dense_Kinv_hack=build_dense_Kinv_hack, compile_tree=compile_tree, sparse_invert=sparse_invert, mean_only=mean_only)
+            if single_precision:
+                self.store_single_precision()
             return
 
         if sort_events:
@@ -559,6 +905,15 @@ class GP(object):
 
         self.cov_main, self.cov_fic, self.noise_var, self.sparse_threshold, self.basis = cov_main, cov_fic, noise_var, sparse_threshold, basis
 
+        # "cholmod" factors the training kernel matrix; "pcg" solves
+        # against it iteratively, for problems where the factor
+        # wouldn't fit in memory.
+        if solver not in ("cholmod", "pcg"):
+            raise ValueError("unknown solver %s" % solver)
+        if solver == "pcg" and (build_tree or compute_grad):
+            raise ValueError("the pcg solver doesn't support build_tree or compute_grad")
+        self.solver = solver
+
         self.timings = dict()
 
         if X is not None:
@@ -587,10 +942,39 @@ class GP(object):
             self.ll = np.float('-inf')
             return
 
+        self.setup_rff()
+
+        if vecchia_k is not None:
+            # nearest-neighbor conditionals, no factorization of K
+            if cov_fic is not None or basis is not None or self.n_rff_features > 0:
+                raise ValueError("vecchia_k supports only a main covariance, without low-rank components")
+            if ski_grid is not None:
+                raise ValueError("vecchia_k and ski_grid are alternative approximations; give only one")
+            self.setup_vecchia(vecchia_k, compute_ll=compute_ll, compute_grad=compute_grad)
+            return
+
+        if ski_grid is not None:
+            # grid-interpolated kernel, solved iteratively
+            if cov_fic is not None or basis is not None or self.n_rff_features > 0:
+                raise ValueError("ski_grid supports only a main covariance, without low-rank components")
+            if compute_grad:
+                raise ValueError("likelihood gradients are not available with ski_grid")
+            self.setup_ski(ski_grid, ski_bounds)
+            if compute_ll:
+                K = scipy.sparse.linalg.LinearOperator((self.n, self.n), matvec=self.ski_matvec, dtype=float)
+                self._compute_marginal_likelihood(L=None, z=self.y, Binv=None, H=None, K=K, Kinv=None)
+            return
+
         # compute sparse training kernel matrix (including
-        # per-observation noise if appropriate), and invert it.
+        # per-observation noise if appropriate), and invert it. With
+        # random features, the main kernel is carried by the low-rank
+        # model below, so this is just the (diagonal) noise.
+        # sparse fits share symbolic analyses of the kernel matrix
+        # through chol_cache (a CholmodAnalysisCache), by default the
+        # module's default_chol_cache; chol_cache=False analyzes afresh.
         alpha = self.setup_kernel_matrix(sparse_invert=sparse_invert,
-                                         build_tree=build_tree)
+                                         build_tree=build_tree,
+                                         chol_cache=chol_cache)
 
         # setup the parameteric features, if applicable, and return the feature representation of X
         H = self.setup_parametric_featurizer(self.X, featurizer_recovery, 
@@ -601,9 +985,11 @@ class GP(object):
             param_cov = np.eye(n_features) * 100.0
 
 
+        Phi = self.rff_projection(self.X) if self.n_rff_features > 0 else None
+
         # if we have any additive low-rank covariances, compute the appropriate terms
-        if H is not None or cov_fic is not None:
-            HH, b, Binv = self.combine_lowrank_models(H, param_mean, param_cov, self.K_fic_un, self.K_fic_uu)
+        if H is not None or cov_fic is not None or Phi is not None:
+            HH, b, Binv = self.combine_lowrank_models(H, param_mean, param_cov, self.K_fic_un, self.K_fic_uu, Phi=Phi)
             self.c, self.invc,self.beta_bar, self.HKinv = self.build_low_rank_model(alpha,
                                                                                     self.Kinv,
                                                                                     HH,
@@ -634,7 +1020,121 @@ class GP(object):
         if compute_grad:
             self.ll_grad = self._log_likelihood_gradient(z=z, Kinv=self.Kinv, include_xu=compute_xu_grad)
 
+        if single_precision:
+            self.store_single_precision()
+
+    def store_single_precision(self):
+        """
+        Keep the large matrices (K, Kinv, HKinv and the FIC
+        cross-covariance) as float32 from now on, halving their memory
+        and bandwidth. Products with them are upcast, so results still
+        accumulate in float64, and the added error (~1e-7 relative) is
+        far below the tolerances the trees use. A dense-hack tree built
+        afterwards also keeps its copy of Kinv in float32. Tree
+        coordinates and node sums stay in float64.
+        """
+        self.single_precision = True
+        for name in ('K', 'Kinv', 'HKinv', 'K_fic_un'):
+            A = getattr(self, name, None)
+            if isinstance(A, np.ndarray) or scipy.sparse.issparse(A):
+                setattr(self, name, A.astype(np.float32))
+
+    @profiled
+    def setup_ski(self, ski_grid, ski_bounds=None):
+        """
+        Structured kernel interpolation: K ~= W K_UU W^T + noise, with
+        K_UU the kernel on a regular grid and W sparse interpolation
+        weights (see ski.py). We solve for alpha with conjugate
+        gradients using fast matvecs, then cache
+
+          the mean weights a = K_UU W^T alpha, so the predictive mean
+          at x is w_x^T a, and
+
+          C = K_UU W^T Q L^-T, where K ~= Q T Q^T from a few Lanczos
+          steps and T = L L^T, so the predictive variance at x is
+          k(x,x) - |C^T w_x|^2 (the LOVE approximation of Pleiss et al.)
+
+        making predictions O(1) per point in the training size.
+
+        ski_grid gives the number of grid points per dimension, and
+        ski_bounds the (lo, hi) corners of the region to cover
+        (default: the bounding box of the training data).
+        """
+        self.predict_tree, self.predict_tree_fic = self.build_initial_single_trees()
+        self.n_features = 0
+        self.HKinv = None
+        self.ll = -np.inf
+
+        t0 = time.time()
+        self.ski = SKIGrid(self.X, self.cov_main, ski_grid, bounds=ski_bounds)
+        self.ski_W = self.ski.interp_weights(self.X)
+        self.ski_diag = self.noise_var * np.ones((self.n,))
+        if self.y_obs_variances is not None:
+            self.ski_diag += self.y_obs_variances
+        t1 = time.time()
+        self.timings['build_grid'] = t1-t0
+
+        alpha, iters, resid = conjugate_gradient(self.ski_matvec, self.y, tol=SKI_CG_TOL)
+        self.alpha_r = alpha
+        self.ski_mean = self.ski.kuu_dot(self.ski_W.T.dot(alpha))
+        t2 = time.time()
+        self.timings['solve_alpha'] = t2-t1
+        self.timings['cg_iters'] = iters
+        self.timings['cg_resid'] = resid
+
+        b = self.ski_W.dot(self.ski.kuu_dot(np.ones((self.ski.M,))))
+        Q, T = lanczos(self.ski_matvec, b, SKI_LOVE_RANK)
+        L = scipy.linalg.cholesky(T, lower=True)
+        KuuWQ = np.array([self.ski.kuu_dot(self.ski_W.T.dot(Q[:,j])) for j in range(Q.shape[1])]).T
+        self.ski_var = scipy.linalg.solve_triangular(L, KuuWQ.T, lower=True).T
+        self.timings['love_cache'] = time.time()-t2
+
+    @profiled
+    def setup_vecchia(self, k, compute_ll=False, compute_grad=False):
+        """
+        Vecchia (nearest-neighbor GP) approximation: in the training
+        order (Morton order, unless sort_events=False), each point is
+        conditioned only on its k nearest predecessors, found with a
+        cover tree on X. This gives a sparse inverse Cholesky factor of
+        the training covariance (see vecchia.py), so the likelihood and
+        its gradient cost O(n k^3) instead of a full factorization.
+        Predictions condition each test point on its k nearest training
+        points.
+        """
+        if k < 1:
+            raise ValueError("vecchia_k must be at least 1, got %d" % k)
+        if compute_grad and len(self.cov_main.wfn_params) != 1:
+            raise ValueError("vecchia likelihood gradients need a single-parameter weight function")
+        self.predict_tree, self.predict_tree_fic = self.build_initial_single_trees(build_single_trees=True)
+        self.n_features = 0
+        self.HKinv = None
+        self.ll = -np.inf
+        self.vecchia_k = k
+
+        noise_diag = self.noise_var * np.ones((self.n,))
+        if self.y_obs_variances is not None:
+            noise_diag += self.y_obs_variances
+
+        t0 = time.time()
+        nbrs = previous_neighbors(self.predict_tree, self.X, k)
+        t1 = time.time()
+        self.timings['vecchia_neighbors'] = t1-t0
+        self.vecchia = VecchiaApprox(self.X, self.y, self.predict_tree, nbrs, noise_diag, self.main_prior_var())
+        self.timings['vecchia_factor'] = time.time()-t1
+
+        if compute_ll:
+            self.ll = self.vecchia.log_likelihood()
+        if compute_grad:
+            self.ll_grad = self.vecchia.log_likelihood_gradient(len(self.cov_main.dfn_params))
+
+    def ski_matvec(self, v):
+        # (W K_UU W^T + noise) v
+        return self.ski_W.dot(self.ski.kuu_dot(self.ski_W.T.dot(v))) + self.ski_diag * v
+
     def build_initial_single_trees(self, build_single_trees = False):
+        # remember whether the trees index the training points, so that
+        # we know when sparse query kernels are available.
+        self.single_trees_on_X = build_single_trees
         if build_single_trees:
             tree_X = pyublas.why_not(self.X)
         else:
@@ -652,17 +1152,21 @@ class GP(object):
         return predict_tree, predict_tree_fic
 
     def _set_max_distance(self):
-        if self.cov_main.wfn_str=="se" and self.sparse_threshold>0:
-            self.max_distance = np.sqrt(-np.log(self.sparse_threshold))
-        elif self.cov_main.wfn_str.startswith("compact"):
-            self.max_distance = 1.0
-        else:
-            self.max_distance = 1e300
+        self.max_distance = cov_max_distance(self.cov_main, self.sparse_threshold)
 
 
+    @profiled
     def build_point_tree(self, HKinv, Kinv, alpha_r, leaf_bin_width, build_dense_Kinv_hack=False, compile_tree=None):
         if self.n == 0: return
 
+        if self.solver == "pcg":
+            raise ValueError("trees need an explicit Kinv, which the pcg solver doesn't compute")
+
+        if self.n_rff_features > 0:
+            # the main kernel is entirely in the low-rank features, so
+            # there are no kernel sums for the trees to speed up.
+            return
+
         self._set_max_distance()
 
         fullness = len(self.Kinv.nonzero()[0]) / float(self.Kinv.shape[0]**2)
@@ -680,9 +1184,10 @@ class GP(object):
 
 
         nzr, nzc = Kinv.nonzero()
-        vals = np.reshape(np.asarray(Kinv[nzr, nzc]), (-1,))
+        vals = np.reshape(np.asarray(Kinv[nzr, nzc], dtype=float), (-1,))
 
         if build_dense_Kinv_hack:
+            self.predict_tree.set_single_precision(self.single_precision)
             self.predict_tree.set_Kinv_for_dense_hack(nzr, nzc, vals)
 
         t0 = time.time()
@@ -692,6 +1197,8 @@ class GP(object):
             self.double_tree.collapse_leaf_bins(leaf_bin_width)
         t1 = time.time()
         print "built product tree on %d points in %.3fs" % (self.n, t1-t0)
+        self.timings['build_tree'] = t1-t0
+        self.stats.count('double_tree.build_s', self.double_tree.build_s)
         if compile_tree is not None:
             #source_fname = compile_tree + ".cc"
             #obj_fname = compile_tree + ".o"
@@ -715,14 +1222,22 @@ class GP(object):
             self.compiled_tree = imp.load_dynamic("compiled_tree", linked_fname)
             self.compiled_tree.init_distance_caches()
 
+    @profiled
     def predict(self, cond, parametric_only=False, eps=1e-8):
-        if not self.double_tree: return self.predict_naive(cond, parametric_only)
+        if self.ski is not None: return self.predict_ski(cond, parametric_only)
+        if self.vecchia is not None: return self.predict_vecchia(cond, parametric_only)
+        # mean-only models keep a tree weighted by alpha_r, but no product tree
+        use_tree = self.double_tree or (self.mean_only and self.n_rff_features == 0)
+        if not use_tree: return self.predict_naive(cond, parametric_only)
         X1 = self.standardize_input_array(cond).astype(np.float)
 
         if parametric_only:
             gp_pred = np.zeros((X1.shape[0],))
         else:
             gp_pred = np.array([self.predict_tree.weighted_sum(0, np.reshape(x, (1,-1)), eps) for x in X1])
+            if self.stats.enabled:
+                # the tree's counters only describe its last query
+                self.stats.count_attrs('predict_tree', self.predict_tree, ('nodes_touched', 'terms', 'dfn_evals', 'wfn_evals'))
 
         if self.n_features > 0:
             H = self.get_data_features(X1)
@@ -735,10 +1250,11 @@ class GP(object):
         gp_pred += self.ymean
         return gp_pred
 
+    @profiled
     def predict_naive(self, cond, parametric_only=False, eps=1e-8):
         X1 = self.standardize_input_array(cond).astype(np.float)
 
-        if parametric_only:
+        if parametric_only or self.n_rff_features > 0:
             gp_pred = np.zeros((X1.shape[0],))
         else:
             Kstar = self.kernel(self.X, X1)
@@ -757,6 +1273,40 @@ class GP(object):
 
         return gp_pred
 
+    @profiled
+    def predict_ski(self, cond, parametric_only=False):
+        X1 = self.standardize_input_array(cond).astype(np.float)
+
+        if parametric_only:
+            gp_pred = np.zeros((X1.shape[0],))
+        else:
+            gp_pred = self.ski.interp_weights(X1).dot(self.ski_mean)
+
+        if len(gp_pred) == 1:
+            gp_pred = gp_pred[0]
+
+        gp_pred += self.ymean
+        return gp_pred
+
+    @profiled
+    def predict_vecchia(self, cond, parametric_only=False):
+        X1 = self.standardize_input_array(cond).astype(np.float)
+
+        if parametric_only:
+            gp_pred = np.zeros((X1.shape[0],))
+        else:
+            gp_pred, _ = self.vecchia.predict(X1, self.vecchia_neighbors(X1), want_var=False)
+
+        if len(gp_pred) == 1:
+            gp_pred = gp_pred[0]
+
+        gp_pred += self.ymean
+        return gp_pred
+
+    def vecchia_neighbors(self, X1):
+        k = min(self.vecchia_k, self.n)
+        return np.reshape(self.predict_tree.knn(X1, k), (X1.shape[0], k))
+
     def dKdi(self, X1, X2, i, identical=False):
         if (i == 0):
             dKdi = np.eye(X1.shape[0]) if identical else np.zeros((X1.shape[0], X2.shape[0]))
@@ -872,6 +1422,127 @@ class GP(object):
 
         return dm, dc
 
+    def query_kernel_and_grad(self, X1):
+        # query kernel Kstar (n x m) between the training points and X1,
+        # along with dKstar[k], its derivative wrt the k'th coordinate of
+        # each query point (each query point only affects its own
+        # column, so one matrix per dimension covers the whole batch).
+        m, D = X1.shape
+        if self.single_trees_on_X and scipy.sparse.issparse(self.Kinv):
+            entries = self.predict_tree.sparse_training_kernel_deriv_wrt_x(X1, self.max_distance)
+            ij = (entries[:,1], entries[:,0])
+            Kstar = scipy.sparse.coo_matrix((entries[:,2], ij), shape=(self.n, m), dtype=float).tocsc()
+            dKstar = [scipy.sparse.coo_matrix((entries[:,3+k], ij), shape=(self.n, m), dtype=float).tocsc() for k in range(D)]
+        else:
+            Kstar = self.kernel(self.X, X1)
+            dKstar = [self.predict_tree.kernel_deriv_wrt_pts1(X1, self.X, k).T for k in range(D)]
+        return Kstar, dKstar
+
+    def data_features_and_grad(self, X1, eps=1e-6):
+        # low-rank features H of X1, and dH[k], their derivative wrt the
+        # k'th coordinate of each point. FIC and random features are
+        # differentiated exactly; parametric features use central
+        # differences, since featurizers don't provide gradients.
+        m, D = X1.shape
+        H = self.get_data_features(X1)
+        dH = [np.zeros(H.shape) for k in range(D)]
+
+        i = 0
+        if self.featurizer is not None:
+            i = self.n_param_features - self.n_rff_features
+            for k in range(D):
+                Xp = np.array(X1, copy=True)
+                Xp[:, k] += eps
+                Xm = np.array(X1, copy=True)
+                Xm[:, k] -= eps
+                dH[k][:i,:] = (self.featurizer(Xp) - self.featurizer(Xm)) / (2*eps)
+
+        if self.n_rff_features > 0:
+            S = self.rff_phase_deriv(X1)
+            for k in range(D):
+                dH[k][i:self.n_param_features,:] = S * np.reshape(self.rff_omega[:,k], (-1, 1))
+            i = self.n_param_features
+
+        if self.predict_tree_fic is not None:
+            for k in range(D):
+                dH[k][i:,:] = self.predict_tree_fic.kernel_deriv_wrt_pts1(X1, self.cov_fic.Xu, k).T
+
+        return H, dH
+
+    def predict_and_grad(self, cond, include_obs=False, pad=1e-8):
+        """
+        Predictive mean and variance at each row of X1 (treating the
+        points independently), along with their gradients wrt the query
+        inputs, computed for the whole batch at once.
+
+        Returns (mean, dmean, var, dvar), where dmean and dvar are m x D
+        matrices: dmean[a, k] is the derivative of mean[a] wrt X1[a, k].
+        """
+        X1 = self.standardize_input_array(cond).astype(np.float)
+        m, D = X1.shape
+
+        def colsum_prod(A, B):
+            if scipy.sparse.issparse(A):
+                return np.asarray(A.multiply(B).sum(axis=0)).flatten()
+            return np.sum(np.asarray(A) * np.asarray(B), axis=0)
+
+        mean = self.ymean * np.ones((m,))
+        dmean = np.zeros((m, D))
+
+        # the prior variance doesn't depend on the query point.
+        var = (self.main_prior_var() + pad) * np.ones((m,))
+        if include_obs:
+            var += self.noise_var
+        dvar = np.zeros((m, D))
+
+        Kstar = None
+        if self.n > 0 and self.n_rff_features == 0:
+            Kstar, dKstar = self.query_kernel_and_grad(X1)
+            KinvK = self.Kinv.dot(Kstar)
+            mean += np.asarray(Kstar.T.dot(self.alpha_r)).flatten()
+            var -= colsum_prod(Kstar, KinvK)
+            for k in range(D):
+                dmean[:, k] += np.asarray(dKstar[k].T.dot(self.alpha_r)).flatten()
+                dvar[:, k] -= 2 * colsum_prod(dKstar[k], KinvK)
+
+        if self.n_features > 0:
+            H, dH = self.data_features_and_grad(X1)
+            mean += np.dot(H.T, self.beta_bar)
+
+            R = H
+            if Kstar is not None:
+                R = H - np.asarray(Kstar.T.dot(self.HKinv.T)).T
+            tmp = np.dot(self.invc, R)
+            var += np.sum(tmp**2, axis=0)
+
+            for k in range(D):
+                dmean[:, k] += np.dot(dH[k].T, self.beta_bar)
+                dR = dH[k]
+                if Kstar is not None:
+                    dR = dH[k] - np.asarray(dKstar[k].T.dot(self.HKinv.T)).T
+                dvar[:, k] += 2 * np.sum(tmp * np.dot(self.invc, dR), axis=0)
+
+        if self.predict_tree_fic is not None:
+            # diagonal correction k_fic(x,x) - |Luu^-1 K_ux|^2
+            var += self.covariance_diag_correction(X1)
+            B = self.fic_projection(X1)[1]
+            for k in range(D):
+                dB = self.solve_Luu(dH[k][self.n_param_features:,:])
+                dvar[:, k] -= 2 * np.sum(B * dB, axis=0)
+
+        return mean, dmean, var, dvar
+
+    def log_p_and_grad(self, y, cond, include_obs=True):
+        """
+        Independent log densities of y (a scalar, or one value per
+        point) at each row of X1, and their m x D gradients wrt X1.
+        """
+        mean, dmean, var, dvar = self.predict_and_grad(cond, include_obs=include_obs)
+        r = y - mean
+        lp = -.5 * (r**2 / var + np.log(2*np.pi*var))
+        dlp = np.reshape(r / var, (-1, 1)) * dmean + np.reshape(.5 * r**2 / var**2 - .5 / var, (-1, 1)) * dvar
+        return lp, dlp
+
     def grad_ll_wrt_X(self):
         # ONLY WORKS for zero-mean dense GPs with no inducing points or parametric components
         n, d = self.X.shape
@@ -889,21 +1560,35 @@ class GP(object):
         return llgrad
 
 
+    def main_prior_var(self):
+        # all of our weight functions have w(0) = wfn_params[0]. Random
+        # features put the main kernel's variance in the low-rank part.
+        if self.n_rff_features > 0:
+            return 0.0
+        return self.cov_main.wfn_params[0]
+
     def kernel(self, X1, X2, identical=False, predict_tree=None):
-        predict_tree = self.predict_tree if predict_tree is None else predict_tree
-        K = predict_tree.kernel_matrix(X1, X2, False)
+        if predict_tree is None and self.n_rff_features > 0:
+            # the main kernel is represented by its random features
+            K = np.zeros((X1.shape[0], X2.shape[0]))
+        else:
+            predict_tree = self.predict_tree if predict_tree is None else predict_tree
+            K = predict_tree.kernel_matrix(X1, X2, False)
         if identical:
             K += self.noise_var * np.eye(K.shape[0])
         return K
 
     def sparse_kernel(self, X, identical=False, predict_tree=None, max_distance=None):
-        predict_tree = self.predict_tree if predict_tree is None else predict_tree
+        if predict_tree is None and self.n_rff_features > 0:
+            spK = scipy.sparse.coo_matrix((self.n, len(X)), dtype=float)
+        else:
+            predict_tree = self.predict_tree if predict_tree is None else predict_tree
 
-        if max_distance is None:
-            max_distance = self.max_distance
+            if max_distance is None:
+                max_distance = self.max_distance
 
-        entries = predict_tree.sparse_training_kernel_matrix(X, max_distance, False)
-        spK = scipy.sparse.coo_matrix((entries[:,2], (entries[:,1], entries[:,0])), shape=(self.n, len(X)), dtype=float)
+            entries = predict_tree.sparse_training_kernel_matrix(X, max_distance, False)
+            spK = scipy.sparse.coo_matrix((entries[:,2], (entries[:,1], entries[:,0])), shape=(self.n, len(X)), dtype=float)
 
         if identical:
             spK = spK + self.noise_var * scipy.sparse.eye(spK.shape[0])
@@ -918,7 +1603,7 @@ class GP(object):
         except AttributeError:
             self.querysp_hsh = None
 
-        hsh = hashlib.sha1(X1.view(np.uint8)).hexdigest()
+        hsh = hashlib.sha1(np.ascontiguousarray(X1).view(np.uint8)).hexdigest()
         if hsh != self.querysp_hsh:
             self.querysp_K = self.sparse_kernel(X1)
             self.querysp_hsh = hsh
@@ -940,7 +1625,7 @@ class GP(object):
         except AttributeError:
             self.query_hsh = None
 
-        hsh = hashlib.sha1(X1.view(np.uint8)).hexdigest()
+        hsh = hashlib.sha1(np.ascontiguousarray(X1).view(np.uint8)).hexdigest()
         if hsh != self.query_hsh:
             self.query_K = self.kernel(self.X, X1)
             self.query_hsh = hsh
@@ -956,11 +1641,11 @@ class GP(object):
 
 
     def covariance_diag_correction(self, X):
-        K_fic_un = self.kernel(self.cov_fic.Xu, X, identical=False, predict_tree = self.predict_tree_fic)
-        B = scipy.linalg.solve(self.Luu, K_fic_un)
+        B = self.fic_projection(X)[1]
         Qvff = np.sum(B*B, axis=0)
         return self.cov_fic.wfn_params[0] - Qvff
 
+    @profiled
     def covariance_spkernel(self, cond, include_obs=False, parametric_only=False, pad=1e-8):
         X1 = self.standardize_input_array(cond)
         m = X1.shape[0]
@@ -977,6 +1662,7 @@ class GP(object):
             gp_cov = np.zeros((m,m))
         t2 = time.time()
         self.qf_time = t2-t1
+        self.stats.count('qf_time', self.qf_time)
 
         if self.n_features > 0:
             t1 = time.time()
@@ -997,6 +1683,7 @@ class GP(object):
 
         return gp_cov
 
+    @profiled
     def covariance_spkernel_solve(self, cond, include_obs=False, parametric_only=False, pad=1e-8):
         X1 = self.standardize_input_array(cond)
         m = X1.shape[0]
@@ -1037,6 +1724,7 @@ class GP(object):
         return gp_cov
 
 
+    @profiled
     def covariance_treedense(self, cond, include_obs=False, parametric_only=False, pad=1e-8, eps_abs=1e-8, qf_only=False):
 
         X1 = self.standardize_input_array(cond)
@@ -1049,20 +1737,19 @@ class GP(object):
 
             t1 = time.time()
             if self.n > 0:
-                qf = np.zeros(gp_cov.shape)
-                for i in range(m):
-                    for j in range(m):
-                        qf = self.predict_tree.quadratic_form_from_dense_hack(X1[i:i+1], X1[j:j+1], self.max_distance)
+                qf = self.predict_tree.quadratic_form_from_dense_hack_batch(np.asarray(X1, dtype=np.float), self.max_distance)
                 if qf_only:
                     return qf
                 gp_cov -= qf
             t2 = time.time()
             self.qf_time = t2-t1
+            self.stats.count('qf_time', self.qf_time)
 
 
             self.qf_dfn_evals = self.predict_tree.dense_hack_dfn_evals
             self.qf_wfn_evals = self.predict_tree.dense_hack_wfn_evals
             self.qf_terms = self.predict_tree.dense_hack_terms
+            self.stats.count_attrs('treedense', self.predict_tree, ('dense_hack_terms', 'dense_hack_dfn_evals', 'dense_hack_wfn_evals', 'dense_hack_tree_s', 'dense_hack_math_s'))
 
 
         else:
@@ -1096,6 +1783,7 @@ class GP(object):
 
 
 
+    @profiled
     def covariance(self, cond, include_obs=False, parametric_only=False, pad=1e-8, qf_only=False):
         """
         Compute the posterior covariance matrix at a set of points given by the rows of X1.
@@ -1107,6 +1795,13 @@ class GP(object):
         loss of positive definiteness from numerical issues. Setting pad=0 disables this.
 
         """
+        if self.ski is not None:
+            return self.covariance_ski(cond, include_obs=include_obs, parametric_only=parametric_only, pad=pad)
+        if self.vecchia is not None:
+            raise ValueError("vecchia models give only marginal predictive variances; use variance()")
+        if self.mean_only:
+            raise ValueError("this model was loaded with mean_only=True, so has no predictive covariance")
+
         X1 = self.standardize_input_array(cond)
         m = X1.shape[0]
 
@@ -1128,6 +1823,7 @@ class GP(object):
             gp_cov = np.zeros((m,m))
         t2 = time.time()
         self.qf_time = t2-t1
+        self.stats.count('qf_time', self.qf_time)
 
 
         if self.n_features > 0:
@@ -1151,6 +1847,7 @@ class GP(object):
 
         return gp_cov
 
+    @profiled
     def covariance_double_tree(self, cond, include_obs=False, parametric_only=False, pad=1e-8, eps=-1, eps_abs=1e-4, cutoff_rule=1, qf_only=False):
 
         X1 = self.standardize_input_array(cond)
@@ -1166,11 +1863,14 @@ class GP(object):
                 for i in range(m):
                     for j in range(m):
                         qf[i,j] = self.double_tree.quadratic_form(X1[i:i+1], X1[j:j+1], eps, eps_abs, cutoff_rule)
+                        if self.stats.enabled:
+                            self.stats.count_attrs('double_tree', self.double_tree, ('nodes_touched', 'terms', 'zeroterms', 'dfn_evals', 'dfn_misses', 'wfn_evals', 'wfn_misses'))
                 if qf_only:
                     return qf
                 gp_cov -= qf
             t2 = time.time()
             self.qf_time = t2-t1
+            self.stats.count('qf_time', self.qf_time)
 
             self.qf_terms = self.double_tree.terms
             self.qf_zeroterms = self.double_tree.zeroterms
@@ -1212,6 +1912,7 @@ class GP(object):
         return gp_cov
 
 
+    @profiled
     def covariance_compiled(self, cond, include_obs=False, parametric_only=False, pad=1e-8, eps_abs=1e-4,  qf_only=False):
 
         X1 = self.standardize_input_array(cond)
@@ -1231,6 +1932,7 @@ class GP(object):
                 gp_cov -= qf
             t2 = time.time()
             self.qf_time = t2-t1
+            self.stats.count('qf_time', self.qf_time)
 
             #self.qf_terms = self.compiled_tree.get_terms()
             #self.qf_zeroterms = self.compiled_tree.get_zeroterms()
@@ -1267,10 +1969,225 @@ class GP(object):
 
         return gp_cov
 
+    @profiled
+    def covariance_ski(self, cond, include_obs=False, parametric_only=False, pad=1e-8):
+        X1 = self.standardize_input_array(cond)
+        m = X1.shape[0]
+        if parametric_only:
+            return pad * np.eye(m)
+
+        V = self.ski.interp_weights(X1).dot(self.ski_var)
+        gp_cov = self.kernel(X1, X1, identical=include_obs) - np.dot(V, V.T)
+        gp_cov += pad * np.eye(m)
+        return gp_cov
+
+    @profiled
+    def variance_ski(self, cond, include_obs=False, parametric_only=False, pad=1e-8):
+        X1 = self.standardize_input_array(cond)
+        m = X1.shape[0]
+        if parametric_only:
+            return pad * np.ones((m,))
+
+        V = self.ski.interp_weights(X1).dot(self.ski_var)
+        var = (self.main_prior_var() + pad) * np.ones((m,)) - np.sum(V**2, axis=1)
+        if include_obs:
+            var += self.noise_var
+        return var
+
+    def variance_vecchia(self, cond, include_obs=False, parametric_only=False, pad=1e-8):
+        # each point's variance given its k nearest training points
+        X1 = self.standardize_input_array(cond).astype(np.float)
+        m = X1.shape[0]
+        if parametric_only:
+            return pad * np.ones((m,))
+
+        _, var = self.vecchia.predict(X1, self.vecchia_neighbors(X1))
+        var += pad
+        if include_obs:
+            var += self.noise_var
+        return var
+
     def variance(self,cond, **kwargs):
+        if self.ski is not None:
+            return self.variance_ski(cond, **kwargs)
+        if self.vecchia is not None:
+            return self.variance_vecchia(cond, **kwargs)
         v = np.diag(self.covariance(cond, **kwargs))
         return v
 
+    def query_signature(self):
+        """
+        Hash of everything that determines the predictive variance (but
+        not the mean) of this model: training inputs, covariances, noise,
+        sparsity threshold, low-rank prior and how Kinv is stored. Models with the same signature, e.g. the same
+        stations observed for different months, can share query kernels
+        and variances.
+        """
+        try:
+            sig = self._query_signature
+        except AttributeError:
+            # raw parameter bytes, each prefixed by its shape, so that
+            # no two different models can print or concatenate alike.
+            h = hashlib.sha1()
+            def update(A):
+                A = np.ascontiguousarray(A, dtype=float)
+                h.update(str(A.shape))
+                h.update(A.view(np.uint8))
+
+            update(self.X)
+            update((self.noise_var, self.sparse_threshold, self.n_features))
+            for cov in (self.cov_main, self.cov_fic):
+                if cov is None:
+                    h.update("None;")
+                    continue
+                h.update("%s;%s;%s;%s;" % (cov.wfn_str, cov.dfn_str, cov.rff_dim, cov.rff_seed))
+                update(cov.wfn_params)
+                update(cov.dfn_params)
+                if cov.Xu is not None:
+                    update(cov.Xu)
+            h.update("%s;" % (self.basis,))
+            if self.y_obs_variances is not None:
+                update(self.y_obs_variances)
+            if self.n_features > 0:
+                update(self.invc)
+            sig = h.hexdigest()
+            self._query_signature = sig
+
+        # batch_query takes a different path depending on how the
+        # model is stored, which can change after training (e.g. when
+        # trees are built), so this part isn't cached.
+        mode = (getattr(self, 'single_trees_on_X', False), scipy.sparse.issparse(getattr(self, 'Kinv', None)), self.solver, self.mean_only)
+        return "%s-%s" % (sig, hashlib.sha1(repr(mode)).hexdigest()[:8])
+
+    @profiled
+    def batch_query(self, X1, include_obs=False, pad=1e-8):
+        """
+        Compute the quantities needed for independent (marginal)
+        predictions at each row of X1: the n x m query kernel Kstar, the
+        low-rank features H, and the diagonal of the predictive
+        covariance, without forming the full m x m covariance.
+        """
+        m = X1.shape[0]
+
+        var = (self.main_prior_var() + pad) * np.ones((m,))
+        if include_obs:
+            var += self.noise_var
+
+        Kstar = None
+        if self.n > 0 and self.n_rff_features == 0:
+            if self.single_trees_on_X:
+                Kstar = self.sparse_kernel(X1).tocsc()
+                if scipy.sparse.issparse(self.Kinv):
+                    tmp = self.Kinv * Kstar
+                    qf = np.asarray(Kstar.multiply(tmp).sum(axis=0)).flatten()
+                else:
+                    Kstar = Kstar.toarray()
+            if not scipy.sparse.issparse(Kstar):
+                if Kstar is None:
+                    Kstar = self.kernel(self.X, X1)
+                tmp = np.asarray(self.Kinv.dot(Kstar))
+                qf = np.sum(np.asarray(Kstar) * tmp, axis=0)
+            var -= qf
+
+        H = None
+        if self.n_features > 0:
+            H = self.get_data_features(X1)
+            R = H
+            if Kstar is not None:
+                R = H - np.asarray(Kstar.T.dot(self.HKinv.T)).T
+            tmp = np.dot(self.invc, R)
+            var += np.sum(tmp**2, axis=0)
+
+        if self.predict_tree_fic is not None:
+            var += self.covariance_diag_correction(X1)
+
+        return Kstar, H, var
+
+    def batch_mean(self, Kstar, H, m):
+        # predictive mean at m points, given Kstar and H from batch_query
+        mean = self.ymean * np.ones((m,))
+        if Kstar is not None:
+            mean += np.asarray(Kstar.T.dot(self.alpha_r)).flatten()
+        if H is not None:
+            mean += np.dot(H.T, self.beta_bar)
+        return mean
+
+    def log_p_batch(self, y_values, X_candidates, include_obs=True, chunk_size=1000):
+        """
+        Independent log densities of y_values (a scalar, or one value per
+        candidate) at each row of X_candidates. Equivalent to calling
+        log_p separately at each candidate, but vectorized.
+        """
+        return sum_log_p([self,], [y_values,], X_candidates, include_obs=include_obs, chunk_size=chunk_size)
+
+    def predict_bounds(self, lo, hi, include_obs=True, eps_abs=1e-4, pad=1e-8):
+        """
+        Bounds that hold simultaneously for every query point in the box
+        [lo, hi]. Returns (mean_lo, mean_hi, var_lo), where var_lo is a
+        lower bound on the predictive variance.
+
+        The bounds come from the cover trees (built with
+        build_tree=True): each tree node brackets its contribution using
+        the node's max_dist and the weight function bounds, with the
+        query widened to a ball around the box center that reaches the
+        box's farthest corner. They are valid for any eps_abs, which
+        only controls how far the trees are expanded.
+
+        Only euclidean distances are supported: under other metrics
+        (e.g. lld) the farthest point of a box needn't be a corner, so
+        the ball could miss part of the box.
+        """
+        for cov in (self.cov_main, self.cov_fic):
+            if cov is not None and cov.dfn_str != "euclidean":
+                raise ValueError("bounds over a region require a euclidean distance, not %s" % cov.dfn_str)
+        if self.double_tree is None:
+            raise ValueError("bounds over a region require a model built with build_tree=True")
+        if self.n_param_features > 0:
+            raise ValueError("bounds over a region are not supported for parametric features")
+
+        lo = np.asarray(lo, dtype=np.float)
+        hi = np.asarray(hi, dtype=np.float)
+        center = np.reshape((lo + hi) / 2.0, (1, -1))
+        corners = np.array(list(itertools.product(*zip(lo, hi))), dtype=np.float)
+
+        # radius of the ball containing the box: for euclidean
+        # distances, the farthest point of a box is a corner.
+        r_main = np.max(self.predict_tree.kernel_matrix(center, corners, True))
+        mean_lo, mean_hi = self.predict_tree.weighted_sum_bounds(0, center, r_main, eps_abs)
+        qf_lo, qf_hi = self.double_tree.quadratic_form_bounds(center, r_main, eps_abs)
+
+        if self.cov_fic is not None:
+            try:
+                self.fic_bound_tree
+            except AttributeError:
+                # the FIC part of the mean is a weighted sum of kernels
+                # centered at the inducing points.
+                self.fic_bound_tree = VectorTree(self.cov_fic.Xu, 1, *self.cov_fic.tree_params())
+                self.fic_bound_tree.set_v(0, self.beta_bar[self.n_param_features:].astype(np.float))
+            r_fic = np.max(self.fic_bound_tree.kernel_matrix(center, corners, True))
+            fic_lo, fic_hi = self.fic_bound_tree.weighted_sum_bounds(0, center, r_fic, eps_abs)
+            mean_lo += fic_lo
+            mean_hi += fic_hi
+
+        # the low-rank and FIC diagonal terms only add variance, so we
+        # can drop them from the lower bound.
+        var_lo = max(0.0, self.cov_main.wfn_params[0] - qf_hi) + pad
+        if include_obs:
+            var_lo += self.noise_var
+
+        return mean_lo + self.ymean, mean_hi + self.ymean, var_lo
+
+    def log_p_bound(self, y, lo, hi, include_obs=True, eps_abs=1e-4):
+        """
+        Upper bound on log p(y | x) over all x in the box [lo, hi].
+        """
+        mean_lo, mean_hi, var_lo = self.predict_bounds(lo, hi, include_obs=include_obs, eps_abs=eps_abs)
+        r = max(0.0, mean_lo - y, y - mean_hi)
+
+        # -.5 * (r^2/v + log(2 pi v)) is maximized at v = r^2
+        v = max(var_lo, r**2)
+        return -.5 * (r**2 / v + np.log(2*np.pi*v))
+
     def sample(self, cond, include_obs=True, method="naive"):
         """
         Sample from the GP posterior at a set of points given by the rows of X1.
@@ -1279,6 +2196,10 @@ class GP(object):
         sample values of the latent function f.
         """
 
+        if method == "pathwise":
+            samples = self.sample_pathwise(cond, include_obs=include_obs)
+            return samples[0] if len(samples) == 1 else samples
+
         X1 = self.standardize_input_array(cond)
         (n,d) = X1.shape
         means = np.reshape(self.predict(X1), (-1, 1))
@@ -1304,6 +2225,68 @@ class GP(object):
 
         return samples
 
+    def sample_pathwise(self, cond, include_obs=True, n_samples=1, n_rff=1000, pad=1e-8):
+        """
+        Joint posterior samples at the rows of X1, drawn by updating
+        prior samples (Matheron's rule) rather than factoring the
+        posterior covariance. Returns an m x n_samples matrix.
+
+        Low-rank feature weights are drawn from their posterior
+        N(beta_bar, M). Given those weights, a joint prior sample of the
+        remaining GP at the training and query points is corrected by
+        K*^T K^-1 (residual - prior sample), using the existing
+        factorization of the training covariance. The prior sample is
+        exact for compact kernels and uses random features otherwise
+        (see prior_sample_scalable), so large grids never need an m x m
+        covariance.
+        """
+        X1 = np.asarray(self.standardize_input_array(cond), dtype=np.float)
+        m = X1.shape[0]
+        X = np.asarray(self.X, dtype=np.float)
+
+        # prior draws at training and query points jointly
+        if self.n_rff_features > 0:
+            # the main kernel is sampled through the feature weights
+            g = np.sqrt(pad) * np.random.randn(self.n + m, n_samples)
+        else:
+            g = prior_sample_scalable(np.vstack([X, X1]), self.cov_main, pad, n_samples=n_samples, n_rff=n_rff)
+            g = np.reshape(g, (self.n + m, n_samples))
+        if self.predict_tree_fic is not None:
+            # FIC treats the residual diagonal variance as independent per point
+            dc = np.concatenate([self.covariance_diag_correction(X), self.covariance_diag_correction(X1)])
+            g += np.reshape(np.sqrt(np.maximum(dc, 0)), (-1, 1)) * np.random.randn(self.n + m, n_samples)
+        g_train, samples = g[:self.n], g[self.n:]
+
+        resid = np.reshape(self.y, (-1, 1)) * np.ones((1, n_samples))
+        if self.n_features > 0:
+            beta = np.reshape(self.beta_bar, (-1, 1)) + np.dot(self.invc.T, np.random.randn(self.n_features, n_samples))
+            resid -= np.dot(self.get_data_features(X).T, beta)
+            samples += np.dot(self.get_data_features(X1).T, beta)
+
+        if self.n > 0 and self.n_rff_features == 0:
+            obs_var = self.noise_var * np.ones((self.n,))
+            if self.y_obs_variances is not None:
+                obs_var += self.y_obs_variances
+            eps = np.reshape(np.sqrt(obs_var), (-1, 1)) * np.random.randn(self.n, n_samples)
+            resid -= g_train + eps
+
+            try:
+                v = np.asarray(self.factor(resid))
+            except AttributeError:
+                # models loaded from disk keep Kinv but not the factor
+                v = np.asarray(self.Kinv.dot(resid))
+
+            if self.single_trees_on_X:
+                Kstar = self.sparse_kernel(X1).tocsc()
+            else:
+                Kstar = self.kernel(self.X, X1)
+            samples += np.asarray(Kstar.T.dot(v))
+
+        if include_obs:
+            samples += np.sqrt(self.noise_var) * np.random.randn(m, n_samples)
+
+        return samples + self.ymean
+
     def param_mean(self):
         return self.beta_bar
 
@@ -1382,7 +2365,137 @@ class GP(object):
 
     
 
+    def _check_cv_available(self):
+        if self.ski is not None or self.vecchia is not None or self.solver == "pcg" or self.mean_only:
+            raise ValueError("cross-validation needs an explicit Kinv, which ski_grid, vecchia, pcg and mean_only models don't have")
+
+    def loo_predictions(self):
+        """
+        Leave-one-out predictions at every training point, computed
+        from the trained model without refitting (Rasmussen & Williams,
+        section 5.4.2). With P the inverse of the training covariance
+        (including any low-rank components), the prediction of y_i from
+        the other points has mean y_i - [P r]_i / P_ii and variance
+        1 / P_ii, where P r is just alpha_r. The diagonal of P comes
+        from diag(Kinv) and the low-rank correction, so this is O(n)
+        work beyond the fit.
+
+        Returns (means, variances, logps), aligned with the rows of
+        self.X (which are in Morton order unless sort_events=False).
+        Variances are of the observations, including noise, and logps
+        are the predictive log densities of each y_i.
+        """
+        self._check_cv_available()
+
+        if scipy.sparse.issparse(self.Kinv):
+            d = np.array(self.Kinv.diagonal(), dtype=float)
+        else:
+            d = np.array(np.diag(np.asarray(self.Kinv)), dtype=float)
+        if self.n_features > 0:
+            V = np.dot(self.invc, np.asarray(self.HKinv))
+            d -= np.sum(V**2, axis=0)
+
+        variances = 1.0 / d
+        resid = self.alpha_r * variances
+        means = self.y - resid + self.ymean
+        logps = -.5 * (np.log(2*np.pi*variances) + resid**2 / variances)
+        return means, variances, logps
+
+    def kfold_predictions(self, folds=10, seed=0):
+        """
+        Cross-validated predictions holding out one fold at a time,
+        again without refitting. folds is either the number of folds,
+        to split the training points at random (using seed), or a list
+        of arrays of row indices into self.X. Holding out the points I,
+        the prediction of y_I has covariance P_II^-1 and mean
+        y_I - P_II^-1 [P r]_I, so each fold costs one dense |I| x |I|
+        factorization.
+
+        Returns (means, variances, logps, fold_logps): the first three
+        as in loo_predictions (marginal per point), and fold_logps the
+        joint predictive log density of each fold.
+        """
+        self._check_cv_available()
+
+        if isinstance(folds, int):
+            p = np.random.RandomState(seed).permutation(self.n)
+            folds = np.array_split(p, folds)
+
+        if scipy.sparse.issparse(self.Kinv):
+            Kinv = self.Kinv.tocsr()
+        else:
+            Kinv = np.asarray(self.Kinv)
+        V = np.dot(self.invc, np.asarray(self.HKinv)) if self.n_features > 0 else None
+
+        means, variances, logps = np.zeros((self.n,)), np.zeros((self.n,)), np.zeros((self.n,))
+        fold_logps = []
+        for I in folds:
+            I = np.asarray(I, dtype=int)
+            if scipy.sparse.issparse(Kinv):
+                P = np.array(Kinv[I,:][:,I].toarray(), dtype=float)
+            else:
+                P = np.array(Kinv[np.ix_(I, I)], dtype=float)
+            if V is not None:
+                P -= np.dot(V[:,I].T, V[:,I])
+
+            L = scipy.linalg.cholesky(P, lower=True)
+            Sigma = scipy.linalg.cho_solve((L, True), np.eye(len(I)))
+            resid = np.dot(Sigma, self.alpha_r[I])
+            var = np.diag(Sigma)
+
+            means[I] = self.y[I] - resid + self.ymean
+            variances[I] = var
+            logps[I] = -.5 * (np.log(2*np.pi*var) + resid**2 / var)
+            # resid^T Sigma^-1 resid = resid^T alpha_r[I], and
+            # log det Sigma = -2 sum(log(diag(L)))
+            fold_logps.append(-.5 * np.dot(resid, self.alpha_r[I]) + np.log(np.diag(L)).sum() - .5 * len(I) * np.log(2*np.pi))
+
+        return means, variances, logps, np.array(fold_logps)
+
+    def memory_report(self):
+        """
+        Bytes held by each large component of the model, including the
+        native storage of the cover trees, as a dict with the overall
+        sum under 'total'. Components that aren't present are omitted.
+        The CHOLMOD factor (if kept) isn't included, since its size
+        isn't exposed without copying it.
+        """
+        report = dict()
+        for name in ('X', 'y', 'y_obs_variances', 'alpha_r', 'K', 'Kinv', 'Kinv_dense', 'L',
+                     'HKinv', 'invc', 'c', 'beta_bar', 'K_fic_un', 'K_fic_uu', 'Luu', 'Luu_inv',
+                     'rff_omega', 'rff_phase', 'ski_W', 'ski_mean', 'ski_var',
+                     'query_K', 'querysp_K', 'querysp_R'):
+            nbytes = array_bytes(getattr(self, name, None))
+            if nbytes > 0:
+                report[name] = nbytes
+
+        if self.solver == "pcg":
+            report['pcg_solver'] = array_bytes(self.factor)
+            report.pop('Kinv', None)
+
+        if self.vecchia is not None:
+            report['vecchia'] = self.vecchia.memory_bytes()
+
+        fic_proj = getattr(self, 'fic_proj', None)
+        if fic_proj is not None:
+            report['fic_proj'] = sum([array_bytes(A) for A in fic_proj])
+
+        for name in ('predict_tree', 'predict_tree_fic', 'cov_tree', 'double_tree'):
+            tree = getattr(self, name, None)
+            if tree is not None:
+                report[name] = tree.memory_bytes()
+
+        report['total'] = sum(report.values())
+        return report
+
     def pack_npz(self, tight=False):
+        if self.ski is not None:
+            raise ValueError("saving ski_grid models is not supported; rebuild them from their hyperparameters")
+        if self.vecchia is not None:
+            raise ValueError("saving vecchia models is not supported; rebuild them from their hyperparameters")
+        if self.mean_only:
+            raise ValueError("mean_only models can't be saved, since they lack Kinv")
+
         d = dict()
         if self.n_features > 0:
             d['beta_bar'] = self.beta_bar
@@ -1398,8 +2511,10 @@ class GP(object):
         d['ymean'] = self.ymean,
         d['alpha_r'] =self.alpha_r
 
-        if not tight:
+        # pcg models have no explicit Kinv; loading one re-runs the solves
+        if not tight and self.solver != "pcg":
             d['Kinv'] =self.Kinv
+        d['solver'] = self.solver
 
         #d['K'] =self.K,
         d['sparse_threshold'] =self.sparse_threshold,
@@ -1420,10 +2535,14 @@ class GP(object):
 
     def __setstate__(self, d):
         self.unpack_npz(d)
-        sparse_invert = scipy.sparse.issparse(self.Kinv)
-        self.predict_tree, self.predict_tree_fic = self.build_initial_single_trees(build_single_trees=sparse_invert)
-        self.double_tree = None
         self.n = self.X.shape[0]
+        if self.solver == "pcg":
+            self.timings = dict()
+            self.setup_kernel_matrix(sparse_invert=True)
+        else:
+            sparse_invert = scipy.sparse.issparse(self.Kinv)
+            self.predict_tree, self.predict_tree_fic = self.build_initial_single_trees(build_single_trees=sparse_invert)
+        self.double_tree = None
 
     def save_trained_model(self, filename, tight=False):
         """
@@ -1433,7 +2552,7 @@ class GP(object):
         with open(filename, 'wb') as f:
             np.savez(f, **d)
 
-    def unpack_npz(self, npzfile):
+    def unpack_npz(self, npzfile, mean_only=False):
         self.X = npzfile['X'][0]
         self.y = npzfile['y'][0]
         self.n = self.X.shape[0]
@@ -1460,11 +2579,18 @@ class GP(object):
         self.cov_main = unpack_gpcov(npzfile, 'main')
         self.cov_fic = unpack_gpcov(npzfile, 'fic')
         if self.cov_fic is not None:
-            self.Luu = npzfile['Luu'][0]
+            self.set_Luu(npzfile['Luu'][0])
+        self.setup_rff()
+
+        # features are ordered [basis | random features | fic]
+        self.n_param_features = self.n_features
+        if self.cov_fic is not None:
+            self.n_param_features -= self.cov_fic.Xu.shape[0]
 
 
         self.sparse_threshold = npzfile['sparse_threshold'][0]
         self.ll = npzfile['ll'][0]
+        self.solver = str(npzfile['solver']) if 'solver' in npzfile else "cholmod"
 
 
         if 'basis' in npzfile:
@@ -1477,12 +2603,16 @@ class GP(object):
 
         if self.n_features > 0:
             self.beta_bar = npzfile['beta_bar']
+        if self.n_features > 0 and not mean_only:
             self.invc = npzfile['invc']
             self.HKinv = npzfile['HKinv']
         else:
             self.HKinv = None
 
-        if 'Kinv' in npzfile:
+        # the terms below are only needed for covariances
+        if mean_only:
+            self.Kinv = None
+        elif 'Kinv' in npzfile:
             Kinv = npzfile['Kinv']
             try:
                 Kinv[0,0]
@@ -1490,12 +2620,28 @@ class GP(object):
             except:
                 self.Kinv = Kinv[0]
 
-    def load_trained_model(self, filename, build_tree=True, cache_dense=False, leaf_bin_width=0, build_dense_Kinv_hack=False, compile_tree=None, sparse_invert=False):
+    def load_trained_model(self, filename, build_tree=True, cache_dense=False, leaf_bin_width=0, build_dense_Kinv_hack=False, compile_tree=None, sparse_invert=False, mean_only=False):
+        """
+        Load a model saved by save_trained_model. With mean_only=True,
+        Kinv and the low-rank covariance terms aren't loaded, and no
+        product tree is built: the model keeps only alpha_r (in a tree
+        over the training points) and the parametric mean, and can
+        serve predict() but not covariance queries.
+        """
         npzfile = np.load(filename)
-        self.unpack_npz(npzfile)
+        self.unpack_npz(npzfile, mean_only=mean_only)
         del npzfile.f
         npzfile.close()
 
+        if mean_only:
+            self.mean_only = True
+            self.timings = dict()
+            self.predict_tree, self.predict_tree_fic = self.build_initial_single_trees(build_single_trees=True)
+            if self.predict_tree is not None:
+                self.predict_tree.set_v(0, self.alpha_r.astype(np.float))
+            self.double_tree = None
+            return
+
         try:
             sparse_invert = scipy.sparse.issparse(self.Kinv)
             self.predict_tree, self.predict_tree_fic = self.build_initial_single_trees(build_single_trees=sparse_invert)
@@ -1517,24 +2663,38 @@ class GP(object):
         if cache_dense and self.n > 0:
             self.Kinv_dense = self.Kinv.todense()
 
+    @profiled
     def _compute_marginal_likelihood(self, L, z, Binv, H, K, Kinv):
 
 
         z = np.reshape(z, (-1, 1))
 
 
-        if scipy.sparse.issparse(L):
-            ldiag = L.diagonal()
+        if L is None:
+            # no factorization to read the determinant from (iterative
+            # solvers), so estimate it from matvecs with K.
+            t0 = time.time()
+            ld2_K = .5 * slq_logdet(K.dot, self.n, n_probes=SLQ_PROBES, n_steps=SLQ_STEPS,
+                                    rng=np.random.RandomState(SLQ_SEED))
+            self.timings['slq_logdet'] = time.time()-t0
         else:
-            ldiag = np.diag(L)
+            # the determinant of a symmetric pos. def. matrix is the
+            # product of squares of the diagonal elements of the
+            # Cholesky factor
+            if scipy.sparse.issparse(L):
+                ldiag = L.diagonal()
+            else:
+                ldiag = np.diag(L)
+            ld2_K = np.log(ldiag).sum()
 
 
         # everything is much simpler in the pure nonparametric case
         if self.n_features == 0:
-            try:
-                ld2_K = self.logdet / 2.0
-            except:
-                ld2_K = np.log(ldiag).sum()
+            if L is not None:
+                try:
+                    ld2_K = self.logdet / 2.0
+                except:
+                    pass
 
             #if np.isnan(ld2_K):
             #    import pdb; pdb.set_trace()
@@ -1576,7 +2736,7 @@ class GP(object):
         # i.e.:            term1    -     term2
         # in the notation of the code.
 
-        tmp1 = Kinv * z
+        tmp1 = Kinv.dot(z)
         term1 = np.dot(z.T, tmp1)
 
         tmp2 = np.dot(self.HKinv, z)
@@ -1590,14 +2750,10 @@ class GP(object):
         # log det(K + H.T * B * H). using the matrix inversion
         # lemma, we instead compute
         # log det(K) + log det(B) + log det(B^-1 + H*K^-1*H.T)
+        # where only log det(K) (ld2_K, above) involves an n x n
+        # matrix; the low-rank terms are exact even with an
+        # iterative solver, since HKinv comes from solves.
 
-        # to compute log(det(K)), we use the trick that the
-        # determinant of a symmetric pos. def. matrix is the
-        # product of squares of the diagonal elements of the
-        # Cholesky factor
-
-
-        ld2_K = np.log(ldiag).sum()
         ld2 =  np.log(np.diag(self.c)).sum() # det( B^-1 + H * K^-1 * H.T )
         ld_B = -np.log(np.linalg.det(Binv))
 
@@ -1710,7 +2866,7 @@ class GP(object):
         return dKdi
 
     def get_dKdi_dense_fic_wfnvar(self):
-        B = scipy.linalg.solve(self.Luu, self.K_fic_un)
+        B = self.solve_Luu(self.K_fic_un)
         Qnn = np.dot(B.T, B)
         Qnn /= self.cov_fic.wfn_params[0]
         Qnn += np.diag(1.0 - np.diag(Qnn))
@@ -1747,7 +2903,66 @@ class GP(object):
         return self.predict_tree_fic.kernel_deriv_wrt_xi(self.cov_fic.Xu, self.X, p, i)
 
 
-    def get_dlldi_sparse_fic(self, dKuu_di, dKnu_di, alpha, nzr, nzc, Kinv_entries, tmp):
+    def fic_param_derivs(self, i, n_main_params):
+        # (dKuu/dtheta_i, dKnu/dtheta_i) for a FIC lengthscale
+        idx = i-n_main_params-2
+        dKuu_di = self.predict_tree_fic.kernel_deriv_wrt_i(self.cov_fic.Xu, self.cov_fic.Xu, idx, 1, self.distance_cache_XuXu)
+        dKnu_di = self.predict_tree_fic.kernel_deriv_wrt_i(self.X, self.cov_fic.Xu, idx, 0, self.distance_cache_XXu)
+        return dKuu_di, dKnu_di
+
+    def fic_xu_gradient(self, alpha, Kinv, tmp):
+        """
+        Gradient of the log likelihood wrt every inducing point
+        coordinate at once, as an array shaped like Xu.
+
+        Moving Xu[p,i] changes only row p of Kun and row/column p of
+        Kuu, so dQ = h D_p^T + D_p h^T (D_p the p'th row of D = Kuu^-1
+        Kun), with h = dKun[p,:] - dKuu[p,:] D. The diagonal of Q is
+        replaced by the FIC correction, so
+            dll/dXu[p,i] = .5 * tr(Z dQ) = h . (D Z)[p,:]
+        where Z = offdiag(alpha alpha^T - Kinv + tmp^T tmp). D Z is
+        shared by all coordinates, and each dimension needs just two
+        kernel derivative matrices and one product with D.
+        """
+        Xu = self.cov_fic.Xu
+        D = self.D
+        a = np.reshape(np.asarray(alpha), (-1,))
+
+        # D Z, using the symmetric part of Kinv as tr(Kinv dQ) does
+        KinvDt = .5 * (np.asarray(Kinv.dot(D.T)) + np.asarray(Kinv.T.dot(D.T)))
+        DZ = np.outer(np.dot(D, a), a) - KinvDt.T
+        zdiag = a**2 - np.reshape(np.asarray(Kinv.diagonal()), (-1,))
+        if tmp is not None:
+            tmp = np.asarray(tmp)
+            DZ += np.dot(np.dot(D, tmp.T), tmp)
+            zdiag += np.sum(tmp**2, axis=0)
+        DZ -= D * zdiag
+
+        grad = np.zeros(Xu.shape)
+        for i in range(Xu.shape[1]):
+            dKun = self.predict_tree_fic.kernel_deriv_wrt_pts1(Xu, self.X, i)
+            dKuu = self.predict_tree_fic.kernel_deriv_wrt_pts1(Xu, Xu, i)
+            np.fill_diagonal(dKuu, 0)
+            H = dKun - np.dot(dKuu, D)
+            grad[:, i] = np.sum(H * DZ, axis=1)
+        return grad
+
+    def sparse_fic_tr1(self, derivs, Kinv_coo):
+        # tr1 = tr( Kinv dQ ) for each (dKuu_di, dKnu_di) in derivs,
+        # over the off-diagonal nonzeros of Kinv (the diagonal of dQ is
+        # in dLambda instead). All params are handled in one pass over
+        # the nonzeros, by sparse_fic_trace in the cover_tree extension.
+        if len(derivs) == 0:
+            return np.zeros((0,))
+        Dt = np.ascontiguousarray(self.D.T, dtype=float)
+        dDt = np.ascontiguousarray(np.hstack([np.dot(dKuu_di, self.D).T for (dKuu_di, dKnu_di) in derivs]), dtype=float)
+        dKnu = np.ascontiguousarray(np.hstack([dKnu_di for (dKuu_di, dKnu_di) in derivs]), dtype=float)
+        return sparse_fic_trace(np.asarray(Kinv_coo.row, dtype=np.int32),
+                                np.asarray(Kinv_coo.col, dtype=np.int32),
+                                np.asarray(Kinv_coo.data, dtype=float),
+                                Dt, dDt, dKnu)
+
+    def get_dlldi_sparse_fic(self, dKuu_di, dKnu_di, alpha, tr1, tmp):
         D = self.D
         # term1 = y^T Kinv (d/dtheta QfuQuu^-1Quf) Kinv y
         nu = self.nu
@@ -1784,33 +2999,8 @@ class GP(object):
         # where M = (K_cs + Lambda + K_fu K_uu^-1 K_uf)^-1
         #       dQ = d/dtheta  K_fu K_uu^-1 K_uf
 
-        # tr1 = tr( Kinv dQ )
-        # compute sum(Kinv elementwise-* dQ) using the sparsity of Kinv
-        code = """
-        int n = nzc.size();
-        int nu = D.shape()(0);
-        double sum = 0;
-        for (int i=0; i < n; ++i) {
-            double entry = 0;
-            int ri = nzr(i);
-            int ci = nzc(i);
-
-            if(ri == ci) {
-               continue;
-            }
-
-            for (int k=0; k < nu; ++k) {
-                entry -= D(k, ri) * dD(k, ci);
-                entry += dKnu_di(ri, k) * D(k, ci);
-                entry += dKnu_di(ci, k) * D(k, ri);
-            }
-            entry *= Kinv_entries(i);
-            sum += entry;
-        }
-        return_val = sum;
-        """
-        tr1 = weave.inline(code, ['nzc', 'nzr', 'Kinv_entries', 'D', 'dD', 'dKnu_di'],
-                           type_converters=converters.blitz, compiler='gcc')
+        # tr1 = tr( Kinv dQ ) is precomputed for all params at once,
+        # see sparse_fic_tr1.
 
         # tr2 = tr( tmp^T tmp dQ)
         TDt = self.TDt
@@ -1834,7 +3024,7 @@ class GP(object):
         dlldi = .5 * (prod-tr)
         return dlldi
 
-    def get_dlldi_sparse(self, i, n_main_params, n_fic_non_inducing, alpha, nzr, nzc, Kinv_entries, tmp):
+    def get_dlldi_sparse(self, i, n_main_params, n_fic_non_inducing, alpha, tmp, fic_derivs=None, fic_tr1=None):
 
         if (i == 0):
             # dKdi = scipy.sparse.eye(self.n)
@@ -1901,7 +3091,7 @@ class GP(object):
             if (len(self.cov_fic.wfn_params) != 1):
                 raise ValueError('gradient computation currently assumes just a single scaling parameter for weight function, but currently wfn_params=%s' % self.cov_fic.wfn_params)
 
-            B = scipy.linalg.solve(self.Luu, self.K_fic_un)
+            B = self.solve_Luu(self.K_fic_un)
 
             # dKdi = B^T B / wfn_params[0] but with diag set to 1.0
             Qnn_diag= self.cov_fic.wfn_params[0] - np.sum(B **2, axis=0)
@@ -1928,24 +3118,42 @@ class GP(object):
 
             dlldi = first_line - second_line
 
-        elif i <= n_main_params + n_fic_non_inducing:
-            idx = i-n_main_params-2
-            dKuu_di = self.predict_tree_fic.kernel_deriv_wrt_i(self.cov_fic.Xu, self.cov_fic.Xu, idx, 1, self.distance_cache_XuXu)
-            dKnu_di = self.predict_tree_fic.kernel_deriv_wrt_i(self.X, self.cov_fic.Xu, idx, 0, self.distance_cache_XXu)
-            dlldi =  self.get_dlldi_sparse_fic(dKuu_di, dKnu_di, alpha, nzr, nzc, Kinv_entries, tmp)
-
         else:
-            p = int(np.floor((i-n_main_params-n_fic_non_inducing-1) / self.cov_fic.Xu.shape[1]))
-            ii = (i-n_main_params-n_fic_non_inducing-1) % self.cov_fic.Xu.shape[1]
-            dKuu_di = self.deriv_uu_wrt_Xu(p,ii)
-            dKnu_di = self.deriv_un_wrt_Xu(p,ii).T
-
-            dlldi =  self.get_dlldi_sparse_fic(dKuu_di, dKnu_di, alpha, nzr, nzc, Kinv_entries, tmp)
+            dKuu_di, dKnu_di = fic_derivs[i]
+            dlldi =  self.get_dlldi_sparse_fic(dKuu_di, dKnu_di, alpha, fic_tr1[i], tmp)
 
 
         return dlldi
 
 
+    def get_dlldi_rff(self, i, alpha, tmp):
+        # derivative wrt the i'th main kernel hyperparam when that
+        # kernel is represented by random features Phi, which enter the
+        # covariance as Phi^T Phi. Then dK = dPhi^T Phi + Phi^T dPhi, and
+        #  .5 * alpha^T dK alpha - .5 * tr((K + H^T B H)^-1 dK)
+        # = (Phi alpha)^T (dPhi alpha) - sum(multiply(P, dPhi))
+        # where P = Phi (K + H^T B H)^-1 = Phi K^-1 - (Phi tmp^T) tmp.
+        # Phi K^-1 is already available as a block of HKinv.
+        if (len(self.cov_main.wfn_params) != 1):
+            raise ValueError('gradient computation currently assumes just a single scaling parameter for weight function, but currently wfn_params=%s' % self.cov_main.wfn_params)
+
+        X = np.asarray(self.X, dtype=float)
+        Phi = self.rff_projection(X)
+        if i == 1:
+            dPhi = Phi / (2 * self.cov_main.wfn_params[0])
+        else:
+            # omega = z / l, so d(omega.x)/dl_k = -omega_k x_k / l_k
+            k = i-2
+            dPhi = -self.rff_phase_deriv(X) * np.outer(self.rff_omega[:,k], X[:,k]) / self.cov_main.dfn_params[k]
+
+        alpha = np.reshape(np.asarray(alpha), (-1,))
+        tmp = np.asarray(tmp)
+        rff_rows = slice(self.n_param_features - self.n_rff_features, self.n_param_features)
+        P = np.asarray(self.HKinv[rff_rows, :]) - np.dot(np.dot(Phi, tmp.T), tmp)
+
+        return np.dot(np.dot(Phi, alpha), np.dot(dPhi, alpha)) - np.sum(P * dPhi)
+
+    @profiled
     def _log_likelihood_gradient(self, z, Kinv, include_xu=True):
         """
         Gradient of the training set log likelihood with respect to the
@@ -1964,7 +3172,10 @@ class GP(object):
 
         grad = np.zeros((nparams,))
 
-        if not scipy.sparse.issparse(Kinv):
+        if self.n_rff_features > 0:
+            # main kernel derivatives come from the features instead
+            pass
+        elif not scipy.sparse.issparse(Kinv):
             self.distance_cache_XX = self.predict_tree.kernel_matrix(self.X, self.X, True)
         else:
             max_distance = 1.0 if self.cov_main.wfn_str.startswith("compact") else 1e300
@@ -1998,14 +3209,25 @@ class GP(object):
             self.nu = np.dot(self.D, alpha)
             self.TDt = np.dot(tmp, self.D.T)
 
+        # inducing point coordinates come last, and are all handled at once
+        n_non_xu = 1 + n_main_params + n_fic_non_inducing
+        if nparams > n_non_xu:
+            grad[n_non_xu:] = np.reshape(self.fic_xu_gradient(alpha, Kinv, tmp), (-1,))
 
-        for i in range(nparams):
+        fic_derivs, fic_tr1 = None, None
+        if scipy.sparse.issparse(Kinv) and self.cov_fic is not None:
+            fic_params = range(n_main_params+2, n_non_xu)
+            fic_derivs = dict([(i, self.fic_param_derivs(i, n_main_params)) for i in fic_params])
+            tr1 = self.sparse_fic_tr1([fic_derivs[i] for i in fic_params], scipy.sparse.coo_matrix(Kinv))
+            fic_tr1 = dict(zip(fic_params, tr1))
 
-            if scipy.sparse.issparse(Kinv):
-                Kinv_coo = scipy.sparse.coo_matrix(Kinv)
-                nzr, nzc, Kinv_entries = Kinv_coo.row, Kinv_coo.col, Kinv_coo.data
+        for i in range(n_non_xu):
 
-                dlldi = self.get_dlldi_sparse(i, n_main_params, n_fic_non_inducing, alpha, nzr, nzc, Kinv_entries, tmp)
+            if self.n_rff_features > 0 and 1 <= i <= n_main_params:
+                dlldi = self.get_dlldi_rff(i, alpha, tmp)
+
+            elif scipy.sparse.issparse(Kinv):
+                dlldi = self.get_dlldi_sparse(i, n_main_params, n_fic_non_inducing, alpha, tmp, fic_derivs, fic_tr1)
 
             else:
                 dKdi = self.get_dKdi_dense(i, n_main_params, n_fic_non_inducing)
@@ -2023,6 +3245,110 @@ class GP(object):
         return self.ll
 
 
+def sum_log_p(models, ys, X_candidates, include_obs=True, chunk_size=1000):
+    """
+    For each row x of X_candidates, return sum_i log p(ys[i] | x) under
+    models[i], treating each candidate independently. ys[i] may be a
+    scalar or hold one value per candidate.
+
+    Candidates are processed in chunks of chunk_size points. Models with
+    the same query_signature() share the query kernel, features and
+    predictive variance for each chunk, since these don't depend on the
+    observed values; only the mean is computed per model.
+    """
+    # C order, so that each chunk of rows is contiguous (the query
+    # caches hash them, and the trees read them in place).
+    X_candidates = np.ascontiguousarray(X_candidates, dtype=np.float)
+    m = X_candidates.shape[0]
+    lp = np.zeros((m,))
+
+    groups = collections.OrderedDict()
+    for (model, y) in zip(models, ys):
+        groups.setdefault(model.query_signature(), []).append((model, y))
+
+    for group in groups.values():
+        for start in range(0, m, chunk_size):
+            Xc = X_candidates[start:start+chunk_size]
+            mc = Xc.shape[0]
+            Kstar, H, var = group[0][0].batch_query(Xc, include_obs=include_obs)
+            for (model, y) in group:
+                y = np.asarray(y, dtype=np.float)
+                if y.ndim > 0:
+                    y = y[start:start+mc]
+                r = y - model.batch_mean(Kstar, H, mc)
+                lp[start:start+mc] += -.5 * (r**2 / var + np.log(2*np.pi*var))
+    return lp
+
+def maximize_sum_log_p(models, ys, lo, hi, min_width, include_obs=True, eps_abs=1e-4, max_boxes=100000):
+    """
+    Branch-and-bound search for the x in the box [lo, hi] maximizing
+    sum_i log p(ys[i] | x) under models[i] (which must be built with
+    build_tree=True, with euclidean distances; see GP.predict_bounds).
+
+    Boxes are expanded best-first by their upper bound. Each box is
+    split in half along its widest dimension (relative to min_width),
+    the children's centers are evaluated exactly, and children whose
+    bound can't beat the best center found so far are pruned. Boxes
+    narrower than min_width in every dimension are not split further,
+    so the result is within about min_width of the best point on a
+    grid of that resolution, at a fraction of the evaluations.
+
+    Returns (x, lp, stats).
+    """
+    lo = np.asarray(lo, dtype=np.float)
+    hi = np.asarray(hi, dtype=np.float)
+    min_width = np.asarray(min_width, dtype=np.float) * np.ones(lo.shape)
+    stats = {'evals': 0, 'bounds': 0, 'pruned': 0, 'boxes': 0}
+
+    def bound(blo, bhi):
+        stats['bounds'] += 1
+        return np.sum([model.log_p_bound(y, blo, bhi, include_obs=include_obs, eps_abs=eps_abs) for (model, y) in zip(models, ys)])
+
+    def evaluate(centers):
+        stats['evals'] += len(centers)
+        return sum_log_p(models, ys, centers, include_obs=include_obs)
+
+    x_best = (lo + hi) / 2.0
+    lp_best = evaluate(np.reshape(x_best, (1, -1)))[0]
+
+    # the counter breaks ties between equal bounds, so the heap never
+    # compares the box arrays themselves.
+    tiebreak = itertools.count()
+    heap = [(-bound(lo, hi), tiebreak.next(), lo, hi)]
+    while heap and stats['boxes'] < max_boxes:
+        neg_ub, _, blo, bhi = heapq.heappop(heap)
+        if -neg_ub <= lp_best:
+            # every remaining box has a lower bound than this one
+            stats['pruned'] += len(heap) + 1
+            break
+        stats['boxes'] += 1
+
+        widths = (bhi - blo) / min_width
+        if np.all(widths <= 1.0):
+            continue
+        k = np.argmax(widths)
+        mid = (blo[k] + bhi[k]) / 2.0
+        hi1 = bhi.copy()
+        hi1[k] = mid
+        lo2 = blo.copy()
+        lo2[k] = mid
+        children = [(blo, hi1), (lo2, bhi)]
+
+        centers = np.array([(clo + chi) / 2.0 for (clo, chi) in children])
+        lps = evaluate(centers)
+        for (center, lp) in zip(centers, lps):
+            if lp > lp_best:
+                x_best, lp_best = center, lp
+
+        for (clo, chi) in children:
+            ub = bound(clo, chi)
+            if ub > lp_best:
+                heapq.heappush(heap, (-ub, tiebreak.next(), clo, chi))
+            else:
+                stats['pruned'] += 1
+
+    return x_best, lp_best, stats
+
 def treegp_nll_ngrad(**kwargs):
     ll, grad = treegp_ll_grad(**kwargs)
     return -ll, (-grad if grad is not None else np.zeros((len(kwargs['hyperparams']),)))
@@ -2037,10 +3363,49 @@ def treegp_ll_grad(priors=None, **kwargs):
     """
 
 
+class MemoizedObjective(object):
+
+    def __init__(self, f, cache_size=64):
+        """
+        Wraps an objective f(v) returning (value, gradient), remembering
+        the results for the cache_size most recently used parameter
+        vectors. Optimizers (and alternating between them, as
+        bfgs_bump does) often evaluate the same vector more than once.
+        """
+        self.f = f
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __call__(self, v):
+        key = np.asarray(v, dtype=float).tostring()
+        try:
+            fv, grad = self.cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            fv, grad = self.f(v)
+            self.misses += 1
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[key] = (fv, grad)
+        # callers may modify the gradient they're given
+        return fv, (grad.copy() if grad is not None else None)
+
 def optimize_gp_hyperparams(optimize_Xu=True,
                             noise_var=1.0, noise_prior=None,
                             cov_main=None, cov_fic=None,
-                            allow_diag=False, **kwargs):
+                            allow_diag=False, cache_size=64,
+                            reuse_analysis=True, **kwargs):
+    """
+    Returns (nllgrad, x0, bounds, build_gp, covs_from_vector), where
+    nllgrad(v) is the negative log posterior and its gradient, memoized
+    for the cache_size most recent vectors (see MemoizedObjective). With
+    reuse_analysis, all fits share a CholmodAnalysisCache, so sparse
+    fits only redo the symbolic factorization when the sparsity pattern
+    changes.
+    """
+
+    chol_cache = CholmodAnalysisCache() if reuse_analysis else False
 
     n_mean_wfn = len(cov_main.wfn_params) if cov_main is not None else 0
     n_mean_dfn = len(cov_main.dfn_params) if cov_main is not None else 0
@@ -2072,7 +3437,8 @@ def optimize_gp_hyperparams(optimize_Xu=True,
         if cov_main is not None:
             new_cov_main = GPCov(wfn_str=cov_main.wfn_str, dfn_str=cov_main.dfn_str,
                                  wfn_params = cm_wfn_params, dfn_params = cm_dfn_params,
-                                 wfn_priors = cov_main.wfn_priors, dfn_priors=cov_main.dfn_priors)
+                                 wfn_priors = cov_main.wfn_priors, dfn_priors=cov_main.dfn_priors,
+                                 rff_dim=cov_main.rff_dim, rff_seed=cov_main.rff_seed)
         else:
             new_cov_main = None
 
@@ -2095,7 +3461,7 @@ def optimize_gp_hyperparams(optimize_Xu=True,
     def _nll(v):
         noise_var, new_cov_main, new_cov_fic = covs_from_vector(v)
         gp = GP(compute_ll=True, compute_grad=True, compute_xu_grad =optimize_Xu, noise_var=noise_var,
-                cov_main=new_cov_main, cov_fic=new_cov_fic, **kwargs)
+                cov_main=new_cov_main, cov_fic=new_cov_fic, chol_cache=chol_cache, **kwargs)
         return gp.ll
 
     def approx_gradient(f, x0, eps):
@@ -2108,7 +3474,7 @@ def optimize_gp_hyperparams(optimize_Xu=True,
             grad[i] = (f(x_new) - fx0) / eps
         return grad
 
-    def nllgrad(v):
+    def _nllgrad(v):
 
         if np.any(v[:n_non_xu] < 1e-10) or not np.all(np.isfinite(v)):
             return np.float('inf'), np.zeros(v.shape)
@@ -2117,7 +3483,7 @@ def optimize_gp_hyperparams(optimize_Xu=True,
 
         try:
             gp = GP(compute_ll=True, compute_grad=True, compute_xu_grad =optimize_Xu, noise_var=noise_var,
-                    cov_main=new_cov_main, cov_fic=new_cov_fic, **kwargs)
+                    cov_main=new_cov_main, cov_fic=new_cov_fic, chol_cache=chol_cache, **kwargs)
             ll = gp.ll
             grad = gp.ll_grad
             del gp
@@ -2160,10 +3526,12 @@ def optimize_gp_hyperparams(optimize_Xu=True,
 
     def build_gp(v, **kwargs2):
         noise_var, new_cov_main, new_cov_fic = covs_from_vector(v)
-        kw = dict(kwargs.items() + kwargs2.items())
+        kw = dict([('chol_cache', chol_cache),] + kwargs.items() + kwargs2.items())
         gp = GP(noise_var=noise_var, cov_main=new_cov_main, cov_fic=new_cov_fic, **kw)
         return gp
 
+    nllgrad = MemoizedObjective(_nllgrad, cache_size=cache_size)
+
     x0 = np.concatenate([[noise_var,],
                          cov_main.flatten() if cov_main is not None else [],
                          cov_fic.flatten(include_xu = optimize_Xu) if cov_fic is not None else []])
@@ -0,0 +1,193 @@
+import numpy as np
+import scipy.sparse
+
+
+def conjugate_gradient(matvec, b, tol=1e-6, maxiter=None, precond=None, x0=None):
+    """
+    Solve A x = b for a symmetric positive definite A, given only
+    matvec(v) = A v. If precond is given, precond(r) should apply an
+    approximate inverse of A. Iterates until |b - A x| <= tol * |b|.
+
+    Returns (x, number of iterations, final relative residual).
+    """
+    b = np.asarray(b, dtype=float)
+    n = len(b)
+    maxiter = n if maxiter is None else maxiter
+
+    bnorm = np.linalg.norm(b)
+    if bnorm == 0:
+        return np.zeros((n,)), 0, 0.0
+
+    if x0 is None:
+        x = np.zeros((n,))
+        r = b.copy()
+    else:
+        x = np.array(x0, dtype=float)
+        r = b - matvec(x)
+
+    z = r if precond is None else precond(r)
+    p = z.copy()
+    rz = np.dot(r, z)
+
+    for i in range(maxiter):
+        resid = np.linalg.norm(r) / bnorm
+        if resid <= tol:
+            return x, i, resid
+
+        Ap = matvec(p)
+        a = rz / np.dot(p, Ap)
+        x += a * p
+        r -= a * Ap
+
+        z = r if precond is None else precond(r)
+        rz_new = np.dot(r, z)
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+
+    return x, maxiter, np.linalg.norm(r) / bnorm
+
+
+def lanczos(matvec, b, k):
+    """
+    k steps of the Lanczos process for a symmetric A, started from b,
+    with full reorthogonalization (k is assumed small).
+
+    Returns Q, an n x k matrix with orthonormal columns spanning the
+    Krylov space of b, and the k x k matrix T = Q^T A Q. In exact
+    arithmetic T is tridiagonal, but once the Krylov space is nearly
+    exhausted the recurrence coefficients lose accuracy, so we form T
+    from the stored products A Q instead (keeping it positive definite
+    when A is). If the space is exhausted exactly, fewer than k
+    columns are returned.
+    """
+    b = np.asarray(b, dtype=float)
+    n = len(b)
+    k = min(k, n)
+
+    Q = np.zeros((n, k))
+    AQ = np.zeros((n, k))
+
+    q = b / np.linalg.norm(b)
+    for j in range(k):
+        Q[:, j] = q
+        AQ[:, j] = matvec(q)
+        alpha = np.dot(q, AQ[:, j])
+
+        # classical Gram-Schmidt, twice: one pass isn't enough to keep
+        # Q orthogonal when v is mostly cancellation error.
+        v = AQ[:, j] - np.dot(Q[:, :j+1], np.dot(Q[:, :j+1].T, AQ[:, j]))
+        v -= np.dot(Q[:, :j+1], np.dot(Q[:, :j+1].T, v))
+        beta = np.linalg.norm(v)
+        if beta <= 1e-10 * np.abs(alpha):
+            k = j+1
+            break
+        q = v / beta
+
+    Q, AQ = Q[:, :k], AQ[:, :k]
+    T = np.dot(Q.T, AQ)
+    return Q, .5 * (T + T.T)
+
+
+class BlockJacobiPreconditioner(object):
+
+    def __init__(self, K, block_size):
+        """
+        Inverts the diagonal blocks of a sparse K, each covering
+        block_size consecutive points. With Morton-ordered training
+        points, consecutive points are spatial neighbours, so these
+        blocks hold most of the mass of a compact-support kernel.
+        Memory is O(n * block_size).
+        """
+        n = K.shape[0]
+        self.n = n
+        self.block_size = block_size
+        n_blocks = (n + block_size - 1) / block_size
+
+        # gather the entries of each diagonal block into a dense stack,
+        # padding the last block with the identity.
+        Kc = scipy.sparse.coo_matrix(K)
+        r, c, v = Kc.row, Kc.col, Kc.data
+        inblock = (r / block_size) == (c / block_size)
+        blocks = np.zeros((n_blocks, block_size, block_size))
+        blocks[r[inblock] / block_size, r[inblock] % block_size, c[inblock] % block_size] = v[inblock]
+        for i in range(n, n_blocks * block_size):
+            blocks[-1, i % block_size, i % block_size] = 1.0
+
+        self.block_inv = np.linalg.inv(blocks)
+
+    def __call__(self, r):
+        R = np.zeros((self.block_inv.shape[0] * self.block_size,))
+        R[:self.n] = r
+        R = np.reshape(R, (-1, self.block_size))
+        z = np.einsum('ijk,ik->ij', self.block_inv, R)
+        return z.flatten()[:self.n]
+
+
+class PCGSolver(object):
+
+    def __init__(self, K, tol=1e-8, block_size=64, maxiter=None):
+        """
+        Applies K^-1 for a sparse positive definite K by block-Jacobi
+        preconditioned conjugate gradient solves, in place of a
+        factorization whose fill-in might not fit in memory. Can be
+        called like a CHOLMOD factor, solver(B), or used as a stand-in
+        for K^-1 via solver.dot(B). B may be a vector or a (dense or
+        sparse) matrix, solved column by column.
+
+        The iteration count and final relative residual of every
+        solve are recorded in self.iters and self.resids.
+        """
+        self.K = scipy.sparse.csr_matrix(K)
+        self.shape = self.K.shape
+        self.tol = tol
+        self.maxiter = maxiter
+        self.precond = BlockJacobiPreconditioner(self.K, block_size)
+        self.iters = []
+        self.resids = []
+
+    def solve_vector(self, b):
+        x, iters, resid = conjugate_gradient(self.K.dot, b, tol=self.tol, maxiter=self.maxiter, precond=self.precond)
+        self.iters.append(iters)
+        self.resids.append(resid)
+        if resid > self.tol:
+            print "WARNING: pcg did not converge (relative residual %g after %d iterations)" % (resid, iters)
+        return x
+
+    def __call__(self, B):
+        if scipy.sparse.issparse(B):
+            B = B.toarray()
+        B = np.asarray(B, dtype=float)
+        if B.ndim == 1:
+            return self.solve_vector(B)
+
+        X = np.zeros(B.shape)
+        for j in range(B.shape[1]):
+            X[:, j] = self.solve_vector(B[:, j])
+        return X
+
+    def dot(self, B):
+        return self(B)
+
+
+def slq_logdet(matvec, n, n_probes=30, n_steps=30, rng=None):
+    """
+    Stochastic Lanczos quadrature estimate of log det(A) for a
+    symmetric positive definite n x n A, given only matvec(v) = A v
+    (Ubaru, Chen & Saad, 2017).
+
+    log det(A) = tr(log(A)) is estimated as the average of z^T log(A) z
+    over Rademacher probes z. Each term is a Gauss quadrature rule from
+    n_steps of Lanczos started at z: with T = V diag(theta) V^T,
+    z^T log(A) z ~= |z|^2 sum_i V[0,i]^2 log(theta_i).
+
+    Pass a seeded rng to reuse the same probes across calls, so that
+    estimates for different models are directly comparable.
+    """
+    rng = np.random if rng is None else rng
+    est = 0.0
+    for i in range(n_probes):
+        z = np.sign(rng.rand(n) - .5)
+        Q, T = lanczos(matvec, z, n_steps)
+        theta, V = np.linalg.eigh(T)
+        est += n * np.dot(V[0, :]**2, np.log(theta))
+    return est / n_probes
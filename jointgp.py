@@ -11,87 +11,200 @@ import hashlib
 import types
 import marshal
 
+from cover_tree import VectorTree
+from gp import sort_morton, cov_max_distance
+
+
+class JointGP(object):
+
+    def __init__(self, Xs, ys, covs, noise_vars,
+                 cross_covs=None,
+                 y_obs_variances=None,
+                 ymeans=None,
+                 sparse_threshold=1e-8,
+                 sort_events=True,
+                 compute_ll=False):
+        """
+        Joint GP over several correlated processes. Process p has training
+        inputs Xs[p], observations ys[p], covariance covs[p] (a GPCov) and
+        observation noise noise_vars[p].
+
+        cross_covs maps a pair (p, q), p < q, to a GPCov giving the
+        cross-covariance between the latent functions of processes p and
+        q. Pairs not listed are independent, so their block of the joint
+        covariance is empty. It is up to the caller to choose
+        cross-covariances that keep the joint covariance positive definite
+        (e.g. scaled copies of a kernel shared by both processes).
+
+        The joint training covariance is assembled as a block-sparse
+        matrix and factored once with CHOLMOD. Training points are stored
+        process by process, so the alphas for a single process are
+        contiguous.
+        """
+
+        self.n_procs = len(Xs)
+        self.covs = covs
+        self.cross_covs = dict() if cross_covs is None else dict(cross_covs)
+        self.noise_vars = np.array(noise_vars, dtype=float)
+        self.sparse_threshold = sparse_threshold
+        self.ymeans = np.zeros((self.n_procs,)) if ymeans is None else np.array(ymeans, dtype=float)
+
+        self.Xs, self.ys, self.training_obs_variances = [], [], []
+        for p in range(self.n_procs):
+            X, y = Xs[p], ys[p]
+            v = None if y_obs_variances is None else y_obs_variances[p]
+            if sort_events:
+                X, y, v = sort_morton(X, y, v)
+            self.Xs.append(np.array(X, dtype=float))
+            self.ys.append(np.array(y, dtype=float) - self.ymeans[p])
+            self.training_obs_variances.append(None if v is None else np.array(v, dtype=float).flatten())
+
+        self.ns = np.array([X.shape[0] for X in self.Xs], dtype=int)
+        self.offsets = np.concatenate([[0,], np.cumsum(self.ns)])
+        self.n = self.offsets[-1]
+
+        # trees[(p, q)] is built on the training points of process q,
+        # using the covariance between processes p and q.
+        self.trees = dict()
+        for p in range(self.n_procs):
+            self.trees[(p,p)] = VectorTree(self.Xs[p], 1, *self.covs[p].tree_params())
+
+        self.timings = dict()
+        t0 = time.time()
+        self.K = self.sparse_cov_matrix()
+        t1 = time.time()
+        self.timings['build_K'] = t1-t0
+
+        self.factor = scikits.sparse.cholmod.cholesky(self.K)
+        t2 = time.time()
+        self.timings['chol_factor'] = t2-t1
+
+        self.alpha = np.reshape(np.asarray(self.factor(np.concatenate(self.ys))), (-1,))
+        self.alphas = [self.alpha[self.offsets[p]:self.offsets[p+1]] for p in range(self.n_procs)]
+        self.timings['solve_alpha'] = time.time()-t2
+
+        if compute_ll:
+            ld2_K = np.log(self.factor.L().diagonal()).sum()
+            self.ll = -.5 * (np.dot(np.concatenate(self.ys), self.alpha) + self.n * np.log(2*np.pi)) - ld2_K
+        else:
+            self.ll = -np.inf
 
-class JointGP():
-
-    def __init__(self):
-
-        self.K = sparse_cov_matrix()
-        self.alphas = alphas() # make sure to set this up in row/col order such that the alphas for a single process are contiguous
-        self.training_obs_variances = variances()
-
-        self.tree = build_tree()
-        self.sparse_threshold = 1e-8
-        self.cov_main = cov_main
-        self.noise_var = 0.5
-
-    def sparse_kernel(self, X, tree=None, max_distance=None):
-        predict_tree = self.tree if tree is None else tree
+    def standardize_input_array(self, c, **kwargs):
+        assert(len(c.shape) == 2)
+        return c
 
-        if max_distance is None:
-            if self.cov_main.wfn_str=="se" and self.sparse_threshold>0:
-                max_distance = np.sqrt(-np.log(self.sparse_threshold))
-            elif self.cov_main.wfn_str.startswith("compact"):
-                max_distance = 1.0
-            else:
-                max_distance = 1e300
+    def pair_cov(self, p, q):
+        if p == q:
+            return self.covs[p]
+        return self.cross_covs.get((min(p,q), max(p,q)), None)
 
+    def tree(self, p, q):
+        # tree over the training points of process q, weighted by the
+        # (cross-)covariance between p and q. Returns None if the two
+        # processes are independent.
+        try:
+            return self.trees[(p,q)]
+        except KeyError:
+            cov = self.pair_cov(p, q)
+            t = None if cov is None else VectorTree(self.Xs[q], 1, *cov.tree_params())
+            self.trees[(p,q)] = t
+            return t
+
+    def max_distance(self, cov):
+        return cov_max_distance(cov, self.sparse_threshold)
+
+    def sparse_kernel(self, X, p, q):
+        # sparse kernel between the points X (from process p) and the
+        # training points of process q, as a len(X) x n_q matrix.
+        tree = self.tree(p, q)
+        if tree is None:
+            return scipy.sparse.coo_matrix((len(X), self.ns[q]), dtype=float)
+
+        max_distance = self.max_distance(self.pair_cov(p, q))
         entries = tree.sparse_training_kernel_matrix(X, max_distance, False)
-        spK = scipy.sparse.coo_matrix((entries[:,2], (entries[:,1], entries[:,0])), shape=(self.n, len(X)), dtype=float)
+        spK = scipy.sparse.coo_matrix((entries[:,2], (entries[:,0], entries[:,1])), shape=(len(X), self.ns[q]), dtype=float)
         return spK
 
-    def get_query_K_sparse(self, X1):
+    def sparse_cov_matrix(self):
+        blocks = [[None,] * self.n_procs for p in range(self.n_procs)]
+        for p in range(self.n_procs):
+            for q in range(p, self.n_procs):
+                if p != q and self.pair_cov(p, q) is None:
+                    continue
+                B = self.sparse_kernel(self.Xs[p], p, q)
+                if p == q:
+                    d = self.noise_vars[p] * np.ones((self.ns[p],))
+                    if self.training_obs_variances[p] is not None:
+                        d += self.training_obs_variances[p]
+                    B = B + scipy.sparse.dia_matrix((d, 0), shape=B.shape)
+                    blocks[p][p] = B
+                else:
+                    blocks[p][q] = B
+                    blocks[q][p] = B.T
+
+        for p in range(self.n_procs):
+            # bmat needs at least one block in each row/column to infer sizes
+            if blocks[p][p] is None:
+                blocks[p][p] = scipy.sparse.coo_matrix((self.ns[p], self.ns[p]))
+        return scipy.sparse.bmat(blocks).tocsc()
+
+    def kernel(self, idx, X1, X2, identical=False):
+        K = self.trees[(idx, idx)].kernel_matrix(X1, X2, False)
+        if identical:
+            K += self.noise_vars[idx] * np.eye(K.shape[0])
+        return K
+
+    def get_query_K_sparse(self, idx, X1):
         # avoid recomputing the kernel if we're evaluating at the same
         # point multiple times. This is effectively a size-1 cache.
         try:
             self.querysp_hsh
         except AttributeError:
             self.querysp_hsh = None
-        hsh = hashlib.sha1(X1.view(np.uint8)).hexdigest()
+        hsh = hashlib.sha1(X1.view(np.uint8)).hexdigest() + str(idx)
         if hsh != self.querysp_hsh:
-            self.querysp_K = self.sparse_kernel(X1)
+            # stack the kernels against every process, giving an n x m
+            # matrix in the row order of the joint covariance.
+            self.querysp_K = scipy.sparse.vstack([self.sparse_kernel(X1, idx, q).T for q in range(self.n_procs)]).tocsc()
             self.querysp_hsh = hsh
         return self.querysp_K
 
     def predict(self, idx, cond, parametric_only=False):
-        pass
+        X1 = self.standardize_input_array(cond).astype(np.float)
+
+        if parametric_only:
+            gp_pred = np.zeros((X1.shape[0],))
+        else:
+            Kstar = self.get_query_K_sparse(idx, X1)
+            gp_pred = np.reshape(np.asarray(Kstar.T * self.alpha), (-1,))
 
-    def covariance(self, cond, include_obs=False, pad=1e-8):
-        X1 = self.standardize_input_array(cond)
+        if len(gp_pred) == 1:
+            gp_pred = gp_pred[0]
+
+        gp_pred += self.ymeans[idx]
+        return gp_pred
+
+    def covariance(self, idx, cond, include_obs=False, parametric_only=False, pad=1e-8):
+        X1 = self.standardize_input_array(cond).astype(np.float)
         m = X1.shape[0]
 
-        Kstar = self.get_query_K_sparse(X1)
+        Kstar = self.get_query_K_sparse(idx, X1)
         if not parametric_only:
-            gp_cov = self.kernel(X1,X1, identical=include_obs)
+            gp_cov = self.kernel(idx, X1, X1, identical=include_obs)
             if self.n > 0:
 
                 f = self.factor(Kstar)
                 qf = (Kstar.T * f).todense()
-
-                """
-                # alternate form using solve_L
-                P = factor.P()
-                kp = kstar[P]
-                flp = factor.solve_L(kp)
-                newdata = flp.data / factor.D()[flp.nonzero()[0]]
-                flp2 = flp.copy()
-                flp.data = newdata
-                qf = (flp2.T * flp).todense()
-                """
-
                 gp_cov -= qf
         else:
             gp_cov = np.zeros((m,m))
 
-        if self.n_features > 0:
-            R = self.querysp_R
-            tmp = np.dot(self.invc, R)
-            mean_cov = np.dot(tmp.T, tmp)
-            gp_cov += mean_cov
-
         gp_cov += pad * np.eye(gp_cov.shape[0])
 
-        if self.predict_tree_fic is not None:
-            gp_cov += np.diag(self.covariance_diag_correction(X1))
-
         return gp_cov
+
+    def variance(self, idx, cond, **kwargs):
+        return np.diag(self.covariance(idx, cond, **kwargs))
+
+    def log_likelihood(self):
+        return self.ll
@@ -0,0 +1,148 @@
+import time
+import json
+import functools
+import numpy as np
+import collections
+
+
+class NullPhase(object):
+    # stands in for a Phase when profiling is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_PHASE = NullPhase()
+
+
+class Phase(object):
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.wall0 = time.time()
+        self.cpu0 = time.clock()
+        return self
+
+    def __exit__(self, *args):
+        self.stats.record(self.name, time.time() - self.wall0, time.clock() - self.cpu0)
+        return False
+
+
+class GPStats(object):
+
+    def __init__(self, enabled=True):
+        """
+        Profiling record for a single GP. Each phase (kernel build,
+        factorization, tree build, a query method, ...) accumulates the
+        wall and CPU time of every call, and named counters (e.g. the
+        number of tree terms evaluated by each query) accumulate one
+        value per observation. summary() aggregates these into totals
+        and histograms.
+
+        When disabled, phase() returns a shared no-op context and
+        nothing is recorded, so instrumented code pays only for the
+        enabled check.
+        """
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.wall = collections.defaultdict(list)
+        self.cpu = collections.defaultdict(list)
+        self.counters = collections.defaultdict(list)
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def record(self, name, wall, cpu=np.nan):
+        if not self.enabled:
+            return
+        self.wall[name].append(wall)
+        self.cpu[name].append(cpu)
+
+    def count(self, name, value):
+        if not self.enabled:
+            return
+        self.counters[name].append(value)
+
+    def count_attrs(self, prefix, obj, attrs):
+        # record the current value of each of obj's attributes (e.g.
+        # the per-query counters of a tree) as prefix.attr
+        if not self.enabled:
+            return
+        for a in attrs:
+            self.counters["%s.%s" % (prefix, a)].append(getattr(obj, a))
+
+    def summary(self, bins=10):
+        """
+        Dict with an entry for every phase and counter. Phases report
+        the call count, total and mean wall and CPU seconds, the median
+        and 99th percentile wall time, and a histogram of per-call wall
+        times; counters report the number of observations, total,
+        mean, min, max, and a histogram.
+        Histograms are (counts, bin edges) lists.
+        """
+        def hist(v):
+            counts, edges = np.histogram(v, bins=bins)
+            return [[int(c) for c in counts], [float(e) for e in edges]]
+
+        phases = dict()
+        for name, w in self.wall.items():
+            w, c = np.array(w), np.array(self.cpu[name])
+            phases[name] = {"calls": len(w),
+                            "wall_total": float(np.sum(w)),
+                            "wall_mean": float(np.mean(w)),
+                            "cpu_total": float(np.sum(c)),
+                            "cpu_mean": float(np.mean(c)),
+                            "wall_p50": float(np.percentile(w, 50)),
+                            "wall_p99": float(np.percentile(w, 99)),
+                            "wall_hist": hist(w)}
+
+        counters = dict()
+        for name, v in self.counters.items():
+            v = np.array(v, dtype=float)
+            counters[name] = {"n": len(v),
+                              "total": float(np.sum(v)),
+                              "mean": float(np.mean(v)),
+                              "min": float(np.min(v)),
+                              "max": float(np.max(v)),
+                              "hist": hist(v)}
+
+        return {"phases": phases, "counters": counters}
+
+    def export(self, fname=None, bins=10):
+        # the summary as a JSON string, also written to fname if given
+        s = json.dumps(self.summary(bins=bins), indent=2, sort_keys=True)
+        if fname is not None:
+            with open(fname, 'w') as f:
+                f.write(s)
+        return s
+
+    def __repr__(self):
+        if not self.enabled:
+            return "GPStats(disabled)"
+        summary = self.summary()
+        lines = ["%-32s %6d calls %10.4fs wall %10.4fs cpu" % (name, p["calls"], p["wall_total"], p["cpu_total"])
+                 for (name, p) in sorted(summary["phases"].items())]
+        lines += ["%-32s %6d obs   mean %10.1f max %10.1f" % (name, c["n"], c["mean"], c["max"])
+                  for (name, c) in sorted(summary["counters"].items())]
+        return "\n".join(lines)
+
+
+def profiled(f):
+    # method decorator: time every call as a phase named after the
+    # method, in the owning object's stats.
+    name = f.__name__
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        if not self.stats.enabled:
+            return f(self, *args, **kwargs)
+        with Phase(self.stats, name):
+            return f(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,184 @@
+import time
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+from gp import GP
+from profiling import GPStats
+
+
+class PendingLoad(object):
+    # a load in progress, which other threads can wait on
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+        self.waiters = 0
+
+
+class ModelRegistry(object):
+
+    def __init__(self, fnames=None, resolve=None, memory_budget=2**30, n_workers=2, build_tree=True, build_dense_Kinv_hack=False, **load_kwargs):
+        """
+        Trained GPs keyed by name, loaded on first use. The file for a
+        name comes from fnames (a dict, see also register()), or failing
+        that from resolve(name), e.g. a function building the path from
+        a station/phase/attribute key.
+
+        Models are loaded without trees; the trees are built the first
+        time a model is requested with get(name, build_tree=True).
+        Loaded models are kept in least-recently-used order, and the
+        least recently used are evicted whenever the total of their
+        memory_report() sizes exceeds memory_budget bytes (the most
+        recent model is always kept, even if it's over budget alone).
+
+        prefetch() loads models on a pool of n_workers background
+        threads. A failed load raises its exception in every thread
+        waiting for it; a failed prefetch that nobody was waiting for
+        is raised by the next request for that model. Hits, misses,
+        evictions, load errors and load/tree build times are recorded
+        in self.stats; see summary().
+        """
+        self.fnames = dict() if fnames is None else dict(fnames)
+        self.resolve = resolve
+        self.memory_budget = memory_budget
+        self.build_tree = build_tree
+        self.build_dense_Kinv_hack = build_dense_Kinv_hack
+        self.load_kwargs = load_kwargs
+
+        self.models = collections.OrderedDict()
+        self.sizes = dict()
+        self.loading = dict()
+        self.failed = dict()
+        self.lock = threading.RLock()
+        self.tree_lock = threading.Lock()
+        self.pool = ThreadPool(n_workers)
+        self.stats = GPStats()
+        self.hits, self.misses, self.evictions, self.load_errors = 0, 0, 0, 0
+
+    def register(self, name, fname):
+        with self.lock:
+            self.fnames[name] = fname
+
+    def fname(self, name):
+        try:
+            return self.fnames[name]
+        except KeyError:
+            if self.resolve is None:
+                raise KeyError("no model registered as %s" % (name,))
+            return self.resolve(name)
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.models
+
+    def __len__(self):
+        with self.lock:
+            return len(self.models)
+
+    def memory_used(self):
+        with self.lock:
+            return sum(self.sizes.values())
+
+    def get(self, name, build_tree=None):
+        """
+        The model called name, loading it if necessary. With build_tree
+        (default: the registry's setting), the model's trees are built
+        if they haven't been already.
+        """
+        build_tree = self.build_tree if build_tree is None else build_tree
+        gp = self.load(name, count=True)
+        if build_tree and gp.double_tree is None:
+            # one build at a time, so a model's trees are never built
+            # twice; lookups of resident models aren't blocked meanwhile.
+            with self.tree_lock:
+                if gp.double_tree is None:
+                    with self.stats.phase('build_tree'):
+                        gp.build_point_tree(HKinv=gp.HKinv, Kinv=gp.Kinv, alpha_r=gp.alpha_r, leaf_bin_width=0, build_dense_Kinv_hack=self.build_dense_Kinv_hack)
+            with self.lock:
+                if name in self.models:
+                    self.sizes[name] = gp.memory_report()['total']
+                    self.evict_to_budget()
+        return gp
+
+    def load(self, name, count=False, keep_error=False):
+        # returns the model, loading it if it isn't resident. If another
+        # thread is already loading it, waits for that load instead, and
+        # raises its exception if it fails. With keep_error, a failure
+        # nobody was waiting for is also raised by the next request.
+        while True:
+            with self.lock:
+                if name in self.models:
+                    self.models[name] = self.models.pop(name)
+                    if count:
+                        self.hits += 1
+                    return self.models[name]
+                if name in self.failed:
+                    raise self.failed.pop(name)
+                pending = self.loading.get(name, None)
+                if pending is None:
+                    pending = PendingLoad()
+                    self.loading[name] = pending
+                    if count:
+                        self.misses += 1
+                    break
+                pending.waiters += 1
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+
+        try:
+            fname = self.fname(name)
+            t0 = time.time()
+            gp = GP(fname=fname, build_tree=False, **self.load_kwargs)
+            self.stats.record('load', time.time() - t0)
+            size = gp.memory_report()['total']
+            with self.lock:
+                self.models[name] = gp
+                self.sizes[name] = size
+                self.evict_to_budget()
+        except Exception as e:
+            pending.error = e
+            with self.lock:
+                self.load_errors += 1
+                if keep_error and pending.waiters == 0:
+                    self.failed[name] = e
+            raise
+        finally:
+            with self.lock:
+                del self.loading[name]
+            pending.done.set()
+        return gp
+
+    def prefetch(self, names):
+        # load models in the background, without counting hits or misses
+        for name in names:
+            # the pool drops exceptions, so the load keeps its own
+            self.pool.apply_async(self.load, (name,), {'keep_error': True})
+
+    def evict(self, name):
+        with self.lock:
+            if name in self.models:
+                del self.models[name]
+                del self.sizes[name]
+                self.evictions += 1
+
+    def evict_to_budget(self):
+        with self.lock:
+            while len(self.models) > 1 and sum(self.sizes.values()) > self.memory_budget:
+                self.evict(next(iter(self.models)))
+
+    def summary(self):
+        with self.lock:
+            d = {"models": len(self.models),
+                 "memory_used": sum(self.sizes.values()),
+                 "memory_budget": self.memory_budget,
+                 "hits": self.hits,
+                 "misses": self.misses,
+                 "evictions": self.evictions,
+                 "load_errors": self.load_errors}
+        d.update(self.stats.summary())
+        return d
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,254 @@
+import time
+import json
+import Queue
+import threading
+import urllib2
+import BaseHTTPServer
+import SocketServer
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+from gp import GP
+from profiling import GPStats
+
+
+class PendingQuery(object):
+
+    def __init__(self, x, variance, include_obs):
+        self.x = np.asarray(x, dtype=float).flatten()
+        self.variance = variance
+        self.include_obs = include_obs
+        self.t0 = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise RuntimeError("query timed out after %.3fs" % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Batcher(object):
+
+    def __init__(self, gp, pool, stats, max_batch=256, max_wait=0.002):
+        """
+        Collects single-point queries against one GP into batches: a
+        batch is dispatched to the worker pool once it has max_batch
+        points, or max_wait seconds after its first query arrived. Each
+        batch is a single vectorized call (batch_query, or predict if
+        no query in the batch needs a variance). Models loaded with
+        mean_only=True always use predict, and answer every query with
+        a variance of None.
+
+        GP queries aren't thread-safe (the trees keep per-query state),
+        so batches for the same model run one at a time.
+        """
+        self.gp = gp
+        self.pool = pool
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+
+        self.collector = threading.Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def submit(self, x, variance=True, include_obs=False):
+        q = PendingQuery(x, variance, include_obs)
+        self.queue.put(q)
+        return q
+
+    def close(self):
+        self.queue.put(None)
+
+    def collect(self):
+        while True:
+            q = self.queue.get()
+            if q is None:
+                return
+            batch = [q,]
+            deadline = q.t0 + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    q = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if q is None:
+                    # finish this batch, then stop
+                    self.queue.put(None)
+                    break
+                batch.append(q)
+            self.pool.apply_async(self.run, (batch,))
+
+    def run(self, batch):
+        m = len(batch)
+        try:
+            X = np.array([q.x for q in batch])
+            with self.lock:
+                if any([q.variance for q in batch]) and not self.gp.mean_only:
+                    # include_obs only adds the noise variance, so one
+                    # call serves both kinds of query.
+                    Kstar, H, var = self.gp.batch_query(X, include_obs=False)
+                    mean = self.gp.batch_mean(Kstar, H, m)
+                else:
+                    mean = np.reshape(self.gp.predict(X), (-1,))
+                    var = None
+        except Exception as e:
+            for q in batch:
+                q.error = e
+                q.done.set()
+            return
+
+        t = time.time()
+        self.stats.count('batch_size', m)
+        for (i, q) in enumerate(batch):
+            v = None
+            if q.variance and var is not None:
+                v = float(var[i]) + (self.gp.noise_var if q.include_obs else 0.0)
+            q.result = (float(mean[i]), v)
+            q.done.set()
+            self.stats.record('query', t - q.t0)
+
+
+class ModelServer(object):
+
+    def __init__(self, models, n_workers=4, max_batch=256, max_wait=0.002, build_tree=True):
+        """
+        Serves predictions from several trained GPs. models maps a
+        model name to a GP, or to a file saved by save_trained_model
+        (loaded with the given build_tree). Queries for each model are
+        coalesced into batches (see Batcher), which run on a shared pool
+        of n_workers threads.
+
+        Latencies (from submission to result) and batch sizes are
+        recorded in self.stats, as the 'query' phase and the
+        'batch_size' counter.
+        """
+        self.pool = ThreadPool(n_workers)
+        self.stats = GPStats()
+        self.batchers = dict()
+        for (name, model) in models.items():
+            gp = model if isinstance(model, GP) else GP(fname=model, build_tree=build_tree)
+            self.batchers[name] = Batcher(gp, self.pool, self.stats, max_batch=max_batch, max_wait=max_wait)
+
+    def submit(self, name, x, variance=True, include_obs=False):
+        try:
+            batcher = self.batchers[name]
+        except KeyError:
+            raise ValueError("unknown model %s" % name)
+        return batcher.submit(x, variance=variance, include_obs=include_obs)
+
+    def query(self, name, x, variance=True, include_obs=False, timeout=None):
+        # returns (mean, variance) at the point x; variance is None
+        # unless requested.
+        return self.submit(name, x, variance=variance, include_obs=include_obs).wait(timeout)
+
+    def summary(self):
+        return self.stats.summary()
+
+    def serve_http(self, host="localhost", port=0):
+        # returns the (not yet running) server; its port is
+        # server.server_address[1].
+        server = ThreadedHTTPServer((host, port), QueryHandler)
+        server.model_server = self
+        return server
+
+    def close(self):
+        for batcher in self.batchers.values():
+            batcher.close()
+        self.pool.close()
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST /query with a JSON object {"model": name, "x": [...],
+    "variance": true, "include_obs": false} returns {"mean": ...,
+    "variance": ...}. GET /stats returns the server's stats summary.
+    """
+
+    def send_json(self, code, d):
+        body = json.dumps(d)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != "/query":
+            self.send_json(404, {"error": "unknown path %s" % self.path})
+            return
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.getheader('content-length'))))
+            mean, var = self.server.model_server.query(req['model'], req['x'],
+                                                       variance=req.get('variance', True),
+                                                       include_obs=req.get('include_obs', False))
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, {"mean": mean, "variance": var})
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.send_json(404, {"error": "unknown path %s" % self.path})
+            return
+        self.send_json(200, self.server.model_server.summary())
+
+    def log_message(self, *args):
+        pass
+
+
+class Client(object):
+
+    def __init__(self, host="localhost", port=8000):
+        self.url = "http://%s:%d" % (host, port)
+
+    def query(self, model, x, variance=True, include_obs=False):
+        req = json.dumps({"model": model, "x": list(np.asarray(x, dtype=float).flatten()),
+                          "variance": variance, "include_obs": include_obs})
+        r = json.loads(urllib2.urlopen(self.url + "/query", req).read())
+        return r['mean'], r['variance']
+
+    def stats(self):
+        return json.loads(urllib2.urlopen(self.url + "/stats").read())
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] name=model_file [name=model_file ...]")
+    parser.add_option("--host", dest="host", default="localhost", type="str", help="interface to listen on (localhost)")
+    parser.add_option("--port", dest="port", default=8000, type="int", help="port to listen on (8000)")
+    parser.add_option("--workers", dest="workers", default=4, type="int", help="worker threads (4)")
+    parser.add_option("--max_batch", dest="max_batch", default=256, type="int", help="largest batch of queries (256)")
+    parser.add_option("--max_wait", dest="max_wait", default=0.002, type="float", help="seconds to wait for a batch to fill (0.002)")
+    parser.add_option("--no_tree", dest="build_tree", default=True, action="store_false", help="don't build trees on load")
+    (options, args) = parser.parse_args()
+
+    models = dict([a.split("=", 1) for a in args])
+    ms = ModelServer(models, n_workers=options.workers, max_batch=options.max_batch,
+                     max_wait=options.max_wait, build_tree=options.build_tree)
+    server = ms.serve_http(options.host, options.port)
+    print "serving %d models on %s:%d" % (len(models), options.host, server.server_address[1])
+    try:
+        server.serve_forever()
+    finally:
+        ms.close()
+
+if __name__ == "__main__":
+    main()
@@ -18,13 +18,15 @@ print sys_includes
 print sys_libraries
 
 #extra_compile_args = ['-g', '-pg', '-O0']
-extra_compile_args = ['-O3']
+extra_compile_args = ['-O3', '-fopenmp']
 
 # extra_compile_args += [ '--stdlib=libc++'] # uncomment this for OSX/clang
 
 #extra_link_args = ['-Wl,--strip-all']
 #extra_link_args = ['-lrt',]
-extra_link_args = []
+extra_link_args = ['-fopenmp']
+# OpenMP parallelizes sparse_fic_trace; drop -fopenmp from both lists
+# for compilers without it (the code then runs serially).
 
 ctree_root = 'src_c'
 ctree_sources = ['cover_tree_point.cc', 'cover_tree_pp_debug.cc', 'distances.cc', 'vector_mult_py.cc', 'quadratic_form_py.cc', 'compile_product_tree.cc']
@@ -37,7 +39,7 @@ covertree_module = ctree = Extension('cover_tree',
                                      include_dirs=CTREE_INCLUDE_DIRS,
                                      library_dirs=['/'],
                                      #library_dirs=['/home/dmoore/.virtualenvs/sigvisa-dbg/lib/', '/'],
-                                     libraries=['boost_python'],
+                                     libraries=['boost_python', 'blas'],
                                      extra_compile_args=extra_compile_args,
                                      extra_link_args = extra_link_args,
                                  )
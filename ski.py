@@ -0,0 +1,98 @@
+import itertools
+import numpy as np
+import scipy.sparse
+
+from cover_tree import VectorTree
+
+
+def cubic_interp_kernel(s):
+    # Keys' cubic convolution kernel (a = -0.5), supported on |s| < 2
+    s = np.abs(s)
+    w = np.zeros(s.shape)
+    near = s <= 1
+    far = (s > 1) & (s < 2)
+    w[near] = 1.5 * s[near]**3 - 2.5 * s[near]**2 + 1
+    w[far] = -0.5 * s[far]**3 + 2.5 * s[far]**2 - 4 * s[far] + 2
+    return w
+
+
+class SKIGrid(object):
+
+    def __init__(self, X, cov, grid_size, pad=2, bounds=None):
+        """
+        Regular grid of inducing points for structured kernel
+        interpolation (KISS-GP): k(x, x') is approximated by
+        w_x^T K_UU w_x', where w_x holds local cubic interpolation
+        weights (4^D nonzeros) from x to the grid.
+
+        grid_size is the number of grid points per dimension (an int,
+        or one per dimension). The grid covers bounds, a (lo, hi) pair
+        of corners, or by default the bounding box of X, with pad extra
+        cells on each side so that points inside are interpolated from
+        interior cells. Predictions much further out revert to the
+        prior, so bounds should include the region to be queried.
+
+        For a stationary kernel on a regular grid, K_UU is
+        block-Toeplitz with Toeplitz blocks (Kronecker, for separable
+        kernels), so we multiply by it in O(M log M) time using FFTs of
+        a circulant embedding, and never form it.
+        """
+        if cov.dfn_str != "euclidean":
+            # the FFT embedding needs a kernel of x - x' alone
+            raise ValueError("ski_grid requires a euclidean distance, not %s" % cov.dfn_str)
+        X = np.asarray(X, dtype=float)
+        D = X.shape[1]
+        self.shape = tuple(int(m) for m in np.broadcast_to(grid_size, (D,)))
+        if min(self.shape) < 2*pad + 2:
+            raise ValueError("grid needs at least %d points per dimension, got %s" % (2*pad + 2, self.shape))
+        self.M = int(np.prod(self.shape))
+
+        if bounds is None:
+            lo, hi = np.min(X, axis=0), np.max(X, axis=0)
+        else:
+            lo, hi = np.asarray(bounds[0], dtype=float), np.asarray(bounds[1], dtype=float)
+        width = np.where(hi > lo, hi - lo, 1.0)
+        self.h = width / (np.array(self.shape) - 1 - 2*pad)
+        self.lo = lo - pad * self.h
+
+        # kernel between the grid origin and every offset (with
+        # wraparound) on a grid of twice the size: the first column of
+        # a circulant matrix containing K_UU as a block.
+        self.embed_shape = tuple(2*m for m in self.shape)
+        offsets = []
+        for (m, h) in zip(self.shape, self.h):
+            o = np.arange(2*m)
+            o[o >= m] -= 2*m
+            offsets.append(o * h)
+        P = np.array([g.flatten() for g in np.meshgrid(*offsets, indexing='ij')]).T
+        tree = VectorTree(np.zeros((1, D)), 1, *cov.tree_params())
+        k0 = tree.kernel_matrix(P, np.zeros((1, D)), False)
+        self.kernel_fft = np.fft.rfftn(np.reshape(k0, self.embed_shape))
+
+    def kuu_dot(self, v):
+        # K_UU v, for a vector over the (flattened) grid
+        V = np.zeros(self.embed_shape)
+        V[tuple(slice(0, m) for m in self.shape)] = np.reshape(v, self.shape)
+        KV = np.fft.irfftn(np.fft.rfftn(V) * self.kernel_fft, s=self.embed_shape)
+        return KV[tuple(slice(0, m) for m in self.shape)].flatten()
+
+    def interp_weights(self, X):
+        # sparse n x M matrix W of interpolation weights. Points
+        # outside the grid lose the weights that fall off its edge, so
+        # far-away predictions revert to the prior.
+        X = np.asarray(X, dtype=float)
+        n, D = X.shape
+        T = (X - self.lo) / self.h
+        base = np.floor(T).astype(int) - 1
+
+        rows, cols, vals = [], [], []
+        for offset in itertools.product(range(4), repeat=D):
+            idx = base + np.array(offset)
+            w = np.prod(cubic_interp_kernel(T - idx), axis=1)
+            valid = np.all((idx >= 0) & (idx < np.array(self.shape)), axis=1) & (w != 0)
+            rows.append(np.arange(n)[valid])
+            cols.append(np.ravel_multi_index(idx[valid].T, self.shape))
+            vals.append(w[valid])
+
+        W = scipy.sparse.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(n, self.M))
+        return W.tocsr()
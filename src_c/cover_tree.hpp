@@ -154,6 +154,10 @@ void epsilon_nearest_neighbor(const node<point> &top_node, const node<point> &qu
 			      v_array<v_array<point> > &results, double epsilon,
 			      distfn<point>::Type distance,
 			      const double* dist_params, void* dist_extra);
+void k_nearest_neighbor(const node<point> &top_node, const node<point> &query,
+			v_array<v_array<point> > &results, int k,
+			distfn<point>::Type distance,
+			const double* dist_params, void* dist_extra);
 void k_nearest_neighbor(const node<pairpoint> &top_node, const node<pairpoint> &query,
 			v_array<v_array< node<pairpoint> > > &results, int k,
 			distfn<pairpoint>::Type distance,
@@ -217,6 +221,24 @@ void set_leaves(node<T> &n, node<T> * parent) {
   }
 }
 
+// bytes allocated below a node: children arrays, per-arm sums and
+// collapsed leaf bins. Points refer to the caller's data, so they
+// aren't counted.
+template<class T>
+unsigned long node_memory_bytes(const node<T> &n) {
+  unsigned long bytes = n.num_children * sizeof(node<T>);
+  if (n.narms > 1) {
+    bytes += 2 * n.narms * sizeof(double);
+  }
+  if (n.n_extra_p > 0) {
+    bytes += n.n_extra_p * sizeof(T) + n.narms * (sizeof(double *) + n.n_extra_p * sizeof(double));
+  }
+  for(unsigned int i=0; i < n.num_children; ++i) {
+    bytes += node_memory_bytes(n.children[i]);
+  }
+  return bytes;
+}
+
 template <class T>
 struct ds_node {
   v_array<double> dist;
@@ -5,24 +5,19 @@
  #include <memory>
  #include <vector>
  #include <limits>
+ #include <sys/time.h>
  #include <google/dense_hash_map>
  using google::dense_hash_map;
 
  using namespace std;
  namespace bp = boost::python;
 
-/*
- double gt(void)
- {
-   struct timespec tv;
-
-   if(clock_gettime(CLOCK_REALTIME, &tv) != 0) return 0;
-
-   return (((double) tv.tv_sec) + (double) (tv.tv_nsec / 1000000000.0));
- }
-*/
+// wall-clock time in seconds. gettimeofday rather than clock_gettime,
+// which needs -lrt on older glibc.
 double gt(void) {
-  return 1000.0;
+  struct timeval tv;
+  gettimeofday(&tv, NULL);
+  return ((double) tv.tv_sec) + ((double) tv.tv_usec) / 1000000.0;
 }
 
  double first_half_d_query_cached(const pairpoint &p1, const pairpoint &p2, double BOUND_IGNORED, const double *params, pair_dfn_extra *p) {
@@ -669,6 +664,127 @@ double MatrixTree::quadratic_form(const pyublas::numpy_matrix<double> &query_pt1
    return ws;
  }
 
+ void accumulate_bounds(double sum, double sum_abs, double min_weight, double max_weight, double scale, double &lower, double &upper) {
+   // split the sum into its positive and negative parts, each of which
+   // is monotone in the weight.
+   double pos = .5 * (sum_abs + sum);
+   double neg = .5 * (sum_abs - sum);
+   lower += scale * (min_weight * pos - max_weight * neg);
+   upper += scale * (max_weight * pos - min_weight * neg);
+ }
+
+ void weighted_sum_bounds_node(node<pairpoint> &n, int v_select,
+			       const pairpoint &query_pt,
+			       double radius, double scale,
+			       double eps_abs, int max_terms,
+			       double &lower, double &upper,
+			       int &nodes_touched, int &dfn_evals, int &wfn_evals,
+			       wfn w_upper, wfn w_lower,
+			       const double* wp_pair,
+			       distfn<pairpoint>::Type dist,
+			       const double * dist_params,
+			       pair_dfn_extra * dist_extra) {
+   // Bound the weighted sum over every query pair within factored
+   // distance radius of query_pt. Pairs under this node are within
+   // max_dist of its center, so the product weight is bracketed by
+   // w_lower/w_upper evaluated at the extremes of the distance range.
+   double d = n.distance_to_query;
+   nodes_touched += 1;
+
+   if (n.n_extra_p > 0) {
+     double * epvals = n.extra_p_vals[v_select];
+     for (unsigned int i=0; i < n.n_extra_p; ++i) {
+       double di = dist(query_pt, n.extra_p[i], std::numeric_limits< double >::max(), dist_params, dist_extra);
+       double min_weight = w_lower(di + radius, wp_pair);
+       double max_weight = w_upper(max(0.0, di - radius), wp_pair);
+       dfn_evals += 2;
+       wfn_evals += 2;
+       accumulate_bounds(epvals[i], fabs(epvals[i]), min_weight, max_weight, scale, lower, upper);
+     }
+     return;
+   }
+
+   double md = (n.num_children == 0) ? 0.0 : n.max_dist;
+   double min_weight = w_lower(d + md + radius, wp_pair);
+   double max_weight = w_upper(max(0.0, d - md - radius), wp_pair);
+   wfn_evals += 2;
+
+   double gap = scale * (max_weight - min_weight) * n.unweighted_sums_abs[v_select];
+   if (n.num_children == 0 || gap <= eps_abs * n.num_leaves / (double)max_terms) {
+     accumulate_bounds(n.unweighted_sums[v_select], n.unweighted_sums_abs[v_select], min_weight, max_weight, scale, lower, upper);
+     return;
+   }
+
+   for(int i=0; i < n.num_children; ++i) {
+     n.children[i].distance_to_query = dist(query_pt, n.children[i].p, std::numeric_limits< double >::max(), dist_params, dist_extra);
+     dfn_evals += 2;
+     weighted_sum_bounds_node(n.children[i], v_select, query_pt, radius, scale,
+			      eps_abs, max_terms, lower, upper,
+			      nodes_touched, dfn_evals, wfn_evals,
+			      w_upper, w_lower, wp_pair,
+			      dist, dist_params, dist_extra);
+   }
+ }
+
+pyublas::numpy_vector<double> MatrixTree::quadratic_form_bounds(const pyublas::numpy_matrix<double> &query_pt, double radius, double eps_abs) {
+   /* Lower and upper bounds on k(x)^T M k(x), simultaneously for every
+      x within distance radius of query_pt. Moving both halves of the
+      query pair by at most radius moves the factored distance by at
+      most 2*radius (l1) or sqrt(2)*radius (l2). */
+   pairpoint qp = {&query_pt(0,0), &query_pt(0,0), 0, 0};
+
+   pair_dfn_extra * p = (pair_dfn_extra *) this->dfn_extra;
+   p->query1_cache = new dense_hash_map<int, double>((int) (10 * log(this->n)));
+   p->query1_cache->set_empty_key(-1);
+   p->query2_cache = p->query1_cache;
+   p->hits = 0;
+   p->misses = 0;
+
+   double pair_radius;
+   if (this->factored_query_dist == factored_query_distance_l2) {
+     pair_radius = sqrt(2.0) * radius;
+   } else {
+     pair_radius = 2.0 * radius;
+   }
+
+   this->nodes_touched = 0;
+   this->terms = 0;
+   this->zeroterms = 0;
+   this->dfn_evals = 2;
+   this->wfn_evals = 0;
+
+   int max_terms = this->root_diag.num_leaves;
+   if (this->use_offdiag) {
+     max_terms += this->root_offdiag.num_leaves;
+   }
+
+   double lower = 0;
+   double upper = 0;
+   this->root_diag.distance_to_query = this->factored_query_dist(qp, this->root_diag.p, std::numeric_limits< double >::max(), this->dist_params, (void*)this->dfn_extra);
+   weighted_sum_bounds_node(this->root_diag, 0, qp, pair_radius, 1.0,
+			    eps_abs, max_terms, lower, upper,
+			    this->nodes_touched, this->dfn_evals, this->wfn_evals,
+			    this->w_upper, this->w_lower, this->wp_pair,
+			    this->factored_query_dist, this->dist_params, this->dfn_extra);
+   if (this->use_offdiag) {
+     // only the upper triangle is stored, so off-diagonal pairs count twice.
+     this->root_offdiag.distance_to_query = this->factored_query_dist(qp, this->root_offdiag.p, std::numeric_limits< double >::max(), this->dist_params, (void*)this->dfn_extra);
+     weighted_sum_bounds_node(this->root_offdiag, 0, qp, pair_radius, 2.0,
+			      eps_abs, max_terms, lower, upper,
+			      this->nodes_touched, this->dfn_evals, this->wfn_evals,
+			      this->w_upper, this->w_lower, this->wp_pair,
+			      this->factored_query_dist, this->dist_params, this->dfn_extra);
+   }
+
+   this->dfn_misses = p->misses;
+   delete p->query1_cache;
+
+   pyublas::numpy_vector<double> bounds(2);
+   bounds(0) = lower;
+   bounds(1) = upper;
+   return bounds;
+ }
+
  void MatrixTree::set_m_sparse(const pyublas::numpy_strided_vector<int> &nonzero_rows,
 			       const pyublas::numpy_strided_vector<int> &nonzero_cols,
 			       const pyublas::numpy_strided_vector<double> &nonzero_vals) {
@@ -870,6 +986,7 @@ void MatrixTree::collapse_leaf_bins(double leaf_bin_width) {
   }
 
   double t1 = gt();
+  this->build_s = t1-t0;
   // printf("built tree in %lfs: %d cache hits and %d cache misses\n", t1-t0, p->hits, p->misses);
   delete p->build_cache;
 }
@@ -927,6 +1044,15 @@ void MatrixTree::test_bounds(double max_d, int n_d) {
 
 }
 
+unsigned long MatrixTree::memory_bytes() {
+  // both trees over the nonzero entries, including collapsed leaf bins
+  unsigned long bytes = sizeof(MatrixTree) + node_memory_bytes(this->root_diag);
+  if (this->use_offdiag) {
+    bytes += node_memory_bytes(this->root_offdiag);
+  }
+  return bytes;
+}
+
 MatrixTree::~MatrixTree() {
   if (this->dist_params != NULL) {
     delete[] this->dist_params;
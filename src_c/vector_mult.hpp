@@ -112,7 +112,19 @@ class VectorTree {
   double * wp;
   double *dist_params;
 
-  google::dense_hash_map<unsigned long, double> *Kinv_for_dense_hack;
+  // Kinv in compressed sparse row format, for the dense hack. Column
+  // indices within each row are sorted so entries can be found by
+  // binary search.
+  std::vector<int> Kinv_indptr;
+  std::vector<int> Kinv_indices;
+  std::vector<double> Kinv_vals;
+  // with single_precision set, the values are kept only as floats
+  std::vector<float> Kinv_vals_f;
+  bool single_precision;
+  double Kinv_val(int pos) const {
+    return this->single_precision ? (double) this->Kinv_vals_f[pos] : this->Kinv_vals[pos];
+  }
+  double Kinv_entry(int i, int j) const;
 
   void set_dist_params(const pyublas::numpy_vector<double> &dist_params);
 
@@ -140,11 +152,14 @@ public:
   pyublas::numpy_vector<double> get_v(int v_select);
 
   double weighted_sum(int v_select, const pyublas::numpy_matrix<double> &query_pt, double eps);
+  pyublas::numpy_vector<double> weighted_sum_bounds(int v_select, const pyublas::numpy_matrix<double> &query_pt, double radius, double eps_abs);
 
 
   pyublas::numpy_matrix<double> kernel_matrix(const pyublas::numpy_matrix<double> &pts1, const pyublas::numpy_matrix<double> &pts2, bool distance_only);
   pyublas::numpy_matrix<double> sparse_training_kernel_matrix(const pyublas::numpy_matrix<double> &pts, double max_distance, bool distance_only);
+  pyublas::numpy_matrix<double> sparse_training_kernel_deriv_wrt_x(const pyublas::numpy_matrix<double> &pts, double max_distance);
   pyublas::numpy_matrix<double> kernel_deriv_wrt_xi(const pyublas::numpy_matrix<double> &pts1, const pyublas::numpy_matrix<double> &pts2, int i, int k);
+  pyublas::numpy_matrix<double> kernel_deriv_wrt_pts1(const pyublas::numpy_matrix<double> &pts1, const pyublas::numpy_matrix<double> &pts2, int k);
   void kernel_deriv_wrt_xi_row(const pyublas::numpy_matrix<double> &pts1, int i, int k, pyublas::numpy_vector<double> K);
   void dist_deriv_wrt_xi_row(const pyublas::numpy_matrix<double> &pts1, const pyublas::numpy_matrix<double> &pts2, int i, int k, pyublas::numpy_vector<double> D);
 
@@ -152,17 +167,23 @@ public:
 
 
   pyublas::numpy_vector<double> sparse_distances(const pyublas::numpy_matrix<double> &pts1, const pyublas::numpy_matrix<double> &pts2, const pyublas::numpy_vector<int> &nzr, const pyublas::numpy_vector<int> &nzc);
+  pyublas::numpy_vector<double> kernel_from_distances(const pyublas::numpy_vector<double> &distance_entries);
+  pyublas::numpy_vector<int> knn(const pyublas::numpy_matrix<double> &query_pts, int k);
   pyublas::numpy_vector<double> sparse_kernel_deriv_wrt_xi(const pyublas::numpy_matrix<double> &pts1, int k, const pyublas::numpy_vector<int> &nzr, const pyublas::numpy_vector<int> &nzc, const pyublas::numpy_vector<double> distance_entries);
   pyublas::numpy_vector<double> sparse_kernel_deriv_wrt_i(const pyublas::numpy_matrix<double> &pts1, const pyublas::numpy_matrix<double> &pts2, const pyublas::numpy_vector<int> &nzr, const pyublas::numpy_vector<int> &nzc, int param_i, const pyublas::numpy_vector<double> distance_entries);
 
   void dump_tree(const std::string &fname);
   void dump_clusters(const std::string &fname, int cluster_size);
 
+  void set_single_precision(bool single_precision);
   void set_Kinv_for_dense_hack(const pyublas::numpy_strided_vector<int> &nonzero_rows,
 			       const pyublas::numpy_strided_vector<int> &nonzero_cols,
 			       const pyublas::numpy_strided_vector<double> &nonzero_vals);
 
   double quadratic_form_from_dense_hack(const pyublas::numpy_matrix<double> &query_pt1, const pyublas::numpy_matrix<double> &query_pt2, double max_distance);
+  pyublas::numpy_matrix<double> quadratic_form_from_dense_hack_batch(const pyublas::numpy_matrix<double> &query_pts, double max_distance);
+
+  unsigned long memory_bytes();
 
 
   ~VectorTree();
@@ -217,6 +238,7 @@ public:
   int wfn_misses;
   int terms;
   int zeroterms;
+  double build_s;
 
   MatrixTree (const pyublas::numpy_matrix<double> &pts,
 	      const pyublas::numpy_strided_vector<int> &nonzero_rows,
@@ -234,6 +256,8 @@ public:
   double quadratic_form(const pyublas::numpy_matrix<double> &query_pt1,
 			const pyublas::numpy_matrix<double> &query_pt2,
 			double eps_rel, double eps_abs, int cutoff_rule);
+  pyublas::numpy_vector<double> quadratic_form_bounds(const pyublas::numpy_matrix<double> &query_pt,
+						      double radius, double eps_abs);
 
   void compile(char *fname, int debug_level);
 
@@ -241,5 +265,7 @@ public:
 
   void test_bounds(double max_d, int n_d);
 
+  unsigned long memory_bytes();
+
   ~MatrixTree();
 };
@@ -14,10 +14,17 @@
 
 #include <sys/time.h>
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 
-#include <google/dense_hash_map>
-using google::dense_hash_map;
+// Fortran BLAS, used for the batched dense-hack quadratic form.
+extern "C" void dgemm_(const char *transa, const char *transb,
+		       const int *m, const int *n, const int *k,
+		       const double *alpha, const double *a, const int *lda,
+		       const double *b, const int *ldb,
+		       const double *beta, double *c, const int *ldc);
 
 
 using namespace std;
@@ -184,6 +191,78 @@ double VectorTree::weighted_sum(int v_select, const pyublas::numpy_matrix<double
   return ws;
 }
 
+void weighted_sum_bounds_node(node<point> &n, int v_select,
+			      const point &query_pt, double radius, double eps_abs,
+			      int max_terms, double &lower, double &upper,
+			      int &nodes_touched, int &dfn_evals, int &wfn_evals,
+			      wfn w,
+			      distfn<point>::Type dist,
+			      const double * dist_params,
+			      void * dist_extra,
+			      const double* weight_params) {
+
+  // Bound the weighted sum over every query point within distance
+  // radius of query_pt. Any point under this node is within
+  // max_dist of its center, so the query-to-point distance lies in
+  // [d - max_dist - radius, d + max_dist + radius], and since the
+  // weight function is decreasing we get an interval of weights.
+  double d = n.distance_to_query;
+  nodes_touched += 1;
+
+  double md = (n.num_children == 0) ? 0.0 : n.max_dist;
+  double min_weight = w(d + md + radius, weight_params);
+  double max_weight = w(max(0.0, d - md - radius), weight_params);
+  wfn_evals += 2;
+
+  double gap = (max_weight - min_weight) * n.unweighted_sums_abs[v_select];
+  if (n.num_children == 0 || gap <= eps_abs * n.num_leaves / (double)max_terms) {
+    // split the sum into its positive and negative parts, each of
+    // which is monotone in the weight.
+    double pos = .5 * (n.unweighted_sums_abs[v_select] + n.unweighted_sums[v_select]);
+    double neg = .5 * (n.unweighted_sums_abs[v_select] - n.unweighted_sums[v_select]);
+    lower += min_weight * pos - max_weight * neg;
+    upper += max_weight * pos - min_weight * neg;
+    return;
+  }
+
+  for(int i=0; i < n.num_children; ++i) {
+    n.children[i].distance_to_query = dist(query_pt, n.children[i].p, std::numeric_limits< double >::max(), dist_params, dist_extra);
+    dfn_evals += 1;
+    weighted_sum_bounds_node(n.children[i], v_select, query_pt, radius, eps_abs,
+			     max_terms, lower, upper,
+			     nodes_touched, dfn_evals, wfn_evals,
+			     w, dist, dist_params, dist_extra, weight_params);
+  }
+}
+
+pyublas::numpy_vector<double> VectorTree::weighted_sum_bounds(int v_select, const pyublas::numpy_matrix<double> &query_pt, double radius, double eps_abs) {
+  point qp = {&query_pt(0,0), 0};
+
+  this->nodes_touched = 0;
+  this->terms = 0;
+  this->dfn_evals = 1;
+  this->wfn_evals = 0;
+
+  pyublas::numpy_vector<double> bounds(2);
+  bounds(0) = 0;
+  bounds(1) = 0;
+  if (this->n == 0) {
+    return bounds;
+  }
+
+  double lower = 0;
+  double upper = 0;
+  this->root.distance_to_query = this->dfn(qp, this->root.p, std::numeric_limits< double >::max(), this->dist_params, this->dfn_extra);
+  weighted_sum_bounds_node(this->root, v_select, qp, radius, eps_abs,
+			   this->root.num_leaves, lower, upper,
+			   this->nodes_touched, this->dfn_evals, this->wfn_evals,
+			   this->w, this->dfn, this->dist_params,
+			   this->dfn_extra, this->wp);
+  bounds(0) = lower;
+  bounds(1) = upper;
+  return bounds;
+}
+
 void dump_clusters_node (node<point> &n, int depth, int cluster_size, FILE * fp) {
   if (n.num_leaves < cluster_size) {
     fprintf(fp, "%f %f %f %d\n", n.p.p[0], n.p.p[1], n.p.p[2], n.num_leaves);
@@ -250,6 +329,7 @@ VectorTree::VectorTree (const pyublas::numpy_matrix<double> &pts,
     points[i] = p;
   }
   this->n = pts.size1();
+  this->single_precision = false;
   this->ddfn_dtheta = NULL;
   this->ddfn_dx = NULL;
   if (distfn_str.compare("lld") == 0) {
@@ -380,8 +460,9 @@ pyublas::numpy_matrix<double> VectorTree::sparse_training_kernel_matrix(const py
     //printf("dfn params %f %f\n", this->dist_params[0], this->dist_params[1]);
     //printf("root is %p and has %d children\n", &this->root, this->root.num_children);
 
-    int min_idx = res[0].index > 1 ? 1 : 0;
-    for(int jj = min_idx; jj < res[0].index; ++jj) {
+    // res[0] lists the query point itself, then its neighbors
+    int n_found = res.index > 0 ? res[0].index : 0;
+    for(int jj = 1; jj < n_found; ++jj) {
       point p2 = res[0][jj];
       int j = p2.idx;
 
@@ -410,6 +491,98 @@ pyublas::numpy_matrix<double> VectorTree::sparse_training_kernel_matrix(const py
   return K;
 }
 
+pyublas::numpy_matrix<double> VectorTree::sparse_training_kernel_deriv_wrt_x(const pyublas::numpy_matrix<double> &pts, double max_distance) {
+  // kernel between each query point and its training neighbors,
+  // along with the gradient of each entry wrt the query point. Each
+  // row is (query idx, training idx, k, dk/dx_0, ..., dk/dx_{D-1}).
+
+  if (this->ddfn_dx == NULL) {
+    printf("ERROR: gradient not implemented for this distance function.\n");
+    exit(1);
+  }
+  if (this->dwfn_dr == NULL) {
+    printf("ERROR: gradient not implemented for this weight function.\n");
+    exit(1);
+  }
+
+  unsigned int D = pts.size2();
+  pyublas::numpy_matrix<double> K(pts.size1()*2, 3 + D);
+
+  unsigned long nzero = 0;
+  for (unsigned i = 0; i < pts.size1 (); ++ i) {
+    v_array<v_array<point> > res;
+    point p1 = {&pts(i, 0), 0};
+
+    node<point> np1;
+    np1.p = p1;
+    np1.max_dist = 0.;
+    np1.parent_dist = 0.;
+    np1.children = NULL;
+    np1.num_children = 0;
+    np1.scale = 100;
+
+    epsilon_nearest_neighbor(this->root,np1,res,max_distance, this->dfn, this->dist_params, this->dfn_extra);
+
+    // res[0] lists the query point itself, then its neighbors. A
+    // point with no training neighbors in range has no entries: its
+    // kernel and gradient are zero.
+    int n_found = res.index > 0 ? res[0].index : 0;
+    for(int jj = 1; jj < n_found; ++jj) {
+      point p2 = res[0][jj];
+      int j = p2.idx;
+
+      double d = this->dfn(p1, p2, std::numeric_limits< double >::max(), this->dist_params, this->dfn_extra);
+
+      if (nzero == K.size1()) {
+	K.resize(K.size1()*2, 3 + D);
+      }
+      K(nzero,0) = i;
+      K(nzero,1) = j;
+      K(nzero,2) = this->w(d, this->wp);
+      for (unsigned k = 0; k < D; ++k) {
+	double dr_dp1 = this->ddfn_dx(p1.p, p2.p, k, d, std::numeric_limits< double >::max(), this->dist_params, this->dfn_extra);
+	K(nzero,3+k) = this->dwfn_dr(d, dr_dp1, this->wp);
+      }
+      nzero++;
+    }
+
+  for (int jj=0; jj < res.index; ++jj) {
+    free(res[jj].elements);
+  }
+  free(res.elements);
+
+  }
+
+  K.resize(nzero, 3 + D);
+  return K;
+}
+
+pyublas::numpy_matrix<double> VectorTree::kernel_deriv_wrt_pts1(const pyublas::numpy_matrix<double> &pts1, const pyublas::numpy_matrix<double> &pts2, int k) {
+  // K(a, b) = deriv of k(pts1[a], pts2[b]) wrt the k'th component of
+  // pts1[a], i.e. kernel_deriv_wrt_xi stacked over all points of pts1.
+
+  if (this->ddfn_dx == NULL) {
+    printf("ERROR: gradient not implemented for this distance function.\n");
+    exit(1);
+  }
+  if (this->dwfn_dr == NULL) {
+    printf("ERROR: gradient not implemented for this weight function.\n");
+    exit(1);
+  }
+
+  pyublas::numpy_matrix<double> K(pts1.size1(), pts2.size1());
+  for(unsigned i = 0; i < pts1.size1 (); ++ i) {
+    point p1 = {&pts1(i, 0), 0};
+    for (unsigned j = 0; j < pts2.size1 (); ++ j) {
+      point p2 = {&pts2(j, 0), 0};
+      double r = this->dfn(p1, p2, std::numeric_limits< double >::max(), this->dist_params, this->dfn_extra);
+      double dr_dp1 = this->ddfn_dx(p1.p, p2.p, k, r, std::numeric_limits< double >::max(), this->dist_params, this->dfn_extra);
+      K(i,j) = this->dwfn_dr(r, dr_dp1, this->wp);
+    }
+  }
+  return K;
+}
+
 pyublas::numpy_matrix<double> VectorTree::kernel_deriv_wrt_xi(const pyublas::numpy_matrix<double> &pts1, const pyublas::numpy_matrix<double> &pts2, int i, int k) {
   // deriv of kernel matrix with respect to k'th component of the 'ith input point.
 
@@ -602,6 +775,61 @@ pyublas::numpy_vector<double> VectorTree::sparse_distances(const pyublas::numpy_
 }
 
 
+pyublas::numpy_vector<double> VectorTree::kernel_from_distances(const pyublas::numpy_vector<double> &distance_entries) {
+  // the weight function applied to each distance
+  pyublas::numpy_vector<double> entries(distance_entries.size());
+  for (unsigned i = 0; i < distance_entries.size(); ++ i) {
+    entries[i] = this->w(distance_entries[i], this->wp);
+  }
+  return entries;
+}
+
+pyublas::numpy_vector<int> VectorTree::knn(const pyublas::numpy_matrix<double> &query_pts, int k) {
+  // indices of the k tree points nearest to each query point, nearest
+  // first, as a flattened (n_queries x k) array padded with -1 when
+  // the tree has fewer than k points.
+
+  unsigned int nq = query_pts.size1();
+  pyublas::numpy_vector<int> nbrs(nq * k);
+  for (unsigned int i = 0; i < nq * k; ++i) {
+    nbrs[i] = -1;
+  }
+  if (nq == 0 || k <= 0) {
+    return nbrs;
+  }
+
+  vector< point > queries(nq);
+  for (unsigned int i = 0; i < nq; ++i) {
+    point p = {&query_pts(i, 0), i};
+    queries[i] = p;
+  }
+  node<point> query_root = batch_create(queries, this->dfn, this->dist_params, this->dfn_extra);
+
+  v_array<v_array<point> > res;
+  k_nearest_neighbor(this->root, query_root, res, k, this->dfn, this->dist_params, this->dfn_extra);
+
+  // each result lists the query point, then its neighbors in no
+  // particular order (ties at the k'th distance may add extras).
+  vector< pair<double, int> > found;
+  for (int i = 0; i < res.index; ++i) {
+    point q = res[i][0];
+    found.clear();
+    for (int j = 1; j < res[i].index; ++j) {
+      double d = this->dfn(q, res[i][j], std::numeric_limits< double >::max(), this->dist_params, this->dfn_extra);
+      found.push_back(make_pair(d, (int) res[i][j].idx));
+    }
+    sort(found.begin(), found.end());
+    for (unsigned int j = 0; j < found.size() && j < (unsigned int) k; ++j) {
+      nbrs[q.idx * k + j] = found[j].second;
+    }
+    free(res[i].elements);
+  }
+  free(res.elements);
+  query_root.free_tree();
+
+  return nbrs;
+}
+
 pyublas::numpy_vector<double> VectorTree::sparse_kernel_deriv_wrt_i(const pyublas::numpy_matrix<double> &pts1, const pyublas::numpy_matrix<double> &pts2, const pyublas::numpy_vector<int> &nzr, const pyublas::numpy_vector<int> &nzc, int param_i, const pyublas::numpy_vector<double> distance_entries) {
 
   pyublas::numpy_vector<double> entries(nzr.size());
@@ -632,20 +860,68 @@ void VectorTree::set_Kinv_for_dense_hack(const pyublas::numpy_strided_vector<int
 					 const pyublas::numpy_strided_vector<int> &nonzero_cols,
 					 const pyublas::numpy_strided_vector<double> &nonzero_vals) {
 
-  this->Kinv_for_dense_hack = new dense_hash_map<unsigned long, double>;
-  this->Kinv_for_dense_hack->set_empty_key(this->n * this->n);
+  // build a CSR representation of Kinv from the (row, col, val)
+  // triples, by counting sort on the row index.
+  unsigned int nnz = nonzero_rows.size();
+  this->Kinv_indptr.assign(this->n + 1, 0);
+  this->Kinv_indices.resize(nnz);
+  this->Kinv_vals.resize(nnz);
 
-  dense_hash_map<unsigned long, double> &hmap = *(this->Kinv_for_dense_hack);
+  for(unsigned int i=0; i < nnz; ++i) {
+    this->Kinv_indptr[nonzero_rows[i]+1]++;
+  }
+  for(unsigned int r=0; r < this->n; ++r) {
+    this->Kinv_indptr[r+1] += this->Kinv_indptr[r];
+  }
+
+  vector<int> next(this->Kinv_indptr.begin(), this->Kinv_indptr.end()-1);
+  for(unsigned int i=0; i < nnz; ++i) {
+    int pos = next[nonzero_rows[i]]++;
+    this->Kinv_indices[pos] = nonzero_cols[i];
+    this->Kinv_vals[pos] = nonzero_vals[i];
+  }
+
+  // sort the column indices within each row
+  vector< std::pair<int, double> > row;
+  for(unsigned int r=0; r < this->n; ++r) {
+    int rstart = this->Kinv_indptr[r], rend = this->Kinv_indptr[r+1];
+    row.clear();
+    for (int pos=rstart; pos < rend; ++pos) {
+      row.push_back(std::make_pair(this->Kinv_indices[pos], this->Kinv_vals[pos]));
+    }
+    std::sort(row.begin(), row.end());
+    for (int pos=rstart; pos < rend; ++pos) {
+      this->Kinv_indices[pos] = row[pos-rstart].first;
+      this->Kinv_vals[pos] = row[pos-rstart].second;
+    }
+  }
 
-  for(unsigned int i=0; i < nonzero_rows.size(); ++i) {
-    unsigned long key = (unsigned long)nonzero_rows[i] * this->n + nonzero_cols[i];
-    hmap[key] = nonzero_vals[i];
+  if (this->single_precision) {
+    // keep only a float copy; entries are widened to double as
+    // they're read, so sums still accumulate in double.
+    this->Kinv_vals_f.assign(this->Kinv_vals.begin(), this->Kinv_vals.end());
+    vector<double>().swap(this->Kinv_vals);
+  } else {
+    vector<float>().swap(this->Kinv_vals_f);
   }
 }
 
-double VectorTree::quadratic_form_from_dense_hack(const pyublas::numpy_matrix<double> &query_pt1, const pyublas::numpy_matrix<double> &query_pt2, double max_distance) {
+void VectorTree::set_single_precision(bool single_precision) {
+  // takes effect at the next set_Kinv_for_dense_hack
+  this->single_precision = single_precision;
+}
+
+double VectorTree::Kinv_entry(int i, int j) const {
+  vector<int>::const_iterator rstart = this->Kinv_indices.begin() + this->Kinv_indptr[i];
+  vector<int>::const_iterator rend = this->Kinv_indices.begin() + this->Kinv_indptr[i+1];
+  vector<int>::const_iterator it = std::lower_bound(rstart, rend, j);
+  if (it == rend || *it != j) {
+    return 0.0;
+  }
+  return this->Kinv_val(it - this->Kinv_indices.begin());
+}
 
-  dense_hash_map<unsigned long, double> &hmap = *(this->Kinv_for_dense_hack);
+double VectorTree::quadratic_form_from_dense_hack(const pyublas::numpy_matrix<double> &query_pt1, const pyublas::numpy_matrix<double> &query_pt2, double max_distance) {
 
   // we want to find all points which are near *both* pt1 and pt2. for the moment, let's concentrate on when pt1 and pt2 are the same.
 
@@ -653,7 +929,7 @@ double VectorTree::quadratic_form_from_dense_hack(const pyublas::numpy_matrix<do
   point pt2 = {&query_pt2(0,0), 0};
 
   if ((pt1.p[0] != pt2.p[0]) || (pt1.p[1] != pt2.p[1])) {
-    printf("ERROR: quadratic_form_from_dense_hack is not yet implemented for off-diagonal covariances.\n");
+    printf("ERROR: quadratic_form_from_dense_hack is not yet implemented for off-diagonal covariances (use quadratic_form_from_dense_hack_batch).\n");
     exit(1);
   }
 
@@ -703,8 +979,7 @@ double VectorTree::quadratic_form_from_dense_hack(const pyublas::numpy_matrix<do
     this->dense_hack_dfn_evals += 1;
     this->dense_hack_wfn_evals += 1;
 
-    unsigned long train_key = (unsigned long) i * this->n + i;
-    double Kinv = hmap[train_key];
+    double Kinv = this->Kinv_entry(i, i);
     qf += kstar[ii-1] * kstar[ii-1] * Kinv;
     this->dense_hack_terms++;
   }
@@ -718,8 +993,7 @@ double VectorTree::quadratic_form_from_dense_hack(const pyublas::numpy_matrix<do
       point train_p2 = res[0][jj];
       int j = train_p2.idx;
 
-      long train_key = (unsigned long) i * this->n + j;
-      double Kinv = hmap[train_key];
+      double Kinv = this->Kinv_entry(i, j);
 
       qf += kstar[ii-1] * kstar[jj-1] * Kinv * 2;
       this->dense_hack_terms++;
@@ -738,6 +1012,134 @@ double VectorTree::quadratic_form_from_dense_hack(const pyublas::numpy_matrix<do
   return qf;
 }
 
+pyublas::numpy_matrix<double> VectorTree::quadratic_form_from_dense_hack_batch(const pyublas::numpy_matrix<double> &query_pts, double max_distance) {
+  // compute the full m x m matrix of quadratic forms k_i^T Kinv k_j for
+  // a block of m query points. We gather the union of the training
+  // points near any query point, pull out the corresponding dense
+  // submatrix of Kinv, and do the products with BLAS.
+
+  int m = query_pts.size1();
+
+  this->dense_hack_dfn_evals = 0;
+  this->dense_hack_wfn_evals = 0;
+  this->dense_hack_terms = 0;
+
+  struct timeval stop, start;
+  gettimeofday(&start, NULL);
+
+  vector< vector<int> > nbr_idx(m);
+  vector< vector<double> > nbr_k(m);
+  vector<int> all_idx;
+
+  if (this->dfn_extra) {
+    ((int *)this->dfn_extra)[1] = 0;
+  }
+  for (int q = 0; q < m; ++q) {
+    point qp = {&query_pts(q, 0), 0};
+
+    v_array<v_array<point> > res;
+    node<point> np1;
+    np1.p = qp;
+    np1.max_dist = 0.;
+    np1.parent_dist = 0.;
+    np1.children = NULL;
+    np1.num_children = 0;
+    np1.scale = 100;
+
+    epsilon_nearest_neighbor(this->root,np1,res,max_distance, this->dfn, this->dist_params, this->dfn_extra);
+
+    // res[0][0] is the query point itself
+    for(int ii = 1; ii < res[0].index; ++ii) {
+      point train_p = res[0][ii];
+      double d = this->dfn(qp, train_p, std::numeric_limits< double >::max(), this->dist_params, this->dfn_extra);
+      nbr_idx[q].push_back(train_p.idx);
+      nbr_k[q].push_back(this->w(d, this->wp));
+      all_idx.push_back(train_p.idx);
+      this->dense_hack_dfn_evals += 1;
+      this->dense_hack_wfn_evals += 1;
+    }
+
+    for (int jj=0; jj < res.index; ++jj) {
+      free(res[jj].elements);
+    }
+    free(res.elements);
+  }
+  if (this->dfn_extra) {
+    this->dense_hack_dfn_evals += ((int *)this->dfn_extra)[1];
+  }
+
+  gettimeofday(&stop, NULL);
+  this->dense_hack_tree_s = (stop.tv_sec - start.tv_sec) + (stop.tv_usec - start.tv_usec)/1000000.0;
+  gettimeofday(&start, NULL);
+
+  std::sort(all_idx.begin(), all_idx.end());
+  all_idx.erase(std::unique(all_idx.begin(), all_idx.end()), all_idx.end());
+  int u = all_idx.size();
+
+  pyublas::numpy_matrix<double> qf(m, m);
+  for (int i = 0; i < m; ++i) {
+    for (int j = 0; j < m; ++j) {
+      qf(i,j) = 0;
+    }
+  }
+  if (u == 0) {
+    gettimeofday(&stop, NULL);
+    this->dense_hack_math_s =(stop.tv_sec - start.tv_sec) + (stop.tv_usec - start.tv_usec)/1000000.0;
+    return qf;
+  }
+
+  // Kq is u x m in column-major order: column q holds the kernel
+  // values between query q and the gathered training points.
+  vector<double> Kq((size_t)u * m, 0.0);
+  for (int q = 0; q < m; ++q) {
+    for (unsigned int ii = 0; ii < nbr_idx[q].size(); ++ii) {
+      int pos = std::lower_bound(all_idx.begin(), all_idx.end(), nbr_idx[q][ii]) - all_idx.begin();
+      Kq[(size_t)q * u + pos] = nbr_k[q][ii];
+    }
+  }
+
+  // gather the dense u x u submatrix of Kinv from its CSR rows
+  vector<double> Kinv_sub((size_t)u * u, 0.0);
+  for (int a = 0; a < u; ++a) {
+    int r = all_idx[a];
+    for (int pos = this->Kinv_indptr[r]; pos < this->Kinv_indptr[r+1]; ++pos) {
+      vector<int>::iterator it = std::lower_bound(all_idx.begin(), all_idx.end(), this->Kinv_indices[pos]);
+      if (it != all_idx.end() && *it == this->Kinv_indices[pos]) {
+	Kinv_sub[(size_t)(it - all_idx.begin()) * u + a] = this->Kinv_val(pos);
+	this->dense_hack_terms++;
+      }
+    }
+  }
+
+  // T = Kinv_sub * Kq, then qf = Kq^T * T
+  vector<double> T((size_t)u * m);
+  vector<double> Q((size_t)m * m);
+  double one = 1.0, zero = 0.0;
+  char N = 'N', TR = 'T';
+  dgemm_(&N, &N, &u, &m, &u, &one, &Kinv_sub[0], &u, &Kq[0], &u, &zero, &T[0], &u);
+  dgemm_(&TR, &N, &m, &m, &u, &one, &Kq[0], &u, &T[0], &u, &zero, &Q[0], &m);
+
+  for (int j = 0; j < m; ++j) {
+    for (int i = 0; i < m; ++i) {
+      qf(i,j) = Q[(size_t)j * m + i];
+    }
+  }
+
+  gettimeofday(&stop, NULL);
+  this->dense_hack_math_s =(stop.tv_sec - start.tv_sec) + (stop.tv_usec - start.tv_usec)/1000000.0;
+  return qf;
+}
+
+
+unsigned long VectorTree::memory_bytes() {
+  // tree nodes, plus the CSR copy of Kinv held for the dense hack
+  unsigned long bytes = sizeof(VectorTree) + node_memory_bytes(this->root);
+  bytes += this->Kinv_indptr.capacity() * sizeof(int);
+  bytes += this->Kinv_indices.capacity() * sizeof(int);
+  bytes += this->Kinv_vals.capacity() * sizeof(double);
+  bytes += this->Kinv_vals_f.capacity() * sizeof(float);
+  return bytes;
+}
 
 VectorTree::~VectorTree() {
   if (this->dist_params != NULL) {
@@ -757,6 +1159,83 @@ VectorTree::~VectorTree() {
 
 }
 
+pyublas::numpy_vector<double> sparse_fic_trace(const pyublas::numpy_vector<int> &nzr,
+					       const pyublas::numpy_vector<int> &nzc,
+					       const pyublas::numpy_vector<double> &Kinv_entries,
+					       const pyublas::numpy_matrix<double> &Dt,
+					       const pyublas::numpy_matrix<double> &dDt,
+					       const pyublas::numpy_matrix<double> &dKnu) {
+
+  // tr(Kinv dQ_p) over the off-diagonal nonzeros of Kinv, for every FIC
+  // hyperparameter p at once, where
+  //     dQ_p = dKnu_p D + D^T dKnu_p^T - D^T dKuu_p D.
+  // Dt is D^T (n x nu), and dDt, dKnu hold (dKuu_p D)^T and dKnu_p
+  // (each n x nu) side by side for all params. Each thread accumulates
+  // its (static) share of the nonzeros separately, and the partial sums
+  // are added in thread order, so results don't vary from run to run.
+
+  int nnz = nzr.size();
+  int nu = Dt.size2();
+  int stride = dKnu.size2();
+  int nparams = nu > 0 ? stride / nu : 0;
+
+  pyublas::numpy_vector<double> tr(nparams);
+  for (int p=0; p < nparams; ++p) tr(p) = 0;
+  if (nnz == 0 || nparams == 0) return tr;
+
+  const double * D = &Dt(0,0);
+  const double * dD = &dDt(0,0);
+  const double * dK = &dKnu(0,0);
+
+  int nthreads = 1;
+#ifdef _OPENMP
+  nthreads = omp_get_max_threads();
+#endif
+  vector<double> partial(nthreads * nparams, 0.0);
+
+#pragma omp parallel num_threads(nthreads)
+  {
+    int t = 0;
+#ifdef _OPENMP
+    t = omp_get_thread_num();
+#endif
+    vector<double> local(nparams, 0.0);
+
+#pragma omp for schedule(static)
+    for (int i=0; i < nnz; ++i) {
+      int ri = nzr[i];
+      int ci = nzc[i];
+      if (ri == ci) continue;
+
+      const double * Dr = D + ri*nu;
+      const double * Dc = D + ci*nu;
+      const double * dDc = dD + ci*stride;
+      const double * dKr = dK + ri*stride;
+      const double * dKc = dK + ci*stride;
+      double kv = Kinv_entries[i];
+
+      for (int p=0; p < nparams; ++p) {
+	double entry = 0;
+	for (int k=0; k < nu; ++k) {
+	  entry -= Dr[k] * dDc[p*nu + k];
+	  entry += dKr[p*nu + k] * Dc[k];
+	  entry += dKc[p*nu + k] * Dr[k];
+	}
+	local[p] += kv * entry;
+      }
+    }
+
+    for (int p=0; p < nparams; ++p) partial[t*nparams + p] = local[p];
+  }
+
+  for (int t=0; t < nthreads; ++t) {
+    for (int p=0; p < nparams; ++p) {
+      tr(p) += partial[t*nparams + p];
+    }
+  }
+  return tr;
+}
+
 BOOST_PYTHON_MODULE(cover_tree) {
   bp::class_<VectorTree>("VectorTree", bp::init< pyublas::numpy_matrix< double > const &, int const, string const &, pyublas::numpy_vector< double > const &, string const &, pyublas::numpy_vector< double > const &>())
     .def("dump_tree", &VectorTree::dump_tree)
@@ -764,16 +1243,24 @@ BOOST_PYTHON_MODULE(cover_tree) {
     .def("set_v", &VectorTree::set_v)
     .def("get_v", &VectorTree::get_v)
     .def("weighted_sum", &VectorTree::weighted_sum)
+    .def("weighted_sum_bounds", &VectorTree::weighted_sum_bounds)
     .def("kernel_matrix", &VectorTree::kernel_matrix)
     .def("sparse_training_kernel_matrix", &VectorTree::sparse_training_kernel_matrix)
     .def("kernel_deriv_wrt_xi", &VectorTree::kernel_deriv_wrt_xi)
+    .def("kernel_deriv_wrt_pts1", &VectorTree::kernel_deriv_wrt_pts1)
+    .def("sparse_training_kernel_deriv_wrt_x", &VectorTree::sparse_training_kernel_deriv_wrt_x)
     .def("kernel_deriv_wrt_xi_row", &VectorTree::kernel_deriv_wrt_xi_row)
     .def("dist_deriv_wrt_xi_row", &VectorTree::dist_deriv_wrt_xi_row)
     .def("kernel_deriv_wrt_i", &VectorTree::kernel_deriv_wrt_i)
     .def("sparse_kernel_deriv_wrt_i", &VectorTree::sparse_kernel_deriv_wrt_i)
     .def("sparse_kernel_deriv_wrt_xi", &VectorTree::sparse_kernel_deriv_wrt_xi)
     .def("sparse_distances", &VectorTree::sparse_distances)
+    .def("kernel_from_distances", &VectorTree::kernel_from_distances)
+    .def("knn", &VectorTree::knn)
     .def("quadratic_form_from_dense_hack", &VectorTree::quadratic_form_from_dense_hack)
+    .def("quadratic_form_from_dense_hack_batch", &VectorTree::quadratic_form_from_dense_hack_batch)
+    .def("memory_bytes", &VectorTree::memory_bytes)
+    .def("set_single_precision", &VectorTree::set_single_precision)
     .def("set_Kinv_for_dense_hack", &VectorTree::set_Kinv_for_dense_hack)
     .def_readonly("nodes_touched", &VectorTree::nodes_touched)
     .def_readonly("dfn_evals", &VectorTree::dfn_evals)
@@ -791,15 +1278,20 @@ BOOST_PYTHON_MODULE(cover_tree) {
     .def("set_m_sparse", &MatrixTree::set_m_sparse)
     .def("get_m", &MatrixTree::get_m)
     .def("quadratic_form", &MatrixTree::quadratic_form)
+    .def("quadratic_form_bounds", &MatrixTree::quadratic_form_bounds)
     .def("print_hierarchy", &MatrixTree::print_hierarchy)
     .def("test_bounds", &MatrixTree::test_bounds)
     .def("compile", &MatrixTree::compile)
+    .def("memory_bytes", &MatrixTree::memory_bytes)
     .def_readonly("nodes_touched", &MatrixTree::nodes_touched)
     .def_readonly("dfn_evals", &MatrixTree::dfn_evals)
     .def_readonly("wfn_evals", &MatrixTree::wfn_evals)
     .def_readonly("terms", &MatrixTree::terms)
     .def_readonly("zeroterms", &MatrixTree::zeroterms)
     .def_readonly("dfn_misses", &MatrixTree::dfn_misses)
-    .def_readonly("wfn_misses", &MatrixTree::wfn_misses);
+    .def_readonly("wfn_misses", &MatrixTree::wfn_misses)
+    .def_readonly("build_s", &MatrixTree::build_s);
+
+  bp::def("sparse_fic_trace", sparse_fic_trace);
 
 }
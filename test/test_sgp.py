@@ -1,8 +1,15 @@
 import numpy as np
+import scipy.sparse
 import unittest
+import threading
 
-from treegp.gp import GP, GPCov, optimize_gp_hyperparams
+from treegp.gp import GP, GPCov, CholmodAnalysisCache, optimize_gp_hyperparams, sum_log_p, maximize_sum_log_p, mcov, prior_sample_scalable
 from treegp.features import featurizer_from_string
+from treegp.distributions import LogNormal
+from treegp.jointgp import JointGP
+from treegp.iterative import PCGSolver, slq_logdet
+from treegp.server import ModelServer, Client
+from treegp.registry import ModelRegistry
 
 from treegp.cover_tree import VectorTree
 import pyublas
@@ -90,6 +97,102 @@ class TestGP(unittest.TestCase):
         g_dense = gp._log_likelihood_gradient(None, gp.Kinv.todense())
         self.assertTrue( (np.abs(g_sparse - g_dense) < 0.0001 ).all() )
 
+    def test_memoized_objective(self):
+        nllgrad, x0, bounds, build_gp, _ = optimize_gp_hyperparams(X=self.X, y=self.y, noise_var=self.noise_var, cov_main=self.cov, noise_prior=LogNormal(0.0, 2.0))
+
+        nll1, grad1 = nllgrad(x0)
+        g = grad1.copy()
+        grad1[0] += 1.0
+        nll2, grad2 = nllgrad(x0.copy())
+        self.assertEqual(nll1, nll2)
+        self.assertTrue((grad2 == g).all())
+        self.assertEqual((nllgrad.hits, nllgrad.misses), (1, 1))
+
+        # a nearby vector reuses the symbolic factorization
+        v = x0 * 1.01
+        gp1 = build_gp(v, compute_ll=True)
+        gp2 = build_gp(v, compute_ll=True, chol_cache=False)
+        self.assertAlmostEqual(gp1.ll, gp2.ll, places=8)
+
+    def test_chol_cache(self):
+        cache = CholmodAnalysisCache()
+        gp1 = GP(X=self.X, y=self.y, noise_var=self.noise_var, cov_main=self.cov, compute_ll=True, chol_cache=cache)
+        gp2 = GP(X=self.X, y=self.y, noise_var=2*self.noise_var, cov_main=self.cov, compute_ll=True, chol_cache=cache)
+        gp3 = GP(X=self.X, y=self.y, noise_var=2*self.noise_var, cov_main=self.cov, compute_ll=True, chol_cache=False)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertAlmostEqual(gp2.ll, gp3.ll, places=8)
+
+    def test_treedense_covariance(self):
+        gp = GP(X=self.X, y=self.y, noise_var=self.noise_var, cov_main=self.cov,
+                build_tree=True, build_dense_Kinv_hack=True)
+        testX = np.array([[120, 30, 0,], [119, 31, 0,], [118, 30, 20,]], dtype=float)
+        c1 = gp.covariance(testX)
+        c2 = gp.covariance_treedense(testX)
+        self.assertTrue( (np.abs(c1 - c2) < 1e-6 ).all() )
+
+    def test_profile(self):
+        gp = GP(X=self.X, y=self.y, noise_var=self.noise_var, cov_main=self.cov,
+                build_tree=True, build_dense_Kinv_hack=True, profile=True)
+        testX = np.array([[120, 30, 0,], [119, 31, 0,], [118, 30, 20,]], dtype=float)
+        gp.predict(testX)
+        gp.covariance_double_tree(testX)
+        gp.covariance_double_tree(testX)
+
+        summary = gp.stats.summary()
+        for phase in ('build_K', 'chol_factor', 'solve_Kinv', 'build_point_tree', 'predict'):
+            self.assertEqual(summary['phases'][phase]['calls'], 1)
+        self.assertEqual(summary['phases']['covariance_double_tree']['calls'], 2)
+        self.assertEqual(summary['counters']['double_tree.terms']['n'], 18)
+        self.assertTrue(summary['counters']['double_tree.build_s']['total'] < 1000.0)
+
+        gp.stats.reset()
+        self.assertEqual(gp.stats.summary()['phases'], dict())
+
+        # profiling is off by default
+        gp = GP(X=self.X, y=self.y, noise_var=self.noise_var, cov_main=self.cov, build_tree=False)
+        gp.covariance(testX)
+        self.assertEqual(gp.stats.summary()['phases'], dict())
+
+    def test_single_precision(self):
+        gp1 = GP(X=self.X, y=self.y, noise_var=self.noise_var, cov_main=self.cov,
+                 build_tree=True, build_dense_Kinv_hack=True)
+        gp2 = GP(X=self.X, y=self.y, noise_var=self.noise_var, cov_main=self.cov,
+                 build_tree=True, build_dense_Kinv_hack=True, single_precision=True)
+        self.assertEqual(gp2.Kinv.dtype, np.float32)
+        self.assertTrue(gp2.memory_report()['Kinv'] < gp1.memory_report()['Kinv'])
+
+        testX = np.array([[120, 30, 0,], [119, 31, 0,], [118, 30, 20,]], dtype=float)
+        self.assertTrue( (np.abs(gp1.predict(testX) - gp2.predict(testX)) < 1e-5 ).all() )
+        self.assertTrue( (np.abs(gp1.covariance(testX) - gp2.covariance(testX)) < 1e-5 ).all() )
+        self.assertTrue( (np.abs(gp1.covariance(testX) - gp2.covariance_treedense(testX)) < 1e-5 ).all() )
+
+    def test_single_precision_dense_hack(self):
+        # float32 Kinv (in the model and the dense-hack tree) should
+        # change predictions by well under 1e-4 of the prior variance,
+        # on a problem with a few dozen neighbors per point.
+        np.random.seed(0)
+        X = np.random.uniform(0, 10, size=(300, 2))
+        y = np.sin(X[:,0]) * np.cos(X[:,1]) + 0.1 * np.random.randn(300)
+        cov = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5, 1.5], wfn_str="compact2", dfn_str="euclidean")
+        gp1 = GP(X=X, y=y, noise_var=0.1, cov_main=cov, build_tree=True, build_dense_Kinv_hack=True)
+        gp2 = GP(X=X, y=y, noise_var=0.1, cov_main=cov, build_tree=True, build_dense_Kinv_hack=True, single_precision=True)
+
+        testX = np.random.uniform(0, 10, size=(20, 2))
+        v1 = np.diag(gp1.covariance_treedense(testX))
+        self.assertTrue( (np.abs(gp1.predict(testX) - gp2.predict(testX)) < 1e-4 ).all() )
+        self.assertTrue( (np.abs(gp1.variance(testX) - gp2.variance(testX)) < 1e-4 ).all() )
+        self.assertTrue( (np.abs(v1 - np.diag(gp2.covariance_treedense(testX))) < 1e-4 ).all() )
+        self.assertTrue( (np.abs(v1 - gp1.variance(testX)) < 1e-6 ).all() )
+
+    def test_prior_sample_scalable(self):
+        np.random.seed(0)
+        X = np.array([[0.0, 0.0], [0.3, 0.1], [0.5, 0.5], [2.0, 1.0]])
+        for wfn_str in ("compact2", "se"):
+            cov = GPCov(wfn_params=[2.0,], dfn_params=[ 1.0, 1.0], wfn_str=wfn_str, dfn_str="euclidean")
+            samples = prior_sample_scalable(X, cov, self.noise_var, n_samples=20000, n_rff=2000, chunk_size=3)
+            K = mcov(X, cov, self.noise_var)
+            self.assertTrue( (np.abs(np.cov(samples) - K) < 0.15 ).all() )
+
     def test_SE_gradient(self):
 
         cov1 = GPCov(wfn_params=[3.0,], dfn_params=[ 900.00, 1000.0, ], wfn_str="se", dfn_str="lld")
@@ -101,6 +204,35 @@ class TestGP(unittest.TestCase):
         cov3 = GPCov(wfn_params=[3.0,], dfn_params=[ 10.00, 10.0, 40.0], wfn_str="se", dfn_str="euclidean")
         self._check_gradient(cov3)
 
+    def test_rff_gradient(self):
+        cov = GPCov(wfn_params=[3.0,], dfn_params=[ 10.00, 10.0, 40.0], wfn_str="se", dfn_str="euclidean", rff_dim=30)
+        self._check_gradient(cov)
+
+    def test_rff_load_save(self):
+        # with enough features the approximation should be close to
+        # the exact SE model, and a saved model should regenerate
+        # exactly the same features.
+        cov_exact = GPCov(wfn_params=[3.0,], dfn_params=[ 10.00, 10.0, 40.0], wfn_str="se", dfn_str="euclidean")
+        cov_rff = GPCov(wfn_params=[3.0,], dfn_params=[ 10.00, 10.0, 40.0], wfn_str="se", dfn_str="euclidean", rff_dim=5000)
+        gp_exact = GP(X=self.X, y=self.y, noise_var=self.noise_var, cov_main=cov_exact, sparse_invert=False)
+        gp1 = GP(X=self.X, y=self.y, noise_var=self.noise_var, cov_main=cov_rff, compute_ll=True)
+
+        testX = np.array([[120, 30, 0,], [119, 31, 0,], [118, 30, 20,]], dtype=float)
+        self.assertTrue( (np.abs(gp1.predict(testX) - gp_exact.predict(testX)) < 0.05 ).all() )
+        self.assertTrue( (np.abs(gp1.variance(testX) - gp_exact.variance(testX)) < 0.05 ).all() )
+
+        # a dense solve is never needed: only the noise is factored
+        gp3 = GP(X=self.X, y=self.y, noise_var=self.noise_var, cov_main=cov_rff, compute_ll=True, sparse_invert=False)
+        self.assertTrue(scipy.sparse.issparse(gp3.Kinv))
+        self.assertEqual(gp3.Kinv.nnz, len(self.y))
+        self.assertAlmostEqual(gp1.ll, gp3.ll, places=8)
+        self.assertTrue( (np.abs(gp1.predict(testX) - gp3.predict(testX)) < 1e-8 ).all() )
+
+        gp1.save_trained_model("test_rff.npz")
+        gp2 = GP(fname="test_rff.npz", build_tree=False)
+        self.assertTrue( (np.abs(gp1.predict(testX) - gp2.predict(testX)) < 1e-8 ).all() )
+        self.assertTrue( (np.abs(gp1.variance(testX) - gp2.variance(testX)) < 1e-8 ).all() )
+
 
 
     """
@@ -364,6 +496,268 @@ class TestCSFIC(unittest.TestCase):
         self.assertAlmostEqual(true_ll, gp.ll, places=8)
 
 
+    def test_fic_projection(self):
+        # the explicit Luu^-1 used for small numbers of inducing points
+        # should agree with the triangular solve.
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact0", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+
+        gp = GP(X=self.X, y=self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic,
+                sparse_threshold=0, build_tree=False)
+        self.assertTrue(gp.Luu_inv is not None)
+
+        x_test = np.reshape(np.linspace(-6,6,20), (-1, 1))
+        var1 = gp.variance(x_test)
+        pred1 = gp.predict(x_test)
+
+        gp.Luu_inv = None
+        gp.fic_hsh = None
+        var2 = gp.variance(x_test)
+        pred2 = gp.predict(x_test)
+        self.assertTrue( ( np.abs(var1-var2) < 1e-10 ).all() )
+        self.assertTrue( ( np.abs(pred1-pred2) < 1e-10 ).all() )
+
+    def test_log_p_batch(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact0", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+
+        gp1 = GP(X=self.X, y=self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic,
+                 sparse_threshold=0, build_tree=False)
+        gp2 = GP(X=self.X, y=-self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic,
+                 sparse_threshold=0, build_tree=False)
+        self.assertEqual(gp1.query_signature(), gp2.query_signature())
+
+        # differences beyond print precision, or in the sparsity
+        # threshold, give different signatures
+        cov_fic2 = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5 + 1e-12,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+        gp3 = GP(X=self.X, y=self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic2,
+                 sparse_threshold=0, build_tree=False)
+        gp4 = GP(X=self.X, y=self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic,
+                 sparse_threshold=1e-4, build_tree=False)
+        self.assertNotEqual(gp1.query_signature(), gp3.query_signature())
+        self.assertNotEqual(gp1.query_signature(), gp4.query_signature())
+
+        x_test = np.reshape(np.linspace(-6,6,20), (-1, 1))
+        lp1 = gp1.log_p_batch(0.5, x_test, chunk_size=7)
+        lp1_naive = np.array([gp1.log_p(0.5, x_test[i:i+1]) for i in range(20)]).flatten()
+        self.assertTrue( ( np.abs(lp1-lp1_naive) < 1e-6 ).all() )
+
+        lp2 = gp2.log_p_batch(-0.3, x_test)
+        lp = sum_log_p([gp1, gp2], [0.5, -0.3], x_test)
+        self.assertTrue( ( np.abs(lp - (lp1 + lp2)) < 1e-8 ).all() )
+
+    def test_sum_log_p_grid(self):
+        # a meshgrid-built candidate grid is Fortran-ordered, so its
+        # chunks aren't contiguous unless sum_log_p copies it
+        np.random.seed(0)
+        X = np.random.uniform(-5, 5, size=(30, 2))
+        y = np.sin(X[:,0]) + np.cos(X[:,1])
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5, 2.5], wfn_str="compact2", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5, 1.5], wfn_str="se", dfn_str="euclidean",
+                        Xu = np.array(((-2.0, -2.0), (2.0, 2.0))))
+        gp = GP(X=X, y=y, noise_var = 0.5, cov_main = cov_main, cov_fic = cov_fic,
+                sparse_threshold=0, build_tree=False)
+
+        g = np.linspace(-6, 6, 5)
+        grid = np.array(np.meshgrid(g, g, indexing='ij')).reshape((2, -1)).T
+        self.assertFalse(grid.flags['C_CONTIGUOUS'])
+        lp = sum_log_p([gp,], [0.5,], grid, chunk_size=7)
+        lp_naive = np.array([gp.log_p(0.5, np.ascontiguousarray(grid[i:i+1])) for i in range(grid.shape[0])]).flatten()
+        self.assertTrue( ( np.abs(lp - lp_naive) < 1e-6 ).all() )
+
+    def test_location_search(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact0", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+
+        gp1 = GP(X=self.X, y=self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic,
+                 sparse_threshold=0, build_tree=True)
+        gp2 = GP(X=self.X, y=-self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic,
+                 sparse_threshold=0, build_tree=True)
+        models, ys = [gp1, gp2], [-1.5, 1.0]
+
+        # the bound over a box should dominate the density at every
+        # point inside it.
+        lo, hi = np.array((-3.0,)), np.array((-1.0,))
+        ub = np.sum([m.log_p_bound(y, lo, hi) for (m, y) in zip(models, ys)])
+        x_test = np.reshape(np.linspace(-3, -1, 20), (-1, 1))
+        self.assertTrue( ( sum_log_p(models, ys, x_test) <= ub + 1e-8 ).all() )
+
+        x_grid = np.reshape(np.linspace(-6, 6, 481), (-1, 1))
+        lp_grid = sum_log_p(models, ys, x_grid)
+        x, lp, stats = maximize_sum_log_p(models, ys, (-6.0,), (6.0,), min_width=0.05)
+        self.assertAlmostEqual(lp, sum_log_p(models, ys, np.reshape(x, (1, -1)))[0])
+        self.assertGreater(lp, np.max(lp_grid) - 0.05)
+        self.assertLess(stats['evals'], len(x_grid))
+
+    def test_predict_bounds(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact0", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+        gp = GP(X=self.X, y=self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic,
+                sparse_threshold=0, build_tree=True)
+
+        # the bounds must hold at every point inside the box
+        np.random.seed(0)
+        for (lo, hi) in [((-3.0,), (-1.0,)), ((-6.0,), (6.0,)), ((2.0,), (2.5,))]:
+            mean_lo, mean_hi, var_lo = gp.predict_bounds(np.array(lo), np.array(hi))
+            x_test = np.random.uniform(lo[0], hi[0], size=(50, 1))
+            mean = gp.predict(x_test)
+            var = gp.variance(x_test, include_obs=True)
+            self.assertTrue( ( (mean_lo - 1e-8 <= mean) & (mean <= mean_hi + 1e-8) ).all() )
+            self.assertTrue( ( var_lo <= var + 1e-8 ).all() )
+
+        # corners don't bound the distance under other metrics
+        cov_lld = GPCov(wfn_params=[1.0,], dfn_params=[ 500.0, 100.0], wfn_str="compact2", dfn_str="lld")
+        X = np.array([[-120.0, 30.0, 0.0], [100.0, -45.0, 10.0], [10.0, 60.0, 5.0]])
+        gp_lld = GP(X=X, y=np.array([1.0, -1.0, 0.5]), noise_var=1.0, cov_main=cov_lld, build_tree=True)
+        self.assertRaises(ValueError, gp_lld.predict_bounds, np.array((-180.0, -90.0, 0.0)), np.array((180.0, 90.0, 10.0)))
+
+    def test_predict_and_grad_far(self):
+        # a query outside every training point's support sees only the prior
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        gp = GP(X=self.X, y=self.y1, noise_var = 1.0, cov_main = cov_main,
+                sparse_threshold=0, build_tree=False)
+        self.assertTrue(gp.single_trees_on_X)
+
+        x_test = np.array([[20.0,], [-3.0,], [-30.0,]])
+        mean, dmean, var, dvar = gp.predict_and_grad(x_test, pad=0)
+        self.assertTrue( ( mean[[0,2]] == 0.0 ).all() )
+        self.assertTrue( ( dmean[[0,2]] == 0.0 ).all() )
+        self.assertTrue( ( var[[0,2]] == 1.0 ).all() )
+        self.assertTrue( ( dvar[[0,2]] == 0.0 ).all() )
+        self.assertTrue( ( np.abs(mean - gp.predict(x_test)) < 1e-8 ).all() )
+        self.assertTrue( ( np.abs(var - gp.variance(x_test, pad=0)) < 1e-8 ).all() )
+
+    def test_noncontiguous_queries(self):
+        # strided rows and column slices hash and predict like copies
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+        gp = GP(X=self.X, y=self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic,
+                sparse_threshold=0, build_tree=False)
+
+        x_rows = np.reshape(np.linspace(-6,6,40), (-1, 1))[::2]
+        x_cols = np.hstack((x_rows, np.zeros(x_rows.shape)))[:, :1]
+        x_copy = np.array(x_rows)
+        for X1 in (x_rows, x_cols):
+            self.assertFalse(X1.flags['C_CONTIGUOUS'])
+            self.assertTrue( ( np.abs(gp.predict(X1) - gp.predict(x_copy)) < 1e-12 ).all() )
+            self.assertTrue( ( np.abs(gp.variance(X1) - gp.variance(x_copy)) < 1e-12 ).all() )
+
+    def test_predict_and_grad(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+
+        gp = GP(X=self.X, y=self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic,
+                sparse_threshold=0, build_tree=False)
+
+        x_test = np.reshape(np.linspace(-6,6,20), (-1, 1)) + 0.01
+        mean, dmean, var, dvar = gp.predict_and_grad(x_test)
+        self.assertTrue( ( np.abs(mean - gp.predict(x_test)) < 1e-8 ).all() )
+        self.assertTrue( ( np.abs(var - gp.variance(x_test)) < 1e-8 ).all() )
+
+        eps = 1e-6
+        lp, dlp = gp.log_p_and_grad(0.5, x_test)
+        lp1 = gp.log_p_batch(0.5, x_test - eps)
+        lp2 = gp.log_p_batch(0.5, x_test + eps)
+        mean1, _, var1, _ = gp.predict_and_grad(x_test - eps)
+        mean2, _, var2, _ = gp.predict_and_grad(x_test + eps)
+        self.assertTrue( ( np.abs(dmean[:,0] - (mean2-mean1)/(2*eps)) < 1e-5 ).all() )
+        self.assertTrue( ( np.abs(dvar[:,0] - (var2-var1)/(2*eps)) < 1e-5 ).all() )
+        self.assertTrue( ( np.abs(dlp[:,0] - (lp2-lp1)/(2*eps)) < 1e-5 ).all() )
+
+    def test_sample_pathwise(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+
+        gp = GP(X=self.X, y=self.y1, noise_var = 0.1, cov_main = cov_main, cov_fic = cov_fic,
+                sparse_threshold=0, build_tree=False)
+
+        np.random.seed(0)
+        x_test = np.reshape(np.linspace(-6,6,5), (-1, 1)) + 0.01
+        samples = gp.sample_pathwise(x_test, include_obs=False, n_samples=20000)
+        self.assertEqual(samples.shape, (5, 20000))
+
+        mean = gp.predict(x_test)
+        cov = gp.covariance(x_test)
+        self.assertTrue( ( np.abs(np.mean(samples, axis=1) - mean) < 0.05 ).all() )
+        self.assertTrue( ( np.abs(np.cov(samples) - cov) < 0.05 ).all() )
+
+    def test_ski(self):
+        # grid interpolation should closely match the exact GP inside the grid
+        cov = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean")
+        gp_exact = GP(X=self.X, y=self.y1, noise_var=1.0, cov_main=cov, sparse_invert=False)
+        gp_ski = GP(X=self.X, y=self.y1, noise_var=1.0, cov_main=cov, ski_grid=100, ski_bounds=([-6.0,], [6.0,]))
+
+        x_test = np.reshape(np.linspace(-6,6,37), (-1, 1))
+        self.assertTrue( ( np.abs(gp_ski.predict(x_test) - gp_exact.predict(x_test)) < 1e-3 ).all() )
+        self.assertTrue( ( np.abs(gp_ski.variance(x_test) - gp_exact.variance(x_test)) < 1e-3 ).all() )
+        self.assertTrue( ( np.abs(np.diag(gp_ski.covariance(x_test)) - gp_ski.variance(x_test)) < 1e-8 ).all() )
+
+        # the grid kernel is a function of x - x', which lld isn't
+        cov_lld = GPCov(wfn_params=[1.0,], dfn_params=[ 500.0, 100.0], wfn_str="se", dfn_str="lld")
+        X = np.array([[-120.0, 30.0, 0.0], [100.0, -45.0, 10.0], [10.0, 60.0, 5.0]])
+        self.assertRaises(ValueError, GP, X=X, y=np.array([1.0, -1.0, 0.5]), noise_var=1.0, cov_main=cov_lld, ski_grid=10)
+
+    def test_vecchia(self):
+        # conditioning on every earlier point is exact
+        cov = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean")
+        n = self.X.shape[0]
+        gp_exact = GP(X=self.X, y=self.y1, noise_var=0.1, cov_main=cov, sparse_invert=False, compute_ll=True, compute_grad=True)
+        gp_vec = GP(X=self.X, y=self.y1, noise_var=0.1, cov_main=cov, vecchia_k=n, compute_ll=True, compute_grad=True)
+        self.assertAlmostEqual(gp_exact.ll, gp_vec.ll, places=8)
+        self.assertTrue( ( np.abs(gp_exact.ll_grad - gp_vec.ll_grad) < 1e-6 ).all() )
+
+        x_test = np.reshape(np.linspace(-6,6,20), (-1, 1))
+        self.assertTrue( ( np.abs(gp_vec.predict(x_test) - gp_exact.predict(x_test)) < 1e-6 ).all() )
+        self.assertTrue( ( np.abs(gp_vec.variance(x_test) - gp_exact.variance(x_test)) < 1e-6 ).all() )
+
+        # a few neighbors give a close approximation, with exact gradients
+        gp3 = GP(X=self.X, y=self.y1, noise_var=0.1, cov_main=cov, vecchia_k=5, compute_ll=True, compute_grad=True)
+        self.assertAlmostEqual(gp3.ll, gp_exact.ll, delta=1.0)
+        eps = 1e-6
+        gp_lo = GP(X=self.X, y=self.y1, noise_var=0.1-eps, cov_main=cov, vecchia_k=5, compute_ll=True)
+        gp_hi = GP(X=self.X, y=self.y1, noise_var=0.1+eps, cov_main=cov, vecchia_k=5, compute_ll=True)
+        self.assertAlmostEqual(gp3.ll_grad[0], (gp_hi.ll - gp_lo.ll)/(2*eps), places=4)
+
+        self.assertRaises(ValueError, GP, X=self.X, y=self.y1, noise_var=0.1, cov_main=cov, vecchia_k=5, ski_grid=100)
+
+    def test_pcg_solver(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+
+        gp1 = GP(X=self.X, y=self.y1, noise_var = 0.1, cov_main = cov_main, cov_fic = cov_fic,
+                 sparse_threshold=0, build_tree=False)
+        gp2 = GP(X=self.X, y=self.y1, noise_var = 0.1, cov_main = cov_main, cov_fic = cov_fic,
+                 sparse_threshold=0, build_tree=False, solver="pcg")
+        self.assertTrue(gp2.timings['pcg_resid'] < 1e-8)
+
+        x_test = np.reshape(np.linspace(-6,6,20), (-1, 1))
+        self.assertTrue( ( np.abs(gp1.predict(x_test) - gp2.predict(x_test)) < 1e-6 ).all() )
+        self.assertTrue( ( np.abs(gp1.variance(x_test) - gp2.variance(x_test)) < 1e-6 ).all() )
+
+        # several preconditioner blocks, including a padded one
+        solver = PCGSolver(gp1.K, block_size=4)
+        B = np.random.randn(self.X.shape[0], 2)
+        self.assertTrue( ( np.abs(solver(B) - np.linalg.solve(gp1.K.toarray(), B)) < 1e-6 ).all() )
+
+    def test_slq_likelihood(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+
+        gp1 = GP(X=self.X, y=self.y1, noise_var = 0.1, cov_main = cov_main, cov_fic = cov_fic,
+                 sparse_threshold=0, build_tree=False, compute_ll=True)
+        gp2 = GP(X=self.X, y=self.y1, noise_var = 0.1, cov_main = cov_main, cov_fic = cov_fic,
+                 sparse_threshold=0, build_tree=False, compute_ll=True, solver="pcg")
+        self.assertAlmostEqual(gp1.ll, gp2.ll, delta=1.0)
+
+        K = gp1.K.toarray()
+        ld = slq_logdet(K.dot, K.shape[0], n_probes=1000, rng=np.random.RandomState(0))
+        self.assertAlmostEqual(ld, np.linalg.slogdet(K)[1], delta=0.2)
+
+        cov_se = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean")
+        gp3 = GP(X=self.X, y=self.y1, noise_var=1.0, cov_main=cov_se, sparse_invert=False, compute_ll=True)
+        gp4 = GP(X=self.X, y=self.y1, noise_var=1.0, cov_main=cov_se, ski_grid=100, compute_ll=True)
+        self.assertAlmostEqual(gp3.ll, gp4.ll, delta=1.0)
+
     def test_load_save(self):
         cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact0", dfn_str="euclidean")
         cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
@@ -391,6 +785,126 @@ class TestCSFIC(unittest.TestCase):
         self.assertTrue((p1 == p2).all())
         self.assertTrue((v1 == v2).all())
 
+    def test_cross_validation(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+        gp = GP(X=self.X, y=self.y1, noise_var = 0.1, cov_main = cov_main, cov_fic = cov_fic,
+                sparse_threshold=0, build_tree=False, sort_events=False, ymean=0.5)
+
+        means, variances, logps = gp.loo_predictions()
+        folds = [[3,], [10, 11, 17]]
+        kmeans, kvariances, klogps, fold_logps = gp.kfold_predictions(folds)
+        for I in folds:
+            rest = np.setdiff1d(np.arange(self.X.shape[0]), I)
+            gp_rest = GP(X=self.X[rest], y=self.y1[rest], noise_var = 0.1, cov_main = cov_main, cov_fic = cov_fic,
+                         sparse_threshold=0, build_tree=False, sort_events=False, ymean=0.5)
+            m = gp_rest.predict(self.X[I])
+            C = gp_rest.covariance(self.X[I], include_obs=True, pad=0)
+            self.assertTrue( (np.abs(kmeans[I] - m) < 1e-6 ).all() )
+            self.assertTrue( (np.abs(kvariances[I] - np.diag(C)) < 1e-6 ).all() )
+            if len(I) == 1:
+                self.assertAlmostEqual(means[I[0]], m, places=6)
+                self.assertAlmostEqual(variances[I[0]], C[0,0], places=6)
+                self.assertAlmostEqual(klogps[I[0]], fold_logps[0], places=6)
+
+        # singleton folds are leave-one-out
+        kmeans, kvariances, klogps, _ = gp.kfold_predictions([[i,] for i in range(self.X.shape[0])])
+        self.assertTrue( (np.abs(kmeans - means) < 1e-6 ).all() )
+        self.assertTrue( (np.abs(klogps - logps) < 1e-6 ).all() )
+
+    def test_server(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+        gp1 = GP(X=self.X, y=self.y1, noise_var = 0.1, cov_main = cov_main, cov_fic = cov_fic, sparse_threshold=0)
+        gp2 = GP(X=self.X, y=-self.y1, noise_var = 0.1, cov_main = cov_main, sparse_threshold=0)
+
+        ms = ModelServer({"gp1": gp1, "gp2": gp2}, max_wait=0.01)
+        server = ms.serve_http()
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        client = Client(port=server.server_address[1])
+
+        pts = np.reshape(np.linspace(-5, 5, 20), (-1, 1))
+        results = dict()
+        def query(i):
+            results[i] = client.query("gp%d" % (i % 2 + 1), pts[i], include_obs=True)
+        threads = [threading.Thread(target=query, args=(i,)) for i in range(len(pts))]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+
+        for i in range(len(pts)):
+            gp = gp1 if i % 2 == 0 else gp2
+            self.assertAlmostEqual(results[i][0], gp.predict(pts[i:i+1]), places=6)
+            self.assertAlmostEqual(results[i][1], gp.variance(pts[i:i+1], include_obs=True)[0], places=6)
+
+        stats = client.stats()
+        self.assertEqual(stats['phases']['query']['calls'], len(pts))
+        self.assertEqual(stats['counters']['batch_size']['total'], len(pts))
+        server.shutdown()
+        ms.close()
+
+    def test_memory_report(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        cov_fic = GPCov(wfn_params=[1.0,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
+        gp1 = GP(X=self.X, y=self.y1, noise_var = 1.0, cov_main = cov_main, cov_fic = cov_fic,
+                 sparse_threshold=0, build_tree=True)
+
+        report = gp1.memory_report()
+        self.assertEqual(report['HKinv'], gp1.HKinv.nbytes)
+        self.assertTrue(report['double_tree'] > 0)
+        self.assertEqual(report['total'], sum([v for (k, v) in report.items() if k != 'total']))
+
+        gp1.save_trained_model("test_csfic_mem.npz")
+        gp2 = GP(fname="test_csfic_mem.npz", mean_only=True)
+        self.assertTrue('Kinv' not in gp2.memory_report())
+
+        pts = np.reshape(np.linspace(-5, 5, 20), (-1, 1))
+        self.assertTrue( (np.abs(gp1.predict(pts) - gp2.predict(pts)) < 1e-6 ).all() )
+        self.assertRaises(ValueError, gp2.variance, pts)
+
+        # served through predict, without variances
+        ms = ModelServer({"mean": gp2}, max_wait=0.001)
+        mean, var = ms.query("mean", pts[3], variance=True, timeout=10.0)
+        self.assertAlmostEqual(mean, gp1.predict(pts[3:4]), places=6)
+        self.assertTrue(var is None)
+        ms.close()
+
+    def test_registry(self):
+        cov_main = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        gps = dict()
+        for i in range(3):
+            gps[i] = GP(X=self.X, y=self.y1 * (i+1), noise_var = 1.0, cov_main = cov_main, sparse_threshold=0)
+            gps[i].save_trained_model("test_registry_%d.npz" % i)
+
+        # room for two loaded models (without trees)
+        size = GP(fname="test_registry_0.npz", build_tree=False).memory_report()['total']
+        registry = ModelRegistry(resolve=lambda i: "test_registry_%d.npz" % i, memory_budget=int(2.5*size), build_tree=False)
+
+        pts = np.reshape(np.linspace(-5, 5, 20), (-1, 1))
+        for i in (0, 1, 0, 2, 0):
+            gp = registry.get(i)
+            self.assertTrue( (np.abs(gp.predict(pts) - gps[i].predict(pts)) < 1e-6 ).all() )
+        self.assertTrue(0 in registry and 2 in registry and 1 not in registry)
+
+        summary = registry.summary()
+        self.assertEqual((summary['hits'], summary['misses'], summary['evictions']), (2, 3, 1))
+        self.assertTrue(summary['memory_used'] <= registry.memory_budget)
+
+        registry.prefetch([1,])
+        registry.close()
+        self.assertTrue(1 in registry)
+        self.assertTrue(registry.get(1, build_tree=True).double_tree is not None)
+
+        # a failed prefetch surfaces at the next request
+        registry = ModelRegistry(fnames={"bad": "test_registry_missing.npz"}, build_tree=False)
+        registry.prefetch(["bad",])
+        registry.close()
+        self.assertRaises(IOError, registry.get, "bad")
+        self.assertEqual(registry.summary()['load_errors'], 1)
+
     def test_gradient(self):
         cov_main = GPCov(wfn_params=[.5,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
         cov_fic = GPCov(wfn_params=[1.2,], dfn_params=[ 1.5,], wfn_str="se", dfn_str="euclidean", Xu = self.u)
@@ -509,6 +1023,16 @@ class TestCSFICSemiParametric(unittest.TestCase):
         self.assertTrue((v1 == v2).all())
 
 
+    def test_predict_and_grad(self):
+        x_test = np.reshape(np.linspace(-4,4,15), (-1, 1)) + 0.01
+        mean, dmean, var, dvar = self.gp.predict_and_grad(x_test)
+
+        eps = 1e-6
+        mean1, _, var1, _ = self.gp.predict_and_grad(x_test - eps)
+        mean2, _, var2, _ = self.gp.predict_and_grad(x_test + eps)
+        self.assertTrue( ( np.abs(dmean[:,0] - (mean2-mean1)/(2*eps)) < 1e-4 ).all() )
+        self.assertTrue( ( np.abs(dvar[:,0] - (var2-var1)/(2*eps)) < 1e-4 ).all() )
+
     def test_gradient(self):
         grad = self.gp.ll_grad
 
@@ -600,5 +1124,78 @@ class TestCSFICSemiParametric(unittest.TestCase):
 
         self.assertAlmostEqual(gp_smallfic.ll, gp_nofic.ll, places=5)
 
+class TestJointGP(unittest.TestCase):
+
+    def setUp(self):
+        N = 25
+        self.X = np.reshape(np.linspace(-5,5,N), (-1, 1))
+        self.X2 = np.reshape(np.linspace(-4,6,15), (-1, 1))
+        self.y1 = np.array([-1.02804007, -1.54448568, -0.31653812, -0.46768499, 0.67463927, 1.06519473, -1.39472442, -0.72392324, -2.99133689, -0.59922449, -3.70430871, -1.75810012, -0.80376896, -0.50514541, -0.5459166, 1.6353825, -1.13032502, 0.80372166, -0.01374143, -1.16083918, -1.6099601, -4.37523678, -1.53780366, -2.98047752, -3.41214803])
+        self.y2 = np.sin(self.X2.flatten())
+        self.cov1 = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        self.cov2 = GPCov(wfn_params=[2.0,], dfn_params=[ 1.5,], wfn_str="compact2", dfn_str="euclidean")
+        self.x_test = np.reshape(np.linspace(-6,6,20), (-1, 1))
+
+    def test_independent(self):
+        # with no cross-covariance, each process should match its own GP.
+        jgp = JointGP(Xs=[self.X, self.X2], ys=[self.y1, self.y2],
+                      covs=[self.cov1, self.cov2], noise_vars=[1.0, 0.1],
+                      compute_ll=True)
+
+        gp1 = GP(X=self.X, y=self.y1, noise_var=1.0, cov_main=self.cov1, compute_ll=True,
+                 sparse_threshold=0, build_tree=False, sparse_invert=True)
+        gp2 = GP(X=self.X2, y=self.y2, noise_var=0.1, cov_main=self.cov2, compute_ll=True,
+                 sparse_threshold=0, build_tree=False, sparse_invert=True)
+
+        for (idx, gp) in enumerate((gp1, gp2)):
+            self.assertTrue( ( np.abs(jgp.predict(idx, self.x_test) - gp.predict(self.x_test)) < 1e-7 ).all() )
+            self.assertTrue( ( np.abs(jgp.variance(idx, self.x_test) - gp.variance(self.x_test)) < 1e-7 ).all() )
+
+        self.assertAlmostEqual(jgp.ll, gp1.ll + gp2.ll, places=6)
+
+    def test_shared_component(self):
+        # two noisy observations of the same function: the joint model
+        # should reduce the variance relative to either process alone.
+        cov_shared = GPCov(wfn_params=[1.0,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        jgp = JointGP(Xs=[self.X, self.X2], ys=[self.y1, self.y2],
+                      covs=[self.cov1, self.cov1], noise_vars=[1.0, 1.0],
+                      cross_covs={(0,1): cov_shared})
+        jgp_indep = JointGP(Xs=[self.X, self.X2], ys=[self.y1, self.y2],
+                            covs=[self.cov1, self.cov1], noise_vars=[1.0, 1.0])
+
+        v_joint = jgp.variance(0, self.x_test)
+        v_indep = jgp_indep.variance(0, self.x_test)
+        self.assertTrue( (v_joint <= v_indep + 1e-8).all() )
+        self.assertEqual(len(jgp.alphas[1]), len(self.y2))
+
+    def test_cross_covariance(self):
+        # compare against the dense joint GP, assembled block by block
+        cov_cross = GPCov(wfn_params=[0.8,], dfn_params=[ 2.5,], wfn_str="compact2", dfn_str="euclidean")
+        covs = [self.cov1, self.cov1]
+        noise_vars = [1.0, 0.5]
+        jgp = JointGP(Xs=[self.X, self.X2], ys=[self.y1, self.y2],
+                      covs=covs, noise_vars=noise_vars,
+                      cross_covs={(0,1): cov_cross}, compute_ll=True)
+
+        def k(cov, X1, X2):
+            return VectorTree(X2, 1, *cov.tree_params()).kernel_matrix(X1, X2, False)
+        pair_covs = {(0,0): covs[0], (1,1): covs[1], (0,1): cov_cross, (1,0): cov_cross}
+
+        X0, X1 = jgp.Xs
+        K = np.vstack([np.hstack([k(self.cov1, X0, X0) + noise_vars[0] * np.eye(len(X0)), k(cov_cross, X0, X1)]),
+                       np.hstack([k(cov_cross, X1, X0), k(self.cov1, X1, X1) + noise_vars[1] * np.eye(len(X1))])])
+        y = np.concatenate(jgp.ys)
+        alpha = np.linalg.solve(K, y)
+
+        ll = -.5 * (np.dot(y, alpha) + np.linalg.slogdet(K)[1] + len(y) * np.log(2*np.pi))
+        self.assertAlmostEqual(jgp.ll, ll, places=6)
+
+        for idx in range(2):
+            Kstar = np.hstack([k(pair_covs[(idx, q)], self.x_test, jgp.Xs[q]) for q in range(2)])
+            mean = np.dot(Kstar, alpha)
+            var = covs[idx].wfn_params[0] - np.sum(Kstar * np.linalg.solve(K, Kstar.T).T, axis=1)
+            self.assertTrue( ( np.abs(jgp.predict(idx, self.x_test) - mean) < 1e-6 ).all() )
+            self.assertTrue( ( np.abs(jgp.variance(idx, self.x_test) - var) < 1e-6 ).all() )
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,207 @@
+import numpy as np
+
+# candidate neighbors initially fetched from the tree for each point,
+# as a multiple of k, when looking for its k nearest predecessors in
+# the ordering. Points left with too few predecessors among their
+# candidates are queried again with twice as many.
+VECCHIA_OVERSAMPLE = 4
+
+# conditioning sets solved together in one batch, bounding the
+# chunk x k x k temporaries.
+VECCHIA_CHUNK = 4096
+
+
+def previous_neighbors(tree, X, k, oversample=VECCHIA_OVERSAMPLE):
+    """
+    For each row i of X, the indices of its k nearest neighbors among
+    rows 0..i-1 (all of them, for i <= k), nearest first, as an n x k
+    array padded with -1. tree is a VectorTree built on X, so
+    distances are those of its kernel.
+    """
+    n = X.shape[0]
+    nbrs = -np.ones((n, k), dtype=np.int32)
+    if n == 0 or k == 0:
+        return nbrs
+
+    def take(rows, m):
+        # keep the first k predecessors among each row's m nearest
+        # points, returning how many were found
+        cand = np.reshape(tree.knn(X[rows], m), (len(rows), m))
+        prev = (cand >= 0) & (cand < rows[:, None])
+        rank = np.cumsum(prev, axis=1)
+        keep = prev & (rank <= k)
+        r, c = np.nonzero(keep)
+        nbrs[rows[r], rank[r, c] - 1] = cand[r, c]
+        return np.sum(keep, axis=1)
+
+    # the first m points have fewer predecessors than we'd fetch
+    # candidates, so scanning them directly is cheaper: O(m^2) total.
+    m = min(n, oversample * k + 1)
+    D = tree.kernel_matrix(X[:m], X[:m], True)
+    for i in range(1, m):
+        nearest = np.argsort(np.asarray(D[i, :i]).flatten(), kind='mergesort')[:k]
+        nbrs[i, :len(nearest)] = nearest
+
+    # every later point has at least k predecessors. Once m reaches n,
+    # the candidates include all of them.
+    todo = np.arange(m, n)
+    while len(todo) > 0:
+        found = take(todo, m)
+        todo = todo[found < k]
+        m = min(n, 2 * m)
+    return nbrs
+
+
+class VecchiaApprox(object):
+
+    def __init__(self, X, y, tree, nbrs, noise_diag, prior_var, chunk=VECCHIA_CHUNK):
+        """
+        Vecchia approximation p(y) ~= prod_i p(y_i | y_N(i)) to a GP
+        marginal likelihood, where N(i) are the (at most k) conditioning
+        points of row i, all earlier in the ordering, given by nbrs (an
+        n x k array padded with -1, see previous_neighbors()).
+
+        With C = K + diag(noise_diag), each conditional is Gaussian with
+        mean b_i^T y_N(i) and variance d_i, where
+
+          b_i = C_NN^-1 C_Ni,   d_i = C_ii - C_iN b_i,
+
+        so that C^-1 ~= U^T diag(1/d) U for the sparse unit triangular U
+        whose row i holds -b_i in the columns N(i): a sparse inverse
+        Cholesky factor with k+1 nonzeros per row. The conditionals are
+        independent k x k problems, O(n k^3) in total, which we solve
+        in batches of chunk points with stacked numpy solves.
+
+        tree is a VectorTree built on X, providing the kernel (and its
+        derivatives) between arbitrary pairs of points.
+        """
+        self.X = X
+        self.y = y
+        self.tree = tree
+        self.nbrs = nbrs
+        self.noise_diag = noise_diag
+        self.prior_var = prior_var
+        self.chunk = chunk
+
+        n, k = nbrs.shape
+        self.b = np.zeros((n, k))
+        self.d = np.zeros((n,))
+        for I in self.chunks():
+            C_NN, C_Ni = self.conditional_cov(self.X, I, self.nbrs[I])[:2]
+            self.b[I] = np.linalg.solve(C_NN, C_Ni[:, :, None])[:, :, 0]
+            self.d[I] = self.prior_var + self.noise_diag[I] - np.sum(C_Ni * self.b[I], axis=1)
+        if np.min(self.d) <= 0:
+            raise np.linalg.LinAlgError("Vecchia conditional variances are not positive")
+        self.r = self.y - np.sum(self.b * self.y[np.maximum(self.nbrs, 0)], axis=1)
+
+    def chunks(self):
+        n = self.nbrs.shape[0]
+        for start in range(0, n, self.chunk):
+            yield np.arange(start, min(n, start + self.chunk))
+
+    def pair_indices(self, nb):
+        # flattened (row, column) indices into X of every (neighbor,
+        # neighbor) pair for each row of nb, with padding mapped to 0
+        k = nb.shape[1]
+        nbz = np.where(nb >= 0, nb, 0).astype(np.int32)
+        return nbz, np.repeat(nbz, k, axis=1).flatten(), np.tile(nbz, (1, k)).flatten()
+
+    def conditional_cov(self, Xq, qi, nb):
+        """
+        Covariances for conditioning the query points Xq[qi] on the
+        training points nb (a c x k array padded with -1): the c x k x k
+        noisy covariances C_NN among the neighbors, with padding rows
+        replaced by the identity, and the c x k noise-free kernel K_Nq
+        between neighbors and query points (zero for padding). Also
+        returns the noise-free K_NN, and the index and distance arrays
+        of both sets of pairs, for derivatives.
+        """
+        c, k = nb.shape
+        valid = nb >= 0
+        nbz, ra, rb = self.pair_indices(nb)
+        dNN = self.tree.sparse_distances(self.X, self.X, ra, rb)
+        K_NN = np.reshape(self.tree.kernel_from_distances(dNN), (c, k, k))
+        K_NN *= valid[:, :, None] & valid[:, None, :]
+
+        qc = np.repeat(np.asarray(qi, dtype=np.int32), k)
+        dNq = self.tree.sparse_distances(self.X, Xq, nbz.flatten(), qc)
+        K_Nq = np.reshape(self.tree.kernel_from_distances(dNq), (c, k)) * valid
+
+        C_NN = K_NN.copy()
+        diag = np.arange(k)
+        C_NN[:, diag, diag] += np.where(valid, self.noise_diag[nbz], 1.0)
+        return C_NN, K_Nq, K_NN, (ra, rb, dNN), (nbz.flatten(), qc, dNq)
+
+    def log_likelihood(self):
+        n = len(self.d)
+        return -.5 * (np.sum(np.log(self.d)) + np.sum(self.r**2 / self.d) + n * np.log(2*np.pi))
+
+    def log_likelihood_gradient(self, n_dfn_params):
+        """
+        Gradient of log_likelihood() with respect to the noise
+        variance, the kernel's scale (wfn_params[0], the prior
+        variance) and its n_dfn_params distance parameters, in that
+        order. For a parameter p, with dC the derivative of C,
+
+          d d_i / dp = dC_ii - 2 dC_iN b_i + b_i^T dC_NN b_i
+          d r_i / dp = -(dC_iN u_i - b_i^T dC_NN u_i),
+
+        where u_i = C_NN^-1 y_N(i), so each point's contribution costs
+        O(k^2) per parameter after its O(k^3) solve.
+        """
+        n, k = self.nbrs.shape
+        grad = np.zeros((2 + n_dfn_params,))
+        for I in self.chunks():
+            nb = self.nbrs[I]
+            C_NN, K_Ni, K_NN, (ra, rb, dNN), (rq, qc, dNq) = self.conditional_cov(self.X, I, nb)
+            yN = self.y[np.maximum(nb, 0)] * (nb >= 0)
+            u = np.linalg.solve(C_NN, yN[:, :, None])[:, :, 0]
+            b, d, r = self.b[I], self.d[I], self.r[I]
+            f = -.5 * (1.0/d - r**2/d**2)
+            g = r / d
+
+            def contrib(dC_ii, dc, dC_NN):
+                dd = dC_ii - 2*np.sum(dc * b, axis=1) + np.einsum('ca,cab,cb->c', b, dC_NN, b)
+                dr = np.einsum('ca,cab,cb->c', b, dC_NN, u) - np.sum(dc * u, axis=1)
+                return np.sum(f * dd - g * dr)
+
+            # noise: dC_NN is the identity on the (valid) neighbors
+            valid = nb >= 0
+            grad[0] += np.sum(f * (1.0 + np.sum(b**2, axis=1)) - g * np.sum(b * u, axis=1))
+
+            # the kernel is linear in its scale
+            s = self.prior_var
+            grad[1] += contrib(np.ones(len(I)), K_Ni / s, K_NN / s)
+
+            pair_valid = valid[:, :, None] & valid[:, None, :]
+            for j in range(n_dfn_params):
+                dK_NN = np.reshape(self.tree.sparse_kernel_deriv_wrt_i(self.X, self.X, ra, rb, j, dNN), (len(I), k, k)) * pair_valid
+                dK_Ni = np.reshape(self.tree.sparse_kernel_deriv_wrt_i(self.X, self.X, rq, qc, j, dNq), (len(I), k)) * valid
+                grad[2+j] += contrib(np.zeros(len(I)), dK_Ni, dK_NN)
+        return grad
+
+    def predict(self, X1, nbrs1, want_var=True):
+        """
+        Mean and (if want_var) noise-free variance at each row of X1,
+        conditioning each on the training points nbrs1 (an m x k array
+        padded with -1, usually its k nearest neighbors): the mean is
+        K_*N C_NN^-1 y_N and the variance k(x,x) - K_*N C_NN^-1 K_N*.
+        """
+        m = X1.shape[0]
+        mean = np.zeros((m,))
+        var = np.zeros((m,)) if want_var else None
+        for start in range(0, m, self.chunk):
+            I = np.arange(start, min(m, start + self.chunk))
+            nb = nbrs1[I]
+            C_NN, K_Nq = self.conditional_cov(X1, I, nb)[:2]
+            yN = self.y[np.maximum(nb, 0)] * (nb >= 0)
+            if want_var:
+                B = np.linalg.solve(C_NN, np.concatenate((yN[:, :, None], K_Nq[:, :, None]), axis=2))
+                mean[I] = np.sum(K_Nq * B[:, :, 0], axis=1)
+                var[I] = self.prior_var - np.sum(K_Nq * B[:, :, 1], axis=1)
+            else:
+                mean[I] = np.sum(K_Nq * np.linalg.solve(C_NN, yN[:, :, None])[:, :, 0], axis=1)
+        return mean, var
+
+    def memory_bytes(self):
+        return self.nbrs.nbytes + self.b.nbytes + self.d.nbytes + self.r.nbytes